@@ -1,7 +1,12 @@
-from flask import Flask, render_template, redirect, url_for, request, session, flash
+from flask import Flask, render_template, redirect, url_for, request, session, flash, g, abort, make_response, \
+	has_request_context, stream_with_context
 from flask.ext.sqlalchemy import SQLAlchemy
-from sqlalchemy import desc
+from sqlalchemy import desc, or_, and_, func, select, bindparam, event, union_all, literal_column, cast
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import contains_eager, subqueryload, joinedload
+from sqlalchemy.exc import IntegrityError
 from werkzeug.security import generate_password_hash, check_password_hash
+from itsdangerous import URLSafeTimedSerializer, BadSignature
 from flask_wtf.csrf import CsrfProtect
 from flask_wtf import Form
 from wtforms import TextField, IntegerField, BooleanField, PasswordField, HiddenField, validators, \
@@ -9,57 +14,421 @@ from wtforms import TextField, IntegerField, BooleanField, PasswordField, Hidden
 from wtforms.widgets import HiddenInput
 from wtforms.validators import Required, EqualTo, Optional, Length, Email, NumberRange
 from datetime import datetime, timedelta
-from celery import Celery
-
-app = Flask(__name__)
-app.config.from_object("config")
+from decimal import Decimal, InvalidOperation
+from collections import OrderedDict, deque
+from assets import AssetManifest, gzipped
+import hashlib
+import heapq
+import jinja2
+import json
+import ledgerio
+import os
+import pytz
+import random
+import threading
+import time
 
 csrf = CsrfProtect()
-csrf.init_app(app)
-
-db = SQLAlchemy(app)
+db = SQLAlchemy()
 
-celery = Celery(app)
-celery.conf.add_defaults(app.config)
+def create_app(config='config'):
+	# config is anything app.config.from_object takes. Celery and Flask-Mail are bound in tasks.py,
+	# which only the worker and the views that queue a task import, so serving pages needs no broker.
+	app = Flask(__name__)
+	app.config.from_object(config)
+	csrf.init_app(app)
+	db.init_app(app)
+	# scripts, migrations and tasks use db outside a request
+	db.app = app
+	return app
 
+# the views below register on this app; PIGGYBANK_CONFIG picks another config module (tests, tools)
+app = create_app(os.environ.get('PIGGYBANK_CONFIG', 'config'))
 
-'''
-### Celery Flask Integration
-def make_celery(app):
-    celery = Celery(app.import_name, broker=app.config['CELERY_BROKER_URL'])
-    celery.conf.update(app.config)
-    TaskBase = celery.Task
-    class ContextTask(TaskBase):
-        abstract = True
-        def __call__(self, *args, **kwargs):
-            with app.app_context():
-                return TaskBase.__call__(self, *args, **kwargs)
-    celery.Task = ContextTask
-    return celery
-celery = make_celery(app)
-'''
 
 ### Login/Session Manager
 class LoginManager:
+	# The session carries a signed, expiring token of (user id, session_version). Verifying it is an
+	# HMAC check; the user is then loaded once per request and cached on g. Bumping
+	# User.session_version revokes every token issued before.
+	serializer = None
+
+	def get_serializer(self):
+		if self.serializer == None:
+			self.serializer = URLSafeTimedSerializer(app.config['SECRET_KEY'], salt='session-token')
+		return self.serializer
+
 	def login(self, user, password):
 		session['userid'] = user.id
-		session['sessionhash'] = generate_password_hash(user.username+str(user.id)) # change to user.email?
+		session['token'] = self.get_serializer().dumps([user.id, user.session_version or 0])
+		g.user = user
 		return
 
 	def logout(self):
 		session.pop('userid', None)
-		session.pop('sessionhash', None)
+		session.pop('token', None)
+		g.user = None
 		return True
 
+	def revoke(self, user):
+		user.session_version = (user.session_version or 0) + 1
+		db.session.commit()
+		return
+
 	def check_login(self, session):
-		if 'userid' in session:
-			user = User.query.get_or_404(session['userid'])
-			if check_password_hash(session['sessionhash'], user.username+str(user.id)):
-				return True
-		return False
+		return self.current_user() != None
+
+	def current_user(self):
+		if getattr(g, 'user', False) == False:
+			g.user = self.load_user(session)
+		return g.user
+
+	def load_user(self, session):
+		if 'token' not in session:
+			return None
+		try:
+			userid, version = self.get_serializer().loads(session['token'], max_age=app.config.get('SESSION_TOKEN_MAX_AGE'))
+		except BadSignature:
+			return None
+		if userid != session.get('userid'):
+			return None
+		user = User.query.get(userid)
+		if user == None or user.active != True or (user.session_version or 0) != version:
+			return None
+		return user
 
 lm = LoginManager()
 
+### Fragment Cache
+class LRUCache:
+	# in-process cache for a single worker, with the get/set interface of werkzeug's cache backends
+	def __init__(self, size=1000):
+		self.size = size
+		self.items = OrderedDict()
+		self.lock = threading.Lock()
+
+	def get(self, key):
+		with self.lock:
+			value = self.items.pop(key, None)
+			if value != None:
+				self.items[key] = value
+			return value
+
+	def set(self, key, value, timeout=None):
+		with self.lock:
+			self.items.pop(key, None)
+			self.items[key] = value
+			while len(self.items) > self.size:
+				self.items.popitem(last=False)
+		return True
+
+	def clear(self):
+		with self.lock:
+			self.items.clear()
+		return True
+
+def make_fragment_cache(config):
+	# 'lru' per process; 'redis' or 'memcached' share fragments between gunicorn workers and dynos
+	kind = config.get('FRAGMENT_CACHE_TYPE', 'lru')
+	if kind == 'redis':
+		import redis
+		from werkzeug.contrib.cache import RedisCache
+		return RedisCache(redis.from_url(config['FRAGMENT_CACHE_URL']), default_timeout=config.get('FRAGMENT_CACHE_TIMEOUT', 86400))
+	if kind == 'memcached':
+		from werkzeug.contrib.cache import MemcachedCache
+		return MemcachedCache(config['FRAGMENT_CACHE_URL'].split(','), default_timeout=config.get('FRAGMENT_CACHE_TIMEOUT', 86400))
+	if kind == 'null':
+		from werkzeug.contrib.cache import NullCache
+		return NullCache()
+	return LRUCache(config.get('FRAGMENT_CACHE_SIZE', 1000))
+
+fragment_cache = make_fragment_cache(app.config)
+
+def fragment_key(name, scope, version):
+	return '%s%s:%s:%s' % (app.config.get('FRAGMENT_CACHE_PREFIX', ''), name, scope, version or 0)
+
+def cached_fragment(name, scope, version, render):
+	# Fragments are keyed on the data version of the bank (or user) they show. Every DBManager write
+	# bumps that version, so a stale fragment is never looked up again and ages out of the LRU.
+	key = fragment_key(name, scope, version)
+	html = fragment_cache.get(key)
+	if html == None:
+		html = render()
+		fragment_cache.set(key, html)
+	return html
+
+def fragment_response(name, scope, version, render):
+	# The strong ETag is a hash of the cache key, so a revalidation that still matches gets a 304
+	# without touching the cache. no-cache makes the browser revalidate every time; private keeps
+	# one user's fragments out of shared proxies.
+	etag = hashlib.sha1(fragment_key(name, scope, version).encode('utf-8')).hexdigest()
+	# compress_html tags the gzipped representation etag-gzip, and browsers send that one back
+	if request.if_none_match.contains(etag) or request.if_none_match.contains(etag + '-gzip'):
+		response = app.response_class(status=304)
+	else:
+		response = make_response(cached_fragment(name, scope, version, render))
+	response.set_etag(etag)
+	response.headers['Cache-Control'] = 'private, no-cache'
+	return response
+
+### Static Assets
+# everything under static/, content-hashed and precompressed at startup (see assets.py)
+assets = AssetManifest(app.static_folder, app.static_url_path, app.config.get('ASSET_URL_PREFIX', '/assets'))
+
+def asset_url(filename):
+	# the hashed, far-future cacheable URL of a static file; plain /static/ for files added since startup
+	return assets.url(filename) or url_for('static', filename=filename)
+
+app.jinja_env.globals['asset_url'] = asset_url
+
+@app.route(app.config.get('ASSET_URL_PREFIX', '/assets') + '/<path:filename>')
+def asset(filename):
+	item = assets.lookup(filename)
+	if item == None:
+		abort(404)
+	encoding = 'identity'
+	for candidate in ('br', 'gzip'):
+		if candidate in item.bodies and request.accept_encodings[candidate] > 0:
+			encoding = candidate
+			break
+	response = app.response_class(item.bodies[encoding], mimetype=item.mimetype)
+	if encoding != 'identity':
+		response.headers['Content-Encoding'] = encoding
+	response.vary.add('Accept-Encoding')
+	response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+	response.set_etag(item.digest if encoding == 'identity' else '%s-%s' % (item.digest, encoding))
+	return response.make_conditional(request)
+
+@app.after_request
+def compress_html(response):
+	# pages and fragments of COMPRESS_MIN_BYTES or more go out gzipped to clients that accept it;
+	# streamed responses (exports) and anything already encoded are left alone
+	if response.status_code != 200 or response.mimetype != 'text/html' or response.is_streamed or response.direct_passthrough:
+		return response
+	response.vary.add('Accept-Encoding')
+	if 'Content-Encoding' in response.headers or request.accept_encodings['gzip'] <= 0:
+		return response
+	data = response.get_data()
+	if len(data) < app.config.get('COMPRESS_MIN_BYTES', 1024):
+		return response
+	response.set_data(gzipped(data, app.config.get('COMPRESS_LEVEL', 6)))
+	response.headers['Content-Encoding'] = 'gzip'
+	etag, weak = response.get_etag()
+	if etag != None:
+		response.set_etag(etag + '-gzip', weak)
+	return response
+
+### Query Budget
+class QueryBudgetExceeded(Exception):
+	pass
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def count_query(conn, cursor, statement, parameters, context, executemany):
+	if has_request_context():
+		g.query_count = getattr(g, 'query_count', 0) + 1
+
+@app.after_request
+def check_query_budget(response):
+	# QUERY_BUDGETS caps the statements each endpoint may run. Over budget is a warning in
+	# production and an error with QUERY_BUDGET_STRICT (scripts/query_budget.py), so an N+1 shows up.
+	count = getattr(g, 'query_count', 0)
+	budget = app.config.get('QUERY_BUDGETS', {}).get(request.endpoint)
+	if app.config.get('QUERY_BUDGET_STRICT'):
+		response.headers['X-Query-Count'] = str(count)
+	if budget != None and count > budget:
+		message = '%s ran %d queries, budget %d' % (request.endpoint, count, budget)
+		if app.config.get('QUERY_BUDGET_STRICT'):
+			raise QueryBudgetExceeded(message)
+		app.logger.warning(message)
+	return response
+
+### Profiler
+# PROFILE_SAMPLE_RATE of requests record their statement count, DB time, slowest statements and template
+# render time, answer them in a Server-Timing header and a JSON log line, and feed the per-endpoint
+# histograms on /admin/. Unsampled requests pay one attribute lookup per statement.
+PROFILE_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, None) # upper bounds in ms; None is the overflow
+
+class ProfileWindow:
+	# per-endpoint latency histograms and totals over the last `window` seconds, in one-minute slots
+	def __init__(self, window):
+		self.window = window
+		self.slots = deque()
+		self.lock = threading.Lock()
+
+	def add(self, endpoint, total, statements, db_time, render_time):
+		minute = int(time.time() // 60)
+		with self.lock:
+			if not self.slots or self.slots[-1][0] != minute:
+				self.slots.append((minute, {}))
+			while self.slots[0][0] <= minute - self.window // 60:
+				self.slots.popleft()
+			stats = self.slots[-1][1].setdefault(endpoint, [0, 0, 0.0, 0.0, 0.0, [0] * len(PROFILE_BUCKETS)])
+			stats[0] += 1
+			stats[1] += statements
+			stats[2] += db_time
+			stats[3] += render_time
+			stats[4] += total
+			for index, bound in enumerate(PROFILE_BUCKETS):
+				if bound == None or total <= bound:
+					stats[5][index] += 1
+					break
+
+	def clear(self):
+		with self.lock:
+			self.slots.clear()
+
+	def snapshot(self):
+		# [{'endpoint', 'count', 'statements', 'db_ms', 'render_ms', 'mean_ms', 'p50_ms', 'p90_ms', 'p99_ms', 'histogram'}]
+		# with averages per request; percentiles are bucket upper bounds
+		oldest = int(time.time() // 60) - self.window // 60
+		merged = {}
+		with self.lock:
+			for minute, endpoints in self.slots:
+				if minute <= oldest:
+					continue
+				for endpoint, stats in endpoints.items():
+					total = merged.setdefault(endpoint, [0, 0, 0.0, 0.0, 0.0, [0] * len(PROFILE_BUCKETS)])
+					for index in range(5):
+						total[index] += stats[index]
+					total[5] = [a + b for a, b in zip(total[5], stats[5])]
+		rows = []
+		for endpoint, (count, statements, db_time, render_time, total, histogram) in merged.items():
+			row = {'endpoint': endpoint, 'count': count, 'statements': float(statements) / count, 'db_ms': db_time / count,
+				'render_ms': render_time / count, 'mean_ms': total / count, 'histogram': histogram}
+			for name, fraction in (('p50_ms', 0.5), ('p90_ms', 0.9), ('p99_ms', 0.99)):
+				seen = 0
+				for bound, bucket in zip(PROFILE_BUCKETS, histogram):
+					seen += bucket
+					if seen >= fraction * count:
+						row[name] = bound
+						break
+			rows.append(row)
+		return sorted(rows, key=lambda row: -row['mean_ms'] * row['count'])
+
+profile_window = ProfileWindow(app.config.get('PROFILE_WINDOW', 900))
+
+class ProfiledTemplate(jinja2.Template):
+	# render time of sampled requests; included and extended templates are part of their parent's render
+	def render(self, *args, **kwargs):
+		profile = getattr(g, 'profile', None) if has_request_context() else None
+		if profile == None:
+			return jinja2.Template.render(self, *args, **kwargs)
+		started = time.time()
+		try:
+			return jinja2.Template.render(self, *args, **kwargs)
+		finally:
+			profile['render'] += time.time() - started
+
+app.jinja_env.template_class = ProfiledTemplate
+
+@app.before_request
+def start_profile():
+	rate = app.config.get('PROFILE_SAMPLE_RATE', 0)
+	if rate > 0 and random.random() < rate:
+		g.profile = {'started': time.time(), 'statements': 0, 'db': 0.0, 'render': 0.0, 'slowest': []}
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_statement(conn, cursor, statement, parameters, context, executemany):
+	if has_request_context() and getattr(g, 'profile', None) != None:
+		context.profile_started = time.time()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def end_statement(conn, cursor, statement, parameters, context, executemany):
+	started = getattr(context, 'profile_started', None)
+	if started == None or not has_request_context() or getattr(g, 'profile', None) == None:
+		return
+	elapsed = time.time() - started
+	profile = g.profile
+	profile['statements'] += 1
+	profile['db'] += elapsed
+	slowest = profile['slowest']
+	slowest.append((elapsed, statement))
+	if len(slowest) > app.config.get('PROFILE_SLOWEST', 3):
+		slowest.remove(min(slowest))
+
+@app.after_request
+def finish_profile(response):
+	profile = getattr(g, 'profile', None)
+	if profile == None:
+		return response
+	g.profile = None
+	total = (time.time() - profile['started']) * 1000
+	db_time = profile['db'] * 1000
+	render_time = profile['render'] * 1000
+	response.headers['Server-Timing'] = 'db;dur=%.1f;desc="%d statements", render;dur=%.1f, total;dur=%.1f' % (
+		db_time, profile['statements'], render_time, total)
+	endpoint = request.endpoint or 'unmatched'
+	profile_window.add(endpoint, total, profile['statements'], db_time, render_time)
+	app.logger.info('profile %s', json.dumps({'endpoint': endpoint, 'method': request.method, 'status': response.status_code,
+		'total_ms': round(total, 1), 'db_ms': round(db_time, 1), 'render_ms': round(render_time, 1),
+		'statements': profile['statements'], 'slowest': [{'ms': round(elapsed * 1000, 1), 'sql': statement[:200]}
+		for elapsed, statement in sorted(profile['slowest'], reverse=True)]}, sort_keys=True))
+	return response
+
+### Recurrence Rules
+def is_payday(frequency, payday, day):
+	# daily; weekly on payday (0 = Monday); biweekly on the 1st and 15th; monthly on the 1st
+	if frequency == "daily":
+		return True
+	if frequency == "weekly":
+		return day.weekday() == payday
+	if frequency == "biweekly":
+		return day.day == 1 or day.day == 15
+	if frequency == "monthly":
+		return day.day == 1
+	return False
+
+def local_date(utc_time, timezone):
+	return pytz.utc.localize(utc_time).astimezone(pytz.timezone(timezone or 'UTC')).date()
+
+def next_occurrence(frequency, payday, after, timezone=None):
+	# first local midnight strictly after `after` (naive UTC) that is a payday, as naive UTC
+	tz = pytz.timezone(timezone or 'UTC')
+	day = local_date(after, timezone)
+	for offset in range(1, 33):
+		candidate = day + timedelta(days=offset)
+		if is_payday(frequency, payday, candidate):
+			return tz.localize(datetime.combine(candidate, datetime.min.time())).astimezone(pytz.utc).replace(tzinfo=None)
+	return None
+
+### Ledger Cursors
+# the date migrations.ledger_dates gives legacy rows that had none, so they sort oldest
+LEDGER_EPOCH = datetime(1970, 1, 1)
+
+def encode_cursor(date, rowid):
+	return '%s_%d' % (date.strftime('%Y-%m-%dT%H:%M:%S.%f'), rowid)
+
+def decode_cursor(cursor):
+	# cursors come back from the client; one that doesn't parse is a bad request, not a server error
+	try:
+		date, rowid = cursor.split('_')
+		return datetime.strptime(date, '%Y-%m-%dT%H:%M:%S.%f'), int(rowid)
+	except ValueError:
+		abort(400)
+
+### Money
+def cents(value):
+	# Numeric (a float on SQLite) or None -> whole cents
+	return int((Decimal(str(value or 0)) * 100).quantize(Decimal(1)))
+
+### Rollup Periods
+# ledger_rollup keeps deposit and purchase totals per bank per UTC week (starting Monday) and month
+ROLLUP_PERIODS = ('week', 'month')
+
+def period_start(period, when):
+	day = when.date()
+	if period == 'week':
+		return day - timedelta(days=day.weekday())
+	return day.replace(day=1)
+
+def period_start_sql(column, period):
+	# the same as period_start, in SQL; literal_column keeps GROUP BY matching the select list on Postgres
+	if db.engine.dialect.name == 'sqlite':
+		if period == 'week':
+			return func.date(column, literal_column("'weekday 0'"), literal_column("'-6 days'"))
+		return func.date(column, literal_column("'start of month'"))
+	return cast(func.date_trunc(literal_column("'%s'" % period), column), db.Date)
+
 ### DB Helper Class
 class DBManager:
 
@@ -72,61 +441,538 @@ class DBManager:
 	def get_user_by_id(self, userid):
 		return User.query.get_or_404(userid)
 
+	def owned(self, model, user, item_id):
+		# a bank, or an item together with its bank, only if user owns the bank: one joined query.
+		# The owner is user, already in the session, so bank.user never goes back to the database.
+		if model is PiggyBank:
+			return PiggyBank.query.filter(PiggyBank.id == item_id).filter(PiggyBank.user_id == user.id).first()
+		return model.query.join(PiggyBank, model.bank_id == PiggyBank.id).options(contains_eager(model.piggybank)) \
+			.filter(model.id == item_id).filter(PiggyBank.user_id == user.id).first()
+
+	def touch(self, bank_id):
+		self.touch_banks([bank_id])
+		return
+
+	def touch_banks(self, bank_ids):
+		# bump the data version of these banks and their owners, so cached fragments showing them go stale;
+		# part of the caller's transaction, like the write it accompanies
+		if not bank_ids:
+			return
+		banks = PiggyBank.__table__
+		users = User.__table__
+		db.session.execute(users.update().where(users.c.id.in_(select([banks.c.user_id]).where(banks.c.id.in_(bank_ids)))) \
+			.values(data_version=func.coalesce(users.c.data_version, 0) + 1))
+		db.session.execute(banks.update().where(banks.c.id.in_(bank_ids)) \
+			.values(data_version=func.coalesce(banks.c.data_version, 0) + 1))
+		return
+
+	def touch_user(self, user):
+		users = User.__table__
+		db.session.execute(users.update().where(users.c.id == user.id) \
+			.values(data_version=func.coalesce(users.c.data_version, 0) + 1))
+		return
+
 	def create_bank(self, user, bankname):		
 		db.session.add(PiggyBank(user, bankname))
+		self.touch_user(user)
 		db.session.commit()
 		return
 
-	def delete_bank(self, bank):
-		db.session.delete(bank)
+	def delete_bank(self, bank_id):
+		# one set-based DELETE per child table and a single commit, however much history the bank has
+		try:
+			self.touch(bank_id)
+			for model in BANK_CHILD_TYPES:
+				model.query.filter(model.bank_id == bank_id).delete(synchronize_session=False)
+			PiggyBank.query.filter(PiggyBank.id == bank_id).delete(synchronize_session=False)
+			db.session.commit()
+		except:
+			db.session.rollback()
+			raise
+		return
+
+	def bank_size(self, bank):
+		return Deposit.query.filter(Deposit.bank_id == bank.id).count() + Expense.query.filter(Expense.bank_id == bank.id).count()
+
+	def detach_bank(self, bank):
+		# hide a bank from its owner and stop its schedules until the background delete gets to it
+		for model in RECURRING_TYPES.values():
+			model.query.filter(model.bank_id == bank.id).update({model.active: False}, synchronize_session=False)
+		self.touch(bank.id)
+		bank.user_id = None
 		db.session.commit()
 		return
 
 	def rename_bank(self, bank, name):
 		bank.name = name
+		self.touch(bank.id)
 		db.session.commit()
 		return
 
+	def adjust_balance(self, bank, delta):
+		# current_balance = current_balance + delta in the database, never read-modify-write in Python;
+		# returns the balance this change produced
+		banks = PiggyBank.__table__
+		update = banks.update().where(banks.c.id == bank.id).values(current_balance=banks.c.current_balance + delta)
+		if db.engine.dialect.implicit_returning:
+			return db.session.execute(update.returning(banks.c.current_balance)).scalar()
+		# no RETURNING (SQLite): the row stays write-locked by this transaction, so the read back is ours
+		db.session.execute(update)
+		return db.session.query(PiggyBank.current_balance).filter(PiggyBank.id == bank.id).scalar()
+
 	def create_deposit(self, amount, bank, description=None, date_deposited=None, source=None, source_id=None):
-		db.session.add(Deposit(amount, bank, description, date_deposited, source, source_id))
-		bank.current_balance += amount
+		balance = self.adjust_balance(bank, amount)
+		deposit = Deposit(amount, bank, description, date_deposited, source, source_id, balance)
+		db.session.add(deposit)
+		self.roll_up([(bank.id, deposit.date_deposited, 'deposit', amount, 1)])
+		self.touch(bank.id)
 		db.session.commit()
-		return
+		return deposit
 
 	def delete_deposit(self, deposit):
+		self.adjust_balance(deposit.piggybank, -deposit.amount_deposited)
+		if deposit.date_deposited != None:
+			self.roll_up([(deposit.bank_id, deposit.date_deposited, 'deposit', deposit.amount_deposited, -1)])
 		db.session.delete(deposit)
+		self.touch(deposit.bank_id)
 		db.session.commit()
 		return
 
 	def create_expense(self, name, price, bank, description=None, purchased=None, date_added=None, date_purchased=None, purchased_by=None):
-		db.session.add(Expense(name, price, bank, description, purchased, date_added, date_purchased, purchased_by))
+		expense = Expense(name, price, bank, description, purchased, date_added, date_purchased, purchased_by)
+		db.session.add(expense)
 		if purchased == True:
-			bank.current_balance -= price
+			self.adjust_balance(bank, -price)
+			self.roll_up([(bank.id, expense.date_purchased, 'purchase', price, 1)])
+		self.touch(bank.id)
 		db.session.commit()
-		return
+		return expense
 
 	def delete_expense(self, expense):
+		if expense.purchased == True:
+			self.adjust_balance(expense.piggybank, expense.price)
+			if expense.date_purchased != None:
+				self.roll_up([(expense.bank_id, expense.date_purchased, 'purchase', expense.price, -1)])
 		db.session.delete(expense)
+		self.touch(expense.bank_id)
 		db.session.commit()
 		return
 
-	def purchase_expense(self, expense):
-		expense.purchased = True
-		expense.date_purchased = datetime.utcnow()
-		expense.piggybank.current_balance -= expense.price
+	def keyset_page(self, query, date_column, id_column, cursor=None, limit=None):
+		# newest first on (date, id); the cursor is the last row of the previous page, so every
+		# page is an index range scan no matter how far back it is. The dates are never NULL
+		# (migrations.ledger_dates), which is what lets the plain column use the index.
+		if limit == None:
+			limit = app.config.get('LEDGER_PAGE_SIZE', 50)
+		if cursor != None:
+			date, rowid = decode_cursor(cursor)
+			query = query.filter(or_(date_column < date, and_(date_column == date, id_column < rowid)))
+		rows = query.order_by(desc(date_column), desc(id_column)).limit(limit + 1).all()
+		if len(rows) <= limit:
+			return rows, None
+		rows = rows[:limit]
+		return rows, encode_cursor(getattr(rows[-1], date_column.key), rows[-1].id)
+
+	def deposits_page(self, bank, cursor=None):
+		return self.keyset_page(Deposit.query.filter(Deposit.bank_id == bank.id), Deposit.date_deposited, Deposit.id, cursor)
+
+	def pending_expenses_page(self, bank, cursor=None):
+		return self.keyset_page(Expense.query.filter(Expense.bank_id == bank.id).filter(Expense.purchased == False),
+			Expense.date_added, Expense.id, cursor)
+
+	def purchased_expenses_page(self, bank, cursor=None):
+		return self.keyset_page(Expense.query.filter(Expense.bank_id == bank.id).filter(Expense.purchased == True),
+			Expense.date_purchased, Expense.id, cursor)
+
+	def set_purchased(self, expense, purchased):
+		# flips the flag only if it isn't already set, so racing clicks charge or refund once
+		expenses = Expense.__table__
+		now = datetime.utcnow()
+		# the refunded purchase comes out of the period it was counted in
+		bought = expense.date_purchased
+		flipped = db.session.execute(expenses.update().where(expenses.c.id == expense.id) \
+			.where(expenses.c.purchased == (not purchased)) \
+			.values(purchased=purchased, date_purchased=now if purchased else None)).rowcount
+		if flipped:
+			self.adjust_balance(expense.piggybank, -expense.price if purchased else expense.price)
+			if purchased:
+				self.roll_up([(expense.bank_id, now, 'purchase', expense.price, 1)])
+			elif bought != None:
+				self.roll_up([(expense.bank_id, bought, 'purchase', expense.price, -1)])
+			self.touch(expense.bank_id)
 		db.session.commit()
+		return flipped == 1
+
+	def purchase_expense(self, expense):
+		self.set_purchased(expense, True)
 		return
 
 	def refund_expense(self, expense):
-		if expense.purchased == True:
-			expense.purchased = False
-			expense.date_purchased = None
-			expense.piggybank.current_balance += expense.price
-			db.session.commit()
+		self.set_purchased(expense, False)
 		return
 
 	def create_allowance(self, amount, frequency, piggybank, description=None, payday=None, active=True):
-		db.session.add(Allowance(amount, frequency, piggybank, description, payday, active))
+		allowance = Allowance(amount, frequency, piggybank, description, payday, active)
+		allowance.next_run_at = next_occurrence(frequency, allowance.payday, datetime.utcnow(), piggybank.user.timezone)
+		db.session.add(allowance)
+		self.touch(piggybank.id)
+		db.session.commit()
+		return allowance
+
+	def due_shards(self, kind, now, shards):
+		# split the bank ids with items of this kind due by now into contiguous, inclusive ranges
+		model = RECURRING_TYPES[kind]
+		first, last = db.session.query(func.min(model.bank_id), func.max(model.bank_id)) \
+			.filter(model.active == True).filter(model.next_run_at <= now).one()
+		if first == None:
+			return []
+		width = max(1, (last - first + shards) // shards)
+		return [(lo, min(lo + width - 1, last)) for lo in range(first, last + 1, width)]
+
+	def run_due(self, kind, now=None, chunk_size=None, bank_range=None):
+		# Pays (allowances) or charges (recurring expenses) every occurrence due by now, oldest first,
+		# committing once per chunk. Items that missed several runs catch up over successive passes.
+		model = RECURRING_TYPES[kind]
+		if now == None:
+			now = datetime.utcnow()
+		if chunk_size == None:
+			chunk_size = app.config.get('SCHEDULE_CHUNK', 1000)
+		amount = Allowance.amount if kind == 'allowance' else RecurringExpense.price
+		started = time.time()
+		count = 0
+		while True:
+			query = db.session.query(model.id, amount.label('amount'), model.description, model.frequency, model.payday, \
+				model.next_run_at, model.bank_id, PiggyBank.user_id, User.username, User.timezone) \
+				.join(PiggyBank, model.bank_id == PiggyBank.id).join(User, PiggyBank.user_id == User.id) \
+				.filter(model.active == True).filter(model.next_run_at <= now)
+			if kind == 'expense':
+				query = query.add_columns(RecurringExpense.name)
+			if bank_range != None:
+				query = query.filter(model.bank_id.between(bank_range[0], bank_range[1]))
+			rows = query.order_by(model.next_run_at, model.id).limit(chunk_size).all()
+			if not rows:
+				break
+			try:
+				count += self.run_chunk(kind, rows, now)
+				db.session.commit()
+			except:
+				db.session.rollback()
+				raise
+		return count, time.time() - started
+
+	def run_chunk(self, kind, rows, now):
+		# one bulk insert, one balance update and one schedule update for the whole chunk.
+		# The unique (item, pay_date) key on deposits/expenses makes a duplicate run fail instead of double paying.
+		model = RECURRING_TYPES[kind]
+		if kind == 'allowance':
+			ledger, key = Deposit, Deposit.allowance_id
+		else:
+			ledger, key = Expense, Expense.recurring_expense_id
+		pay_dates = {}
+		for row in rows:
+			pay_dates[row.id] = local_date(row.next_run_at, row.timezone)
+		done = set(db.session.query(key, ledger.pay_date).filter(key.in_(list(pay_dates.keys()))) \
+			.filter(ledger.pay_date.in_(list(set(pay_dates.values())))))
+		due = [row for row in rows if (row.id, pay_dates[row.id]) not in done]
+
+		totals = {}
+		for row in due:
+			delta = row.amount if kind == 'allowance' else -row.amount
+			totals[row.bank_id] = totals.get(row.bank_id, 0) + delta
+		balances = self.adjust_balances(totals)
+		running = dict((bank_id, balances[bank_id] - totals[bank_id]) for bank_id in totals)
+		entries = []
+		for row in due:
+			if kind == 'allowance':
+				running[row.bank_id] += row.amount
+				entries.append({'date_deposited': now, 'amount_deposited': row.amount, 'balance': running[row.bank_id],
+					'source': row.username, 'source_id': row.user_id, 'description': row.description or "", 'bank_id': row.bank_id,
+					'allowance_id': row.id, 'pay_date': pay_dates[row.id]})
+			else:
+				entries.append({'name': row.name, 'description': row.description, 'price': row.amount, 'date_added': now,
+					'date_purchased': now, 'purchased': True, 'purchased_by': row.user_id, 'bank_id': row.bank_id,
+					'recurring_expense_id': row.id, 'pay_date': pay_dates[row.id]})
+		if entries:
+			db.session.execute(ledger.__table__.insert(), entries)
+			self.roll_up([(row.bank_id, now, 'deposit' if kind == 'allowance' else 'purchase', row.amount, 1) for row in due])
+
+		table = model.__table__
+		db.session.execute(table.update().where(table.c.id == bindparam('item_id')).values(next_run_at=bindparam('run_at')),
+			[{'item_id': row.id, 'run_at': next_occurrence(row.frequency, row.payday, row.next_run_at, row.timezone)} for row in rows])
+		return len(due)
+
+	def adjust_balances(self, totals):
+		# apply {bank_id: delta} in one executemany and return the resulting balances
+		if not totals:
+			return {}
+		banks = PiggyBank.__table__
+		db.session.execute(banks.update().where(banks.c.id == bindparam('bank')) \
+			.values(current_balance=banks.c.current_balance + bindparam('delta')),
+			[{'bank': bank_id, 'delta': delta} for bank_id, delta in totals.items()])
+		self.touch_banks(list(totals.keys()))
+		return dict(db.session.query(PiggyBank.id, PiggyBank.current_balance).filter(PiggyBank.id.in_(list(totals.keys()))))
+
+	def roll_up(self, entries):
+		# Folds [(bank_id, when, 'deposit' or 'purchase', amount, +1 or -1)] into the weekly and monthly
+		# ledger_rollup rows: one read for the keys that exist, then an executemany update and insert.
+		# `when` must not be None; callers skip undated rows.
+		totals = {}
+		for bank_id, when, kind, amount, sign in entries:
+			for period in ROLLUP_PERIODS:
+				row = totals.setdefault((bank_id, period, period_start(period, when)), [0, 0, Decimal(0), Decimal(0)])
+				if kind == 'deposit':
+					row[0] += sign
+					row[2] += sign * Decimal(amount)
+				else:
+					row[1] += sign
+					row[3] += sign * Decimal(amount)
+		if not totals:
+			return
+		existing = set(db.session.query(LedgerRollup.bank_id, LedgerRollup.period, LedgerRollup.period_start) \
+			.filter(LedgerRollup.bank_id.in_(list(set(key[0] for key in totals)))) \
+			.filter(LedgerRollup.period_start.in_(list(set(key[2] for key in totals)))))
+		changes = [{'bank': bank_id, 'kind': period, 'start': start, 'add_deposits': row[0], 'add_purchases': row[1],
+			'add_deposited': row[2], 'add_spent': row[3]} for (bank_id, period, start), row in totals.items()]
+		table = LedgerRollup.__table__
+		update = table.update().where(table.c.bank_id == bindparam('bank')).where(table.c.period == bindparam('kind')) \
+			.where(table.c.period_start == bindparam('start')).values(deposits=table.c.deposits + bindparam('add_deposits'),
+			purchases=table.c.purchases + bindparam('add_purchases'), deposited=table.c.deposited + bindparam('add_deposited'),
+			spent=table.c.spent + bindparam('add_spent'))
+		updates = [change for change in changes if (change['bank'], change['kind'], change['start']) in existing]
+		if updates:
+			db.session.execute(update, updates)
+		inserts = [change for change in changes if (change['bank'], change['kind'], change['start']) not in existing]
+		if not inserts:
+			return
+		if db.engine.dialect.name == 'sqlite':
+			# SQLite lets one writer at a time past the read above, and pysqlite mishandles SAVEPOINT
+			db.session.execute(table.insert(), [self.rollup_row(change) for change in inserts])
+			return
+		try:
+			with db.session.begin_nested():
+				db.session.execute(table.insert(), [self.rollup_row(change) for change in inserts])
+		except IntegrityError:
+			# a concurrent first write to one of these periods inserted it since the read: add to the
+			# rows one at a time, inserting only where the update finds nothing
+			for change in inserts:
+				while not db.session.execute(update, change).rowcount:
+					try:
+						with db.session.begin_nested():
+							db.session.execute(table.insert(), self.rollup_row(change))
+						break
+					except IntegrityError:
+						pass
+		return
+
+	def rollup_row(self, change):
+		return {'bank_id': change['bank'], 'period': change['kind'], 'period_start': change['start'], 'deposits': change['add_deposits'],
+			'purchases': change['add_purchases'], 'deposited': change['add_deposited'], 'spent': change['add_spent']}
+
+	def backfill_rollups(self, chunk_size=None, first=None, last=None):
+		# Rebuilds ledger_rollup from the ledger, ROLLUP_BACKFILL_CHUNK banks per transaction. Each chunk deletes its
+		# rollups and regroups its deposits and purchases with one INSERT ... SELECT per period, so no ledger
+		# row passes through Python. first/last limit it to a bank-id range. Returns the number of banks.
+		if chunk_size == None:
+			chunk_size = app.config.get('ROLLUP_BACKFILL_CHUNK', 500)
+		table = LedgerRollup.__table__
+		count = 0
+		after = first - 1 if first != None else 0
+		while True:
+			query = db.session.query(PiggyBank.id).filter(PiggyBank.id > after)
+			if last != None:
+				query = query.filter(PiggyBank.id <= last)
+			bank_ids = [row[0] for row in query.order_by(PiggyBank.id).limit(chunk_size)]
+			if not bank_ids:
+				break
+			events = union_all(
+				select([Deposit.bank_id.label('bank_id'), Deposit.date_deposited.label('date'), literal_column('1').label('deposits'),
+					literal_column('0').label('purchases'), Deposit.amount_deposited.label('deposited'), literal_column('0').label('spent')]) \
+					.where(Deposit.bank_id.in_(bank_ids)),
+				select([Expense.bank_id, Expense.date_purchased, literal_column('0'), literal_column('1'), literal_column('0'), Expense.price]) \
+					.where(Expense.bank_id.in_(bank_ids)).where(Expense.purchased == True).where(Expense.date_purchased != None)).alias('events')
+			try:
+				LedgerRollup.query.filter(LedgerRollup.bank_id.in_(bank_ids)).delete(synchronize_session=False)
+				for period in ROLLUP_PERIODS:
+					start = period_start_sql(events.c.date, period)
+					db.session.execute(table.insert().from_select(['bank_id', 'period', 'period_start', 'deposits', 'purchases',
+						'deposited', 'spent'], select([events.c.bank_id, literal_column("'%s'" % period), start, func.sum(events.c.deposits),
+						func.sum(events.c.purchases), func.sum(events.c.deposited), func.sum(events.c.spent)]) \
+						.group_by(events.c.bank_id, start)))
+				db.session.commit()
+			except:
+				db.session.rollback()
+				raise
+			count += len(bank_ids)
+			after = bank_ids[-1]
+		return count
+
+	def rollups(self, bank_ids, period, count):
+		# the last `count` periods of deposits and purchases summed over these banks, newest first:
+		# [(period_start, deposits, purchases, deposited, spent)]. Reads rollup rows only.
+		since = period_start(period, datetime.utcnow())
+		for i in range(count - 1):
+			since = period_start(period, datetime.combine(since, datetime.min.time()) - timedelta(days=1))
+		if not bank_ids:
+			return []
+		return db.session.query(LedgerRollup.period_start, func.sum(LedgerRollup.deposits), func.sum(LedgerRollup.purchases),
+			func.sum(LedgerRollup.deposited), func.sum(LedgerRollup.spent)).filter(LedgerRollup.bank_id.in_(bank_ids)) \
+			.filter(LedgerRollup.period == period).filter(LedgerRollup.period_start >= since) \
+			.group_by(LedgerRollup.period_start).order_by(desc(LedgerRollup.period_start)).all()
+
+	def forecasts(self, banks, horizon, goal=None):
+		# {bank id: forecast} for these PiggyBank rows over `horizon` days from today (UTC), cached per bank under
+		# its data version, the day and the arguments. Banks missing from the cache are projected together
+		# (see forecast.py) from three queries: pending expenses, active allowances and active recurring
+		# expenses, the last going in as negative allowances.
+		import forecast
+		today = datetime.utcnow().date()
+		keys = dict((bank.id, fragment_key('forecast', bank.id, '%s:%s:%d:%s' % (bank.data_version or 0, today, horizon, goal)))
+			for bank in banks)
+		results = {}
+		missing = []
+		for bank in banks:
+			cached = fragment_cache.get(keys[bank.id])
+			if cached == None:
+				missing.append(bank)
+			else:
+				results[bank.id] = cached
+		if not missing:
+			return results
+		bank_ids = [bank.id for bank in missing]
+		pending = dict(db.session.query(Expense.bank_id, func.sum(Expense.price)).filter(Expense.bank_id.in_(bank_ids)) \
+			.filter(Expense.purchased == False).group_by(Expense.bank_id))
+		allowances = []
+		for kind, model in sorted(RECURRING_TYPES.items()):
+			amount, sign = (Allowance.amount, 1) if kind == 'allowance' else (RecurringExpense.price, -1)
+			allowances.extend((row.bank_id, sign * cents(row.amount), row.frequency, row.payday,
+				local_date(row.next_run_at, row.timezone) if row.next_run_at != None else None)
+				for row in db.session.query(model.bank_id, amount.label('amount'), model.frequency, model.payday, model.next_run_at,
+				User.timezone).join(PiggyBank, model.bank_id == PiggyBank.id).join(User, PiggyBank.user_id == User.id) \
+				.filter(model.bank_id.in_(bank_ids)).filter(model.active == True))
+		openings = dict((bank.id, cents(bank.current_balance) - cents(pending.get(bank.id))) for bank in missing)
+		goals = dict((bank_id, cents(goal)) for bank_id in bank_ids) if goal != None else None
+		order, days, curves, reached = forecast.project(openings, allowances, today, horizon, goals)
+		by_id = dict((bank.id, bank) for bank in missing)
+		for index, bank_id in enumerate(order):
+			bank = by_id[bank_id]
+			result = {'bank': bank_id, 'balance': money(bank.current_balance or 0), 'pending': money(Decimal(str(pending.get(bank_id) or 0))),
+				'goal': money(goal) if goal != None else None, 'start': day(today),
+				'goal_date': str(days[reached[index]]) if reached[index] >= 0 else None,
+				'curve': ['%.2f' % (value / 100.0) for value in curves[index].tolist()]}
+			fragment_cache.set(keys[bank_id], result)
+			results[bank_id] = result
+		return results
+
+	def reconcile(self, chunk_size=None, full=False):
+		# Rebuilds current_balance (deposits minus purchased expenses) and the running Deposit.balance of every
+		# bank whose data_version moved since its last pass (of all banks with full=True), RECONCILE_CHUNK banks
+		# per transaction: three reads per chunk, and executemany repairs only where something drifted.
+		# reconciled_version is the checkpoint. Returns (banks checked, balances repaired, deposits repaired).
+		if chunk_size == None:
+			chunk_size = app.config.get('RECONCILE_CHUNK', 500)
+		version = func.coalesce(PiggyBank.data_version, 0)
+		checked = banks_fixed = deposits_fixed = 0
+		after = 0
+		while True:
+			query = db.session.query(PiggyBank.id, version).filter(PiggyBank.id > after)
+			if not full:
+				query = query.filter(or_(PiggyBank.reconciled_version == None, PiggyBank.reconciled_version != version))
+			banks = query.order_by(PiggyBank.id).limit(chunk_size).all()
+			if not banks:
+				break
+			bank_ids = [bank[0] for bank in banks]
+			try:
+				drift = self.balance_drift(bank_ids)
+				deposits = self.deposit_drift(bank_ids)
+				repaired = set(drift)
+				if deposits:
+					# compare-and-set, so a balance written since the read is left alone
+					table = Deposit.__table__
+					db.session.execute(table.update().where(table.c.id == bindparam('deposit')) \
+						.where(or_(table.c.balance == bindparam('observed'), table.c.balance == None)).values(balance=bindparam('running')),
+						[{'deposit': rowid, 'observed': observed, 'running': running} for rowid, bank_id, observed, running in deposits])
+					self.touch_banks(list(set(bank_id for rowid, bank_id, observed, running in deposits) - repaired))
+					repaired.update(bank_id for rowid, bank_id, observed, running in deposits)
+				# a delta rather than the recomputed total, so writes racing the pass are kept
+				self.adjust_balances(drift)
+				# The checkpoint is the version this pass leaves behind: one bump for a repaired bank. It is only
+				# taken if data_version still matches, so a bank written since the read is checked again next pass.
+				table = PiggyBank.__table__
+				db.session.execute(table.update().where(table.c.id == bindparam('bank')) \
+					.where(func.coalesce(table.c.data_version, 0) == bindparam('seen')).values(reconciled_version=bindparam('seen')),
+					[{'bank': bank_id, 'seen': seen + 1 if bank_id in repaired else seen} for bank_id, seen in banks])
+				db.session.commit()
+			except:
+				db.session.rollback()
+				raise
+			checked += len(bank_ids)
+			banks_fixed += len(drift)
+			deposits_fixed += len(deposits)
+			after = bank_ids[-1]
+		return checked, banks_fixed, deposits_fixed
+
+	def balance_drift(self, bank_ids):
+		# {bank_id: expected - current_balance} for the banks whose balance is off, from one grouped query
+		deposited = db.session.query(Deposit.bank_id.label('bank_id'), func.sum(Deposit.amount_deposited).label('total')) \
+			.filter(Deposit.bank_id.in_(bank_ids)).group_by(Deposit.bank_id).subquery()
+		spent = db.session.query(Expense.bank_id.label('bank_id'), func.sum(Expense.price).label('total')) \
+			.filter(Expense.bank_id.in_(bank_ids)).filter(Expense.purchased == True).group_by(Expense.bank_id).subquery()
+		cent = Decimal('0.01')
+		drift = {}
+		for bank_id, balance, total_in, total_out in db.session.query(PiggyBank.id, PiggyBank.current_balance, deposited.c.total,
+			spent.c.total).outerjoin(deposited, deposited.c.bank_id == PiggyBank.id).outerjoin(spent, spent.c.bank_id == PiggyBank.id) \
+			.filter(PiggyBank.id.in_(bank_ids)):
+			# compared in Decimal, since SQLite sums Numeric columns as floats
+			delta = (Decimal(str(total_in or 0)) - Decimal(str(total_out or 0))).quantize(cent) - Decimal(str(balance or 0)).quantize(cent)
+			if delta != 0:
+				drift[bank_id] = delta
+		return drift
+
+	def deposit_drift(self, bank_ids):
+		# [(deposit id, bank id, stored balance, running balance)] for deposits whose stored balance is off. The running balance
+		# is a window SUM over the bank's deposits and purchases in date order (purchases first on a tie).
+		events = union_all(
+			select([Deposit.bank_id.label('bank_id'), Deposit.date_deposited.label('date'), literal_column('1').label('kind'),
+				Deposit.id.label('id'), Deposit.amount_deposited.label('delta')]).where(Deposit.bank_id.in_(bank_ids)),
+			select([Expense.bank_id, func.coalesce(Expense.date_purchased, Expense.date_added), literal_column('0'), Expense.id,
+				-Expense.price]).where(Expense.bank_id.in_(bank_ids)).where(Expense.purchased == True)).alias('events')
+		running = select([events.c.id, events.c.kind, func.sum(events.c.delta).over(partition_by=events.c.bank_id,
+			order_by=[events.c.date, events.c.kind, events.c.id]).label('balance')]).alias('running')
+		rows = db.session.query(Deposit.id, Deposit.bank_id, Deposit.balance, running.c.balance) \
+			.join(running, and_(running.c.id == Deposit.id, running.c.kind == 1)) \
+			.filter(or_(Deposit.balance == None, func.abs(Deposit.balance - running.c.balance) >= Decimal('0.005'))).all()
+		return [(rowid, bank_id, observed, Decimal(str(balance)).quantize(Decimal('0.01'))) for rowid, bank_id, observed, balance in rows]
+
+	def schedule_unscheduled(self):
+		# give active items created before next_run_at existed (or re-enabled) their first run time
+		now = datetime.utcnow()
+		for model in RECURRING_TYPES.values():
+			rows = db.session.query(model.id, model.frequency, model.payday, User.timezone) \
+				.join(PiggyBank, model.bank_id == PiggyBank.id).join(User, PiggyBank.user_id == User.id) \
+				.filter(model.active == True).filter(model.next_run_at == None).all()
+			if rows:
+				table = model.__table__
+				db.session.execute(table.update().where(table.c.id == bindparam('item_id')).values(next_run_at=bindparam('run_at')),
+					[{'item_id': row.id, 'run_at': next_occurrence(row.frequency, row.payday, now, row.timezone)} for row in rows])
+		db.session.commit()
+		return
+
+	def set_timezone(self, user, timezone):
+		# paydays are local midnights, so every active item in the user's banks gets a new next run;
+		# re-enabled items get theirs when they are toggled back on
+		pytz.timezone(timezone) # raises UnknownTimeZoneError
+		user.timezone = timezone
+		now = datetime.utcnow()
+		bank_ids = [row[0] for row in db.session.query(PiggyBank.id).filter(PiggyBank.user_id == user.id)]
+		if bank_ids:
+			for model in RECURRING_TYPES.values():
+				rows = db.session.query(model.id, model.frequency, model.payday).filter(model.bank_id.in_(bank_ids)) \
+					.filter(model.active == True).all()
+				if rows:
+					table = model.__table__
+					db.session.execute(table.update().where(table.c.id == bindparam('item_id')).values(next_run_at=bindparam('run_at')),
+						[{'item_id': row.id, 'run_at': next_occurrence(row.frequency, row.payday, now, timezone)} for row in rows])
+		self.touch_banks(bank_ids)
 		db.session.commit()
 		return
 
@@ -135,19 +981,346 @@ class DBManager:
 			allowance.active = False
 		else:
 			allowance.active = True
+			# paused time is not caught up
+			allowance.next_run_at = next_occurrence(allowance.frequency, allowance.payday, datetime.utcnow(), allowance.piggybank.user.timezone)
+		self.touch(allowance.bank_id)
 		db.session.commit()
 		return
 
 
 	def change_allowance(self, allowance, amount, frequency, payday=None):
+		# keeps the current payday unless given one; weekly allowances need it to be scheduled at all
+		if payday == None:
+			payday = allowance.payday if allowance.payday != None else 0
 		allowance.amount = amount
 		allowance.frequency = frequency
 		allowance.payday = payday
+		allowance.next_run_at = next_occurrence(frequency, payday, datetime.utcnow(), allowance.piggybank.user.timezone)
+		self.touch(allowance.bank_id)
 		db.session.commit()
 		return
 
 	def delete_allowance(self, allowance):
 		db.session.delete(allowance)
+		self.touch(allowance.bank_id)
+		db.session.commit()
+		return
+
+	def create_recurring_expense(self, name, price, frequency, piggybank, description=None, payday=None, active=True):
+		expense = RecurringExpense(name, price, frequency, piggybank, description, payday, active)
+		expense.next_run_at = next_occurrence(frequency, expense.payday, datetime.utcnow(), piggybank.user.timezone)
+		db.session.add(expense)
+		self.touch(piggybank.id)
+		db.session.commit()
+		return expense
+
+	def toggle_recurring_expense(self, expense):
+		expense.active = not expense.active
+		if expense.active:
+			expense.next_run_at = next_occurrence(expense.frequency, expense.payday, datetime.utcnow(), expense.piggybank.user.timezone)
+		self.touch(expense.bank_id)
+		db.session.commit()
+		return
+
+	def delete_recurring_expense(self, expense):
+		db.session.delete(expense)
+		self.touch(expense.bank_id)
+		db.session.commit()
+		return
+
+	def import_rows(self, bank_id, user, rows, progress=None, chunk_size=None):
+		# Bulk-inserts parsed ledger rows (see ledgerio), one transaction per chunk: an executemany
+		# insert per table and a single balance update, the chunk's deposits getting running balances
+		# from it. progress(imported) runs inside each chunk's transaction, before its commit.
+		if chunk_size == None:
+			chunk_size = app.config.get('IMPORT_CHUNK', 1000)
+		count = 0
+		for chunk in ledgerio.batches(rows, chunk_size):
+			try:
+				delta = sum(row['amount'] if row['kind'] == 'deposit' else -row['amount'] for row in chunk)
+				running = self.adjust_balances({bank_id: delta})[bank_id] - delta
+				deposits = []
+				expenses = []
+				for row in chunk:
+					if row['kind'] == 'deposit':
+						running += row['amount']
+						deposits.append({'date_deposited': row['date'], 'amount_deposited': row['amount'], 'balance': running,
+							'source': user.username, 'source_id': user.id, 'description': row['description'], 'bank_id': bank_id})
+					else:
+						running -= row['amount']
+						expenses.append({'name': row['name'], 'description': row['description'], 'price': row['amount'],
+							'date_added': row['date'], 'date_purchased': row['date'], 'purchased': True, 'purchased_by': user.id,
+							'bank_id': bank_id})
+				if deposits:
+					db.session.execute(Deposit.__table__.insert(), deposits)
+				if expenses:
+					db.session.execute(Expense.__table__.insert(), expenses)
+				self.roll_up([(bank_id, row['date'], 'deposit' if row['kind'] == 'deposit' else 'purchase', row['amount'], 1)
+					for row in chunk])
+				count += len(chunk)
+				if progress:
+					progress(count)
+				db.session.commit()
+			except:
+				db.session.rollback()
+				raise
+		return count
+
+	def create_import(self, bank, user, format, filename, stream):
+		# stage an upload in the database, a piece at a time, for run_import on whichever dyno picks it up
+		ledger_import = LedgerImport(bank, user, format, filename)
+		db.session.add(ledger_import)
+		db.session.flush()
+		chunks = LedgerImportChunk.__table__
+		for seq, data in enumerate(ledgerio.read_chunks(stream)):
+			db.session.execute(chunks.insert().values(import_id=ledger_import.id, seq=seq, data=data, bank_id=bank.id))
+			ledger_import.size += len(data)
+		db.session.commit()
+		return ledger_import
+
+	def import_data(self, import_id):
+		# the staged upload, one piece in memory at a time
+		seq = 0
+		while True:
+			data = db.session.query(LedgerImportChunk.data).filter(LedgerImportChunk.import_id == import_id) \
+				.filter(LedgerImportChunk.seq == seq).scalar()
+			if data == None:
+				return
+			yield bytes(data)
+			seq += 1
+
+	def run_import(self, import_id):
+		ledger_import = LedgerImport.query.get(import_id)
+		if ledger_import == None or ledger_import.status != 'pending':
+			return ledger_import
+		ledger_import.status = 'running'
+		db.session.commit()
+		imports = LedgerImport.__table__
+		def progress(count):
+			db.session.execute(imports.update().where(imports.c.id == import_id).values(rows_imported=count))
+		rejects = ledgerio.Rejects()
+		user = User.query.get(ledger_import.user_id)
+		try:
+			self.import_rows(ledger_import.bank_id, user,
+				ledgerio.read_ledger(self.import_data(import_id), ledger_import.format, rejects), progress)
+			status = 'done'
+		except ledgerio.LedgerFormatError as exc:
+			# chunks committed before the error stay imported; rows_imported says how many
+			rejects.add(str(exc))
+			status = 'failed'
+		except Exception:
+			app.logger.exception("run_import: import %d failed", import_id)
+			rejects.add("The import stopped on a server error.")
+			status = 'failed'
+		LedgerImportChunk.query.filter(LedgerImportChunk.import_id == import_id).delete(synchronize_session=False)
+		db.session.execute(imports.update().where(imports.c.id == import_id).values(status=status,
+			rows_skipped=rejects.count, errors=json.dumps(rejects.messages), finished_at=datetime.utcnow()))
+		db.session.commit()
+		db.session.refresh(ledger_import)
+		return ledger_import
+
+	def family_bank_ids(self, user):
+		# the user's banks and their children's
+		return [row[0] for row in db.session.query(PiggyBank.id).join(User, PiggyBank.user_id == User.id) \
+			.filter(or_(User.id == user.id, User.parent_id == user.id)).order_by(PiggyBank.id)]
+
+	def ledger_rows(self, bank_ids, batch=None):
+		# Deposits and purchased expenses of these banks as (date, type, amount, name, description, bank),
+		# oldest first. Two column-only queries read through server-side cursors (yield_per; psycopg2
+		# streams them) and are merged on the fly, so memory stays flat however long the history.
+		if batch == None:
+			batch = app.config.get('EXPORT_BATCH', 1000)
+		if not bank_ids:
+			return iter([])
+		# Both sort on a date that is never NULL, the same value the merge compares: Postgres sorts NULL last and
+		# SQLite first, and Python 3 can't compare None with a datetime. A row ledger_dates hasn't backfilled
+		# yet sorts as LEDGER_EPOCH, the date it will get.
+		deposited = func.coalesce(Deposit.date_deposited, LEDGER_EPOCH)
+		deposits = db.session.query(deposited, Deposit.id, Deposit.amount_deposited, Deposit.source,
+			Deposit.description, PiggyBank.name).join(PiggyBank, Deposit.bank_id == PiggyBank.id) \
+			.filter(Deposit.bank_id.in_(bank_ids)).order_by(deposited, Deposit.id).yield_per(batch)
+		purchased = func.coalesce(Expense.date_purchased, Expense.date_added, LEDGER_EPOCH)
+		expenses = db.session.query(purchased, Expense.id, Expense.price, Expense.name, Expense.description,
+			PiggyBank.name).join(PiggyBank, Expense.bank_id == PiggyBank.id) \
+			.filter(Expense.bank_id.in_(bank_ids)).filter(Expense.purchased == True).order_by(purchased, Expense.id).yield_per(batch)
+		# (date, type, id) sorts the merge without ever comparing the nullable columns
+		merged = heapq.merge(((row[0], 'deposit') + tuple(row[1:]) for row in deposits),
+			((row[0], 'expense') + tuple(row[1:]) for row in expenses))
+		return ((date, kind, amount, name, description, bank) for date, kind, rowid, amount, name, description, bank in merged)
+
+	def users_page(self, search=None, after=None, limit=None):
+		# admin user list by id, `limit` at a time after the id `after`, optionally only usernames or emails
+		# containing `search`; parents are joined and children loaded in one more query. Returns (users, next id or None).
+		if limit == None:
+			limit = app.config.get('ADMIN_PAGE_SIZE', 50)
+		query = User.query.options(joinedload(User.parent), subqueryload(User.children))
+		if search:
+			pattern = '%' + search.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+			query = query.filter(or_(User.username.ilike(pattern, escape='\\'), User.email.ilike(pattern, escape='\\')))
+		if after != None:
+			query = query.filter(User.id > after)
+		users = query.order_by(User.id).limit(limit + 1).all()
+		if len(users) <= limit:
+			return users, None
+		return users[:limit], users[limit - 1].id
+
+	def user_stats(self, user_ids):
+		# {user id: {'banks', 'balance', 'transactions', 'last_activity'}} from three grouped queries
+		stats = dict((user_id, {'banks': 0, 'balance': Decimal(0), 'transactions': 0, 'last_activity': None}) for user_id in user_ids)
+		if not user_ids:
+			return stats
+		for user_id, banks, balance in db.session.query(PiggyBank.user_id, func.count(PiggyBank.id), \
+			func.sum(PiggyBank.current_balance)).filter(PiggyBank.user_id.in_(user_ids)).group_by(PiggyBank.user_id):
+			stats[user_id]['banks'] = banks
+			stats[user_id]['balance'] = balance or Decimal(0)
+		for model, date in ((Deposit, Deposit.date_deposited), (Expense, func.coalesce(Expense.date_purchased, Expense.date_added))):
+			for user_id, count, last in db.session.query(PiggyBank.user_id, func.count(model.id), func.max(date)) \
+				.join(model, model.bank_id == PiggyBank.id).filter(PiggyBank.user_id.in_(user_ids)).group_by(PiggyBank.user_id):
+				stats[user_id]['transactions'] += count
+				if last != None and (stats[user_id]['last_activity'] == None or last > stats[user_id]['last_activity']):
+					stats[user_id]['last_activity'] = last
+		return stats
+
+	def system_totals(self):
+		# site-wide counts in one statement of scalar subqueries
+		row = db.session.query(db.session.query(func.count(User.id)).as_scalar().label('users'),
+			db.session.query(func.count(PiggyBank.id)).as_scalar().label('banks'),
+			db.session.query(func.coalesce(func.sum(PiggyBank.current_balance), 0)).as_scalar().label('balance'),
+			db.session.query(func.count(Deposit.id)).as_scalar().label('deposits'),
+			db.session.query(func.count(Expense.id)).as_scalar().label('expenses')).one()
+		return {'users': row.users, 'banks': row.banks, 'balance': str(row.balance), 'deposits': row.deposits,
+			'expenses': row.expenses}
+
+	def statement_shards(self, shards):
+		# contiguous, inclusive user-id ranges covering every parent who gets a statement
+		first, last = db.session.query(func.min(User.id), func.max(User.id)).filter(User.role == 'parent') \
+			.filter(User.active == True).filter(User.email != None).one()
+		if first == None:
+			return []
+		width = max(1, (last - first + shards) // shards)
+		return [(lo, min(lo + width - 1, last)) for lo in range(first, last + 1, width)]
+
+	def statement_batch(self, after, last, start, end, limit=None):
+		# Weekly statements for up to `limit` parents with ids in (after, last]: every bank of the family with
+		# its deposits and purchases between start and end, from four grouped queries whatever the batch size.
+		# Returns [(parent row, [{'name', 'owner', 'balance', 'deposits', 'deposited', 'purchases', 'spent', 'change'}])].
+		if limit == None:
+			limit = app.config.get('STATEMENT_BATCH', 200)
+		parents = db.session.query(User.id, User.username, User.email).filter(User.role == 'parent') \
+			.filter(User.active == True).filter(User.email != None).filter(User.id > after).filter(User.id <= last) \
+			.order_by(User.id).limit(limit).all()
+		if not parents:
+			return []
+		parent_ids = [parent.id for parent in parents]
+		banks = db.session.query(PiggyBank.id, PiggyBank.name, PiggyBank.current_balance, User.username,
+			func.coalesce(User.parent_id, User.id).label('family')).join(User, PiggyBank.user_id == User.id) \
+			.filter(or_(User.id.in_(parent_ids), User.parent_id.in_(parent_ids))).order_by(PiggyBank.id).all()
+		bank_ids = [bank.id for bank in banks]
+		deposits = {}
+		purchases = {}
+		if bank_ids:
+			deposits = dict((row[0], row[1:]) for row in db.session.query(Deposit.bank_id, func.count(Deposit.id),
+				func.sum(Deposit.amount_deposited)).filter(Deposit.bank_id.in_(bank_ids)).filter(Deposit.date_deposited >= start) \
+				.filter(Deposit.date_deposited < end).group_by(Deposit.bank_id))
+			purchases = dict((row[0], row[1:]) for row in db.session.query(Expense.bank_id, func.count(Expense.id),
+				func.sum(Expense.price)).filter(Expense.bank_id.in_(bank_ids)).filter(Expense.purchased == True) \
+				.filter(Expense.date_purchased >= start).filter(Expense.date_purchased < end).group_by(Expense.bank_id))
+		families = dict((parent_id, []) for parent_id in parent_ids)
+		for bank in banks:
+			count, deposited = deposits.get(bank.id, (0, None))
+			bought, spent = purchases.get(bank.id, (0, None))
+			deposited = deposited or Decimal(0)
+			spent = spent or Decimal(0)
+			families[bank.family].append({'name': bank.name, 'owner': bank.username, 'balance': bank.current_balance,
+				'deposits': count, 'deposited': deposited, 'purchases': bought, 'spent': spent, 'change': deposited - spent})
+		return [(parent, families[parent.id]) for parent in parents]
+
+	def generate_test_data(self, users, banks, rows, allowances=1, seed=0, password='testpass'):
+		# Seeded bulk load for benchmarks: `users` parents named test<seed>_<n>, each with `banks` banks of
+		# `rows` deposits and `rows` expenses (a quarter still pending) over the past year, plus `allowances`
+		# weekly allowances, most of them due. executemany inserts, one commit per user, then a rollup backfill
+		# over the new banks; returns the user ids.
+		rng = random.Random(seed)
+		now = datetime.utcnow()
+		pwhash = generate_password_hash(password)
+		user_ids = []
+		bank_ids = []
+		for n in range(users):
+			username = 'test%d_%d' % (seed, n)
+			user_id = db.session.execute(User.__table__.insert().values(username=username, password=pwhash,
+				email=username + '@example.com', role='parent', active=True, session_version=0, data_version=0,
+				timezone='UTC')).inserted_primary_key[0]
+			user_ids.append(user_id)
+			for b in range(banks):
+				bank_id = db.session.execute(PiggyBank.__table__.insert().values(name='Bank %d' % b, current_balance=0,
+					data_version=0, user_id=user_id)).inserted_primary_key[0]
+				bank_ids.append(bank_id)
+				# purchases before deposits on the same minute, as reconcile orders them
+				events = sorted([(now - timedelta(minutes=rng.randint(0, 525600)), kind) for kind in ('deposit', 'expense')
+					for i in range(rows)], key=lambda event: (event[0], event[1] == 'deposit'))
+				balance = Decimal(0)
+				deposits = []
+				expenses = []
+				for date, kind in events:
+					if kind == 'deposit':
+						amount = Decimal(rng.randint(100, 2000)) / 100
+						balance += amount
+						deposits.append({'date_deposited': date, 'amount_deposited': amount, 'balance': balance, 'source': username,
+							'source_id': user_id, 'description': 'Deposit %d' % len(deposits), 'bank_id': bank_id})
+					else:
+						price = Decimal(rng.randint(50, 1500)) / 100
+						purchased = rng.random() < 0.75
+						if purchased:
+							balance -= price
+						expenses.append({'name': 'Item %d' % len(expenses), 'description': '', 'price': price, 'date_added': date,
+							'date_purchased': date if purchased else None, 'purchased': purchased,
+							'purchased_by': user_id if purchased else None, 'bank_id': bank_id})
+				if deposits:
+					db.session.execute(Deposit.__table__.insert(), deposits)
+				if expenses:
+					db.session.execute(Expense.__table__.insert(), expenses)
+				if allowances:
+					paydays = [rng.randint(0, 6) for i in range(allowances)]
+					db.session.execute(Allowance.__table__.insert(), [{'amount': Decimal(rng.randint(1, 20)), 'frequency': 'weekly',
+						'payday': payday, 'active': True, 'description': 'Allowance', 'bank_id': bank_id,
+						'next_run_at': next_occurrence('weekly', payday, now - timedelta(days=7))} for payday in paydays])
+				banks_table = PiggyBank.__table__
+				db.session.execute(banks_table.update().where(banks_table.c.id == bank_id).values(current_balance=balance))
+			db.session.commit()
+		if bank_ids:
+			self.backfill_rollups(first=bank_ids[0], last=bank_ids[-1])
+		return user_ids
+
+	def acquire_lock(self, name, owner, ttl):
+		# take or renew a lease; succeeds only if the lock is free, expired, or already ours
+		now = datetime.utcnow()
+		locks = BeatLock.__table__
+		renewed = db.session.execute(locks.update().where(locks.c.name == name) \
+			.where(or_(locks.c.owner == owner, locks.c.expires_at < now)) \
+			.values(owner=owner, expires_at=now + timedelta(seconds=ttl)))
+		if renewed.rowcount == 0:
+			try:
+				db.session.execute(locks.insert().values(name=name, owner=owner, expires_at=now + timedelta(seconds=ttl)))
+			except IntegrityError:
+				db.session.rollback()
+				return False
+		db.session.commit()
+		return True
+
+	def release_lock(self, name, owner):
+		locks = BeatLock.__table__
+		db.session.execute(locks.update().where(locks.c.name == name).where(locks.c.owner == owner) \
+			.values(expires_at=datetime.utcnow()))
+		db.session.commit()
+		return
+
+	def save_beat_entry(self, name, last_run_at, total_run_count):
+		entry = BeatEntry.query.get(name)
+		if entry == None:
+			entry = BeatEntry(name)
+			db.session.add(entry)
+		entry.last_run_at = last_run_at
+		entry.total_run_count = total_run_count
 		db.session.commit()
 		return
 
@@ -162,8 +1335,11 @@ class User(db.Model):
 	email = db.Column(db.String(120), unique=True)
 	active = db.Column(db.Boolean, default=False)
 	role = db.Column(db.String(80))
+	session_version = db.Column(db.Integer, default=0) # bump to revoke all session tokens
+	timezone = db.Column(db.String(40), default='UTC') # pytz name; allowances are paid at local midnight
+	data_version = db.Column(db.Integer, default=0) # bumped by DBManager writes to any of the user's banks
 	
-	parent_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+	parent_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
 	parent = db.relationship('User', backref='children', remote_side=[id])
 
 
@@ -173,6 +1349,8 @@ class User(db.Model):
 		self.email = email
 		self.active = True
 		self.role = role
+		self.session_version = 0
+		self.data_version = 0
 		if role == "child":
 			self.parent = parent
 
@@ -184,11 +1362,14 @@ class PiggyBank(db.Model):
 	id = db.Column(db.Integer, primary_key=True)
 	name = db.Column(db.String(80))
 	current_balance = db.Column(db.Numeric(10,2))
-	user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+	data_version = db.Column(db.Integer, default=0) # bumped by every DBManager write to the bank; keys cached fragments
+	reconciled_version = db.Column(db.Integer) # data_version the last reconcile pass checked
+	user_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
 	user = db.relationship('User', backref=db.backref('piggybanks', lazy='dynamic'))
 
 	def __init__(self, user, name):
 		self.current_balance = 0
+		self.data_version = 0
 		self.user = user
 		self.name = name
 	def __repr__(self):
@@ -205,8 +1386,10 @@ class Allowance(db.Model):
 	frequency = db.Column(db.String(12))
 	payday = db.Column(db.Integer)
 	active = db.Column(db.Boolean, default=False)
-	bank_id = db.Column(db.Integer, db.ForeignKey('piggybank.id'))
+	next_run_at = db.Column(db.DateTime) # naive UTC
+	bank_id = db.Column(db.Integer, db.ForeignKey('piggybank.id'), index=True)
 	piggybank = db.relationship('PiggyBank', backref=db.backref('allowances', lazy='dynamic'))
+	__table_args__ = (db.Index('ix_allowance_active_next_run', 'active', 'next_run_at'),)
 
 	def __init__(self, amount, frequency, piggybank, description=None, payday=None, active=True):
 		self.amount = amount
@@ -224,16 +1407,20 @@ class Allowance(db.Model):
 class Deposit(db.Model): 
 	__tablename__ = 'deposit'
 	id = db.Column(db.Integer, primary_key=True)
-	date_deposited  = db.Column(db.DateTime)
+	date_deposited  = db.Column(db.DateTime, nullable=False)
 	amount_deposited = db.Column(db.Numeric(10,2))
 	balance = db.Column(db.Numeric(10,2))
 	source = db.Column(db.String(80)) # description for display on screen; use source_id if by a user, otherwise Allowance
 	source_id = db.Column(db.Integer) #if deposit made by user
 	description = db.Column(db.Text)
+	allowance_id = db.Column(db.Integer) #if deposit paid out by the allowance task
+	pay_date = db.Column(db.Date) #allowance pay date; (allowance_id, pay_date) is unique
 	bank_id = db.Column(db.Integer, db.ForeignKey('piggybank.id'))
 	piggybank = db.relationship('PiggyBank', backref=db.backref('deposits', lazy='dynamic'))
+	__table_args__ = (db.Index('uq_deposit_allowance_pay_date', 'allowance_id', 'pay_date', unique=True),
+		db.Index('ix_deposit_bank_date', 'bank_id', 'date_deposited', 'id'))
 
-	def __init__(self, amount_deposited, piggybank, description=None, date_deposited=None, source=None, source_id=None):
+	def __init__(self, amount_deposited, piggybank, description=None, date_deposited=None, source=None, source_id=None, balance=None):
 		self.amount_deposited = amount_deposited
 		self.piggybank = piggybank
 		if date_deposited == None:
@@ -248,7 +1435,9 @@ class Deposit(db.Model):
 		if source_id == None:
 			source_id = piggybank.user_id
 		self.source_id = source_id
-		self.balance = piggybank.current_balance + self.amount_deposited
+		if balance == None:
+			balance = piggybank.current_balance + self.amount_deposited
+		self.balance = balance
 
 	def __repr__(self):
 		return '<Deposit %r>' % self.date_deposited
@@ -259,12 +1448,17 @@ class Expense(db.Model):
 	name = db.Column(db.String(80))
 	description = db.Column(db.Text)
 	price = db.Column(db.Numeric(10,2))
-	date_purchased = db.Column(db.DateTime)
-	date_added = db.Column(db.DateTime)
+	date_purchased = db.Column(db.DateTime) # set whenever purchased is
+	date_added = db.Column(db.DateTime, nullable=False)
 	purchased = db.Column(db.Boolean, default=False)
 	purchased_by = db.Column(db.Integer) #user id
+	recurring_expense_id = db.Column(db.Integer) #if charged by the recurring expense task
+	pay_date = db.Column(db.Date) #recurring charge date; (recurring_expense_id, pay_date) is unique
 	bank_id = db.Column(db.Integer, db.ForeignKey('piggybank.id'))
 	piggybank = db.relationship('PiggyBank', backref=db.backref('expenses', lazy='dynamic'))
+	__table_args__ = (db.Index('uq_expense_recurring_pay_date', 'recurring_expense_id', 'pay_date', unique=True),
+		db.Index('ix_expense_bank_purchased_date', 'bank_id', 'purchased', 'date_purchased', 'id'),
+		db.Index('ix_expense_bank_pending_added', 'bank_id', 'purchased', 'date_added', 'id'))
 
 	def __init__(self, name, price, piggybank, description=None, purchased=True, date_added=None, date_purchased=None, purchased_by=None):
 		self.name = name
@@ -288,6 +1482,117 @@ class Expense(db.Model):
 	def __repr__(self):
 		return '<Expense %r>' % self.name
 
+class RecurringExpense(db.Model):
+	__tablename__ = 'recurring_expense'
+	id = db.Column(db.Integer, primary_key=True)
+	name = db.Column(db.String(80))
+	description = db.Column(db.Text)
+	price = db.Column(db.Numeric(10,2))
+	frequency = db.Column(db.String(12))
+	payday = db.Column(db.Integer)
+	active = db.Column(db.Boolean, default=False)
+	next_run_at = db.Column(db.DateTime) # naive UTC
+	bank_id = db.Column(db.Integer, db.ForeignKey('piggybank.id'), index=True)
+	piggybank = db.relationship('PiggyBank', backref=db.backref('recurring_expenses', lazy='dynamic'))
+	__table_args__ = (db.Index('ix_recurring_expense_active_next_run', 'active', 'next_run_at'),)
+
+	def __init__(self, name, price, frequency, piggybank, description=None, payday=None, active=True):
+		self.name = name
+		self.price = price
+		self.frequency = frequency
+		self.piggybank = piggybank
+		self.description = description
+		self.active = active
+		if payday == None:
+			payday = 0
+		self.payday = payday
+
+	def __repr__(self):
+		return '<RecurringExpense %r>' % self.name
+
+class LedgerImport(db.Model):
+	__tablename__ = 'ledger_import'
+	id = db.Column(db.Integer, primary_key=True)
+	filename = db.Column(db.String(255))
+	format = db.Column(db.String(8)) # ledgerio.FORMATS
+	status = db.Column(db.String(12)) # pending, running, done or failed
+	size = db.Column(db.Integer) # bytes uploaded
+	rows_imported = db.Column(db.Integer, default=0)
+	rows_skipped = db.Column(db.Integer, default=0)
+	errors = db.Column(db.Text) # JSON list of the first rejected rows
+	created_at = db.Column(db.DateTime)
+	finished_at = db.Column(db.DateTime)
+	user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+	bank_id = db.Column(db.Integer, db.ForeignKey('piggybank.id'), index=True)
+	piggybank = db.relationship('PiggyBank')
+
+	def __init__(self, piggybank, user, format, filename):
+		self.piggybank = piggybank
+		self.user_id = user.id
+		self.format = format
+		self.filename = filename
+		self.status = 'pending'
+		self.size = 0
+		self.rows_imported = 0
+		self.rows_skipped = 0
+		self.created_at = datetime.utcnow()
+
+	def __repr__(self):
+		return '<LedgerImport %r>' % self.id
+
+class LedgerImportChunk(db.Model):
+	# an uploaded file in ledgerio.CHUNK_BYTES pieces, so a worker dyno can stream it back
+	__tablename__ = 'ledger_import_chunk'
+	import_id = db.Column(db.Integer, db.ForeignKey('ledger_import.id'), primary_key=True)
+	seq = db.Column(db.Integer, primary_key=True)
+	data = db.Column(db.LargeBinary)
+	bank_id = db.Column(db.Integer, db.ForeignKey('piggybank.id'), index=True)
+
+	def __repr__(self):
+		return '<LedgerImportChunk %r:%r>' % (self.import_id, self.seq)
+
+class LedgerRollup(db.Model):
+	# deposit and purchase totals per bank per ROLLUP_PERIODS period, kept current by every DBManager
+	# ledger write; DBManager.backfill_rollups rebuilds it from history
+	__tablename__ = 'ledger_rollup'
+	bank_id = db.Column(db.Integer, db.ForeignKey('piggybank.id'), primary_key=True)
+	period = db.Column(db.String(8), primary_key=True)
+	period_start = db.Column(db.Date, primary_key=True)
+	deposits = db.Column(db.Integer, default=0)
+	purchases = db.Column(db.Integer, default=0)
+	deposited = db.Column(db.Numeric(12,2), default=0)
+	spent = db.Column(db.Numeric(12,2), default=0)
+
+	def __repr__(self):
+		return '<LedgerRollup %r:%r:%r>' % (self.bank_id, self.period, self.period_start)
+
+# items the hourly schedule tick pays or charges, by kind
+RECURRING_TYPES = {'allowance': Allowance, 'expense': RecurringExpense}
+
+# tables deleted along with their bank, children first
+BANK_CHILD_TYPES = [Allowance, RecurringExpense, Expense, Deposit, LedgerImportChunk, LedgerImport, LedgerRollup]
+
+class BeatLock(db.Model):
+	__tablename__ = 'beat_lock'
+	name = db.Column(db.String(80), primary_key=True)
+	owner = db.Column(db.String(120))
+	expires_at = db.Column(db.DateTime)
+
+	def __repr__(self):
+		return '<BeatLock %r>' % self.name
+class BeatEntry(db.Model):
+	__tablename__ = 'beat_entry'
+	name = db.Column(db.String(80), primary_key=True)
+	last_run_at = db.Column(db.DateTime) # naive UTC
+	total_run_count = db.Column(db.Integer, default=0)
+
+	def __init__(self, name):
+		self.name = name
+		self.total_run_count = 0
+
+	def __repr__(self):
+		return '<BeatEntry %r>' % self.name
+
 ### Forms
 class RegistrationForm(Form):
 	username = TextField('Username', [validators.Length(min=4, max=25, message=("Username must be between 4 and 25 characters in length.")), validators.Required(), ])
@@ -322,6 +1627,18 @@ class AddAllowanceForm(Form):
 	frequency = SelectField("Frequency", choices=[("daily","Daily"), ("weekly", "Weekly"), ("biweekly", "Bi-Weekly"), ("monthly", "Monthly")] )
 	description = TextField('Description')
 	
+class AddRecurringExpenseForm(Form):
+	name = TextField('Name', [validators.Required(), validators.Length(max=80)])
+	price = DecimalField('Price', [validators.Required()])
+	frequency = SelectField("Frequency", choices=[("daily","Daily"), ("weekly", "Weekly"), ("biweekly", "Bi-Weekly"), ("monthly", "Monthly")] )
+	# weekly only: 0 = Monday
+	payday = IntegerField('Pay On', [validators.Optional(), validators.NumberRange(min=0, max=6)])
+	description = TextField('Description')
+
+class TimezoneForm(Form):
+	bankid = IntegerField('BankID', widget=HiddenInput())
+	timezone = SelectField('Time Zone', choices=[(name, name) for name in pytz.common_timezones])
+
 class PayDayForm(Form):
 	payday = SelectField("Pay On:", choices=[("0", "Monday"), ("1", "Tuesday"), ("2", "Wednesday"), ("3", "Thursday"), ("4", "Friday"), ("5", "Saturday"), ("6", "Sunday")])
 
@@ -350,6 +1667,30 @@ class UserIdForm(Form):
 
 
 ### Views/Controllers
+def owned_or_404(model, itemid):
+	# the logged in user's bank, or an item in one of their banks, loaded with its bank
+	item = dbm.owned(model, lm.current_user(), itemid)
+	if item == None:
+		abort(404)
+	return item
+
+def render_overview(bank):
+	recent_purchases = bank.expenses.filter(Expense.purchased == True).order_by(desc(Expense.date_purchased)).limit(5).all()
+	recent_deposits = bank.deposits.order_by(desc(Deposit.date_deposited)).limit(5).all()
+	return render_template('overview.html', bank=bank, recentpurchases=recent_purchases, recentdeposits=recent_deposits)
+
+def render_deposits(bank, add_deposit_form, bank_id_form, deposit_id_form):
+	deposits, cursor = dbm.deposits_page(bank)
+	return render_template('deposits.html', bank=bank, deposits=deposits, nextcursor=cursor,
+		adddepositform=add_deposit_form, bankidform=bank_id_form, depositidform=deposit_id_form)
+
+def render_expenses(bank, add_expense_form, bank_id_form, expense_id_form):
+	pending, pending_cursor = dbm.pending_expenses_page(bank)
+	purchased, purchased_cursor = dbm.purchased_expenses_page(bank)
+	return render_template('expenses.html', bank=bank, pending=pending, pendingcursor=pending_cursor,
+		purchased=purchased, purchasedcursor=purchased_cursor,
+		addexpenseform=add_expense_form, bankidform=bank_id_form, expenseidform=expense_id_form)
+
 @app.route('/', methods=['GET', 'POST'])
 def front():
 	if lm.check_login(session):
@@ -418,7 +1759,7 @@ def register():
 def home():
 	addallowanceform = AddAllowanceForm(request.form)
 	if lm.check_login(session):
-		user = dbm.get_user_by_id(session['userid'])	
+		user = lm.current_user()	
 		return render_template('home.html', username=user.username, role=user.role, addallowanceform=addallowanceform)
 	return redirect(url_for('login'))
 
@@ -426,10 +1767,10 @@ def home():
 @app.route('/navigation/', methods=['GET', 'POST'])
 def navigationbar():
 	if lm.check_login(session):
-	 	bankid = request.form['bankid']
-	 	bank = PiggyBank.query.get_or_404(bankid)
-	 	if request.method == 'POST':
-	 		return render_template('navigationbar.html', bankid=bankid, bank=bank)
+	 	bankid = request.values['bankid']
+	 	bank = owned_or_404(PiggyBank, bankid)
+	 	return fragment_response('navigationbar', bank.id, bank.data_version,
+	 		lambda: render_template('navigationbar.html', bankid=bankid, bank=bank))
 	return render_template('navigationbar.html')
 
 @csrf.exempt
@@ -438,17 +1779,18 @@ def banks():
 	addbankform = AddBankForm(request.form)
 	bankidform = BankIdForm(request.form)
 	if lm.check_login(session):
-		user = dbm.get_user_by_id(session['userid'])
-		piggybanks = user.piggybanks.order_by(PiggyBank.id).all()
-		return render_template('banks.html', addbankform=addbankform, bankidform=bankidform, piggybanks=piggybanks)
+		user = lm.current_user()
+		return fragment_response('banks', user.id, user.data_version, lambda: render_template('banks.html',
+			addbankform=addbankform, bankidform=bankidform, piggybanks=user.piggybanks.order_by(PiggyBank.id).all()))
 	return render_template('oops.html')
 
 # create bank
 @app.route('/addbank/', methods=['GET', 'POST'])
 def add_bank():
 	if lm.check_login(session):
-		form = AddBankForm(request.form)
-		user = dbm.get_user_by_id(session['userid'])
+		# the token comes in the X-CSRFToken header, so the cached bank list carries no per-session field
+		form = AddBankForm(request.form, csrf_enabled=False)
+		user = lm.current_user()
 		if request.method == 'POST':
 			if form.validate():
 				dbm.create_bank(user, form.bankname.data)
@@ -460,13 +1802,8 @@ def add_bank():
 @app.route('/overview/', methods=['GET', 'POST'])
 def overview():
 	if lm.check_login(session):
-		bankid = request.form['bankid']
-		user = dbm.get_user_by_id(session['userid'])
-		if request.method == 'POST':
-			piggybank = PiggyBank.query.get_or_404(bankid)
-			recent_purchases = piggybank.expenses.filter(Expense.purchased == True).order_by(desc(Expense.date_purchased)).limit(5).all()
-			recent_deposits = piggybank.deposits.order_by(desc(Deposit.date_deposited)).limit(5).all()
-			return render_template('overview.html', bank=piggybank, recentpurchases=recent_purchases, recentdeposits=recent_deposits)
+		piggybank = owned_or_404(PiggyBank, request.values['bankid'])
+		return fragment_response('overview', piggybank.id, piggybank.data_version, lambda: render_overview(piggybank))
 	return render_template('overview.html')
 
 @csrf.exempt
@@ -476,10 +1813,13 @@ def deposits():
 	bank_id_form = BankIdForm(request.form)
 	deposit_id_form = DepositIdForm(request.form)
 	if lm.check_login(session):
-		bankid = request.form['bankid']
-		bank = PiggyBank.query.get_or_404(bankid)
-		if request.method =='POST':
-			return render_template('deposits.html', bank=bank, adddepositform=add_deposit_form, bankidform=bank_id_form, depositidform=deposit_id_form)
+		bank = owned_or_404(PiggyBank, request.values['bankid'])
+		if request.values.get('cursor'):
+			# "show older deposits": just the next page of rows
+			deposits, cursor = dbm.deposits_page(bank, request.values['cursor'])
+			return render_template('deposit_rows.html', bank=bank, deposits=deposits, nextcursor=cursor, depositidform=deposit_id_form)
+		return fragment_response('deposits', bank.id, bank.data_version,
+			lambda: render_deposits(bank, add_deposit_form, bank_id_form, deposit_id_form))
 	return render_template('oops.html')
 
 # create deposit
@@ -489,16 +1829,14 @@ def add_deposit():
 
 	#bankid = piggybank.id
 	if lm.check_login(session):
-		user = dbm.get_user_by_id(session['userid'])
 		add_deposit_form = AddDepositForm(request.form)
 		bank_id_form = BankIdForm(request.form)
 		deposit_id_form=DepositIdForm(request.form)
-		piggybank = PiggyBank.query.get_or_404(bank_id_form.bankid.data)
+		piggybank = owned_or_404(PiggyBank, bank_id_form.bankid.data)
 		if request.method == 'POST':
 			if add_deposit_form.validate() and bank_id_form.validate():
-				if piggybank.user_id == user.id:
-					dbm.create_deposit(add_deposit_form.amount.data, piggybank, add_deposit_form.description.data)
-					return render_template('deposits.html', bank=piggybank, adddepositform=add_deposit_form, bankidform=bank_id_form, depositidform=deposit_id_form)
+				dbm.create_deposit(add_deposit_form.amount.data, piggybank, add_deposit_form.description.data)
+				return render_deposits(piggybank, add_deposit_form, bank_id_form, deposit_id_form)
 	return render_template('oops.html')
 
 # delete deposit
@@ -506,16 +1844,14 @@ def add_deposit():
 @app.route('/deletedeposit/', methods=['GET', 'POST'])
 def delete_deposit():
 	if lm.check_login(session):
-		user = dbm.get_user_by_id(session['userid'])
 		add_deposit_form = AddDepositForm(request.form)
 		bank_id_form = BankIdForm(request.form)
 		deposit_id_form = DepositIdForm(request.form)
 		if request.method == 'POST':
-			deposit = Deposit.query.get_or_404(deposit_id_form.depositid.data)
+			deposit = owned_or_404(Deposit, deposit_id_form.depositid.data)
 			piggybank = deposit.piggybank
-			if deposit.piggybank.user_id == user.id:
-				dbm.delete_deposit(deposit)
-				return render_template('deposits.html', bank=piggybank, adddepositform=add_deposit_form, bankidform=bank_id_form, depositidform=deposit_id_form)
+			dbm.delete_deposit(deposit)
+			return render_deposits(piggybank, add_deposit_form, bank_id_form, deposit_id_form)
 	return render_template('oops.html')
 
 
@@ -526,29 +1862,35 @@ def expenses():
 	bank_id_form = BankIdForm(request.form)
 	expense_id_form = ExpenseIdForm(request.form)
 	if lm.check_login(session):
-		bankid = request.form['bankid']
-		piggybank = PiggyBank.query.get_or_404(bankid)
-		if request.method =='POST':
-			return render_template('expenses.html', bank=piggybank, addexpenseform=add_expense_form, bankidform=bank_id_form, expenseidform = expense_id_form)
+		piggybank = owned_or_404(PiggyBank, request.values['bankid'])
+		if request.values.get('cursor'):
+			# "show more": just the next page of one list
+			listname = request.values.get('list')
+			if listname == 'purchased':
+				expenses, cursor = dbm.purchased_expenses_page(piggybank, request.values['cursor'])
+			else:
+				listname = 'pending'
+				expenses, cursor = dbm.pending_expenses_page(piggybank, request.values['cursor'])
+			return render_template('expense_rows.html', bank=piggybank, expenses=expenses, listname=listname, nextcursor=cursor, expenseidform=expense_id_form)
+		return fragment_response('expenses', piggybank.id, piggybank.data_version,
+			lambda: render_expenses(piggybank, add_expense_form, bank_id_form, expense_id_form))
 	return render_template('oops.html')
 
 # add expense
 @app.route('/addexpense/', methods=['GET', 'POST'])
 def add_expense():
 	if lm.check_login(session):
-		user = dbm.get_user_by_id(session['userid'])
 		add_expense_form = AddExpenseForm(request.form)
 		bank_id_form = BankIdForm(request.form)
 		expense_id_form = ExpenseIdForm(request.form)
-		piggybank = PiggyBank.query.get_or_404(bank_id_form.bankid.data)
+		piggybank = owned_or_404(PiggyBank, bank_id_form.bankid.data)
 		if request.method == 'POST':
 			if add_expense_form.validate() and bank_id_form.validate():
-				if piggybank.user_id == user.id:
-					purchased = False
-					if add_expense_form.purchased.data:
-						purchased = True
-					dbm.create_expense(add_expense_form.name.data, add_expense_form.price.data, piggybank, add_expense_form.description.data, purchased )
-					return render_template('expenses.html', bank=piggybank, addexpenseform=add_expense_form, bankidform=bank_id_form, expenseidform=expense_id_form)
+				purchased = False
+				if add_expense_form.purchased.data:
+					purchased = True
+				dbm.create_expense(add_expense_form.name.data, add_expense_form.price.data, piggybank, add_expense_form.description.data, purchased )
+				return render_expenses(piggybank, add_expense_form, bank_id_form, expense_id_form)
 	return render_template('oops.html')
 
 # purchase expense
@@ -557,16 +1899,14 @@ def add_expense():
 def purchase_expense():
 	expense_id_form = ExpenseIdForm(request.form)
 	if lm.check_login(session):
-		user = dbm.get_user_by_id(session['userid'])
 		add_expense_form = AddExpenseForm(request.form)
 		bank_id_form = BankIdForm(request.form)
 		expense_id_form = ExpenseIdForm(request.form)
 		if request.method == 'POST':
-			expense = Expense.query.get_or_404(expense_id_form.expenseid.data)
+			expense = owned_or_404(Expense, expense_id_form.expenseid.data)
 			piggybank = expense.piggybank
-			if expense.piggybank.user_id == user.id:
-				dbm.purchase_expense(expense)
-				return render_template('expenses.html', bank=piggybank, addexpenseform=add_expense_form, bankidform=bank_id_form, expenseidform=expense_id_form)
+			dbm.purchase_expense(expense)
+			return render_expenses(piggybank, add_expense_form, bank_id_form, expense_id_form)
 	return render_template('oops.html')
 
 
@@ -577,16 +1917,14 @@ def purchase_expense():
 def delete_expense():
 	expense_id_form = ExpenseIdForm(request.form)
 	if lm.check_login(session):
-		user = dbm.get_user_by_id(session['userid'])
 		add_expense_form = AddExpenseForm(request.form)
 		bank_id_form = BankIdForm(request.form)
 		expense_id_form = ExpenseIdForm(request.form)
 		if request.method == 'POST':
-			expense = Expense.query.get_or_404(expense_id_form.expenseid.data)
+			expense = owned_or_404(Expense, expense_id_form.expenseid.data)
 			piggybank = expense.piggybank
-			if expense.piggybank.user_id == user.id:
-				dbm.delete_expense(expense)
-				return render_template('expenses.html', bank=piggybank, addexpenseform=add_expense_form, bankidform=bank_id_form, expenseidform=expense_id_form)
+			dbm.delete_expense(expense)
+			return render_expenses(piggybank, add_expense_form, bank_id_form, expense_id_form)
 	return render_template('oops.html')
 
 # refund expense
@@ -595,16 +1933,14 @@ def delete_expense():
 def refund_expense():
 	expense_id_form = ExpenseIdForm(request.form)
 	if lm.check_login(session):
-		user = dbm.get_user_by_id(session['userid'])
 		add_expense_form = AddExpenseForm(request.form)
 		bank_id_form = BankIdForm(request.form)
 		expense_id_form = ExpenseIdForm(request.form)
 		if request.method =='POST':
-			expense = Expense.query.get_or_404(expense_id_form.expenseid.data)
+			expense = owned_or_404(Expense, expense_id_form.expenseid.data)
 			piggybank = expense.piggybank
-			if piggybank.user_id == user.id:
-				dbm.refund_expense(expense)
-				return render_template('expenses.html', bank=piggybank, addexpenseform=add_expense_form, bankidform=bank_id_form, expenseidform=expense_id_form)
+			dbm.refund_expense(expense)
+			return render_expenses(piggybank, add_expense_form, bank_id_form, expense_id_form)
 	return render_template('oops.html')
 
 
@@ -615,26 +1951,23 @@ def allowances():
 	bank_id_form = BankIdForm(request.form)
 	allowance_id_form = AllowanceIdForm(request.form)
 	if lm.check_login(session):
-		bankid = request.form['bankid']
-		bank = PiggyBank.query.get_or_404(bankid)
-		if request.method=='POST':
-			return render_template('allowances.html', bank=bank, addallowanceform=add_allowance_form, bankidform=bank_id_form, allowanceidform=allowance_id_form)
-		return render_template('allowances.html')
+		bank = owned_or_404(PiggyBank, request.values['bankid'])
+		return fragment_response('allowances', bank.id, bank.data_version, lambda: render_template('allowances.html',
+			bank=bank, addallowanceform=add_allowance_form, bankidform=bank_id_form, allowanceidform=allowance_id_form))
+	return render_template('oops.html')
 
 # add allowance
 @ app.route('/addallowance/', methods=['GET', 'POST'])
 def add_allowance():	
 	if lm.check_login(session):
-		user = dbm.get_user_by_id(session['userid'])
 		add_allowance_form = AddAllowanceForm(request.form)
 		bank_id_form = BankIdForm(request.form)
 		allowance_id_form = AllowanceIdForm(request.form)
-		piggybank = PiggyBank.query.get_or_404(bank_id_form.bankid.data)
+		piggybank = owned_or_404(PiggyBank, bank_id_form.bankid.data)
 		if request.method == 'POST' and add_allowance_form.validate() and bank_id_form.validate():
-			if piggybank.user_id == user.id:
-				dbm.create_allowance(add_allowance_form.amount.data, add_allowance_form.frequency.data, piggybank, \
-				 add_allowance_form.description.data)
-				return render_template('allowances.html', bank=piggybank, addallowanceform=add_allowance_form, bankidform=bank_id_form, allowanceidform=allowance_id_form)
+			dbm.create_allowance(add_allowance_form.amount.data, add_allowance_form.frequency.data, piggybank, \
+			 add_allowance_form.description.data)
+			return render_template('allowances.html', bank=piggybank, addallowanceform=add_allowance_form, bankidform=bank_id_form, allowanceidform=allowance_id_form)
 	return render_template('oops.html')
 
 @app.route('/updateallowance/', methods=['GET', 'POST'])
@@ -642,27 +1975,23 @@ def update_allowance():
 	allowance_form = AddAllowanceForm(request.form)
 	allowance_id_form = AllowanceIdForm(request.form)
 	if lm.check_login(session):
-		user = dbm.get_user_by_id(session['userid'])
 		if request.method =='POST' and allowance_form.validate():
-			allowance = Allowance.query.get_or_404(allowance_id_form.allowanceid.data)
-			if allowance.piggypank.user_id == user.id:
-				dbm.change_allowance(allowance_form.amount.data, allowance_form.frequency.data, allowance_form.description.data)
+			allowance = owned_or_404(Allowance, allowance_id_form.allowanceid.data)
+			dbm.change_allowance(allowance, allowance_form.amount.data, allowance_form.frequency.data)
 	return redirect(url_for('home'))
 
 @csrf.exempt
 @app.route('/toggleallowance/', methods=['GET', 'POST'])
 def toggle_allowance():
 	if lm.check_login(session):
-		user = dbm.get_user_by_id(session['userid'])
 		allowance_id_form = AllowanceIdForm(request.form)
 		add_allowance_form = AddAllowanceForm(request.form)
 		bank_id_form = BankIdForm(request.form)
 		if request.method == 'POST':
-			allowance = Allowance.query.get_or_404(allowance_id_form.allowanceid.data)
+			allowance = owned_or_404(Allowance, allowance_id_form.allowanceid.data)
 			piggybank = allowance.piggybank
-			if piggybank.user_id == user.id:
-				dbm.toggle_allowance(allowance)
-				return render_template('allowances.html', bank=piggybank, addallowanceform=add_allowance_form, bankidform=bank_id_form, allowanceidform=allowance_id_form)
+			dbm.toggle_allowance(allowance)
+			return render_template('allowances.html', bank=piggybank, addallowanceform=add_allowance_form, bankidform=bank_id_form, allowanceidform=allowance_id_form)
 	return render_template('oops.html')
 
 # delete allowance
@@ -670,16 +1999,14 @@ def toggle_allowance():
 @app.route('/deleteallowance/', methods=['GET', 'POST'])
 def delete_allowance():	
 	if lm.check_login(session):
-		user = dbm.get_user_by_id(session['userid'])
 		allowance_id_form = AllowanceIdForm(request.form)
 		add_allowance_form = AddAllowanceForm(request.form)
 		bank_id_form = BankIdForm(request.form)
 		if request.method == 'POST':
-			allowance = Allowance.query.get_or_404(allowance_id_form.allowanceid.data)
+			allowance = owned_or_404(Allowance, allowance_id_form.allowanceid.data)
 			piggybank = allowance.piggybank
-			if allowance.piggybank.user_id == user.id:
-				dbm.delete_allowance(allowance)
-				return render_template('allowances.html', bank=piggybank, addallowanceform=add_allowance_form, bankidform=bank_id_form, allowanceidform=allowance_id_form)
+			dbm.delete_allowance(allowance)
+			return render_template('allowances.html', bank=piggybank, addallowanceform=add_allowance_form, bankidform=bank_id_form, allowanceidform=allowance_id_form)
 	return render_template('oops.html')
 
 
@@ -687,54 +2014,323 @@ def delete_allowance():
 @app.route('/settings/', methods=['GET', 'POST'])
 def settings():
 	if lm.check_login(session):
-		user = dbm.get_user_by_id(session['userid'])
-		bankid = request.form['bankid']
-		bank = PiggyBank.query.get_or_404(bankid)
-		bank_delete_form = BankDeleteForm(request.form)
-		bank_rename_form = BankRenameForm(request.form)
-		if request.method == 'POST':
-			return render_template('settings.html', bank=bank, bankdeleteform=bank_delete_form, bankrenameform=bank_rename_form)
+		bank = owned_or_404(PiggyBank, request.values['bankid'])
+		return render_settings(bank)
 	return render_template('oops.html')
 
+def render_settings(bank, bank_rename_form=None, bank_delete_form=None, timezone_form=None):
+	# the form a view was posted keeps its input and errors; the others start blank
+	if bank_rename_form == None:
+		bank_rename_form = BankRenameForm(request.form)
+	if bank_delete_form == None:
+		bank_delete_form = BankDeleteForm(request.form)
+	if timezone_form == None:
+		timezone_form = TimezoneForm(request.form, timezone=lm.current_user().timezone or 'UTC')
+	return render_template('settings.html', bank=bank, bankrenameform=bank_rename_form, bankdeleteform=bank_delete_form,
+		timezoneform=timezone_form)
+
 @csrf.exempt
 @app.route('/renamebank/', methods=['GET', 'POST'])
 def rename_bank():
 	if lm.check_login(session):
-		user = dbm.get_user_by_id(session['userid'])
 		bank_rename_form = BankRenameForm(request.form)
-		bank_delete_form = BankDeleteForm(request.form)
-		bank = PiggyBank.query.get_or_404(bank_rename_form.bankid.data)
+		bank = owned_or_404(PiggyBank, bank_rename_form.bankid.data)
 		if request.method == 'POST' and bank_rename_form.validate():
-			if bank.user_id == user.id:
-				dbm.rename_bank(bank, bank_rename_form.bankname.data)
-	return render_template('settings.html', bank=bank, bankrenameform=bank_rename_form, bankdeleteform=bank_delete_form)
+			dbm.rename_bank(bank, bank_rename_form.bankname.data)
+		return render_settings(bank, bank_rename_form=bank_rename_form)
+	return render_template('oops.html')
+
+@csrf.exempt
+@app.route('/settimezone/', methods=['GET', 'POST'])
+def set_timezone():
+	# per parent, not per bank: allowances and recurring expenses run at midnight in this zone
+	if lm.check_login(session):
+		timezone_form = TimezoneForm(request.form)
+		bank = owned_or_404(PiggyBank, timezone_form.bankid.data)
+		if request.method == 'POST' and timezone_form.validate():
+			dbm.set_timezone(lm.current_user(), timezone_form.timezone.data)
+		return render_settings(bank, timezone_form=timezone_form)
+	return render_template('oops.html')
 
 # delete bank
 @csrf.exempt
 @app.route('/deletebank/', methods=['GET', 'POST'])
 def delete_bank():
 	if lm.check_login(session):
-		user = dbm.get_user_by_id(session['userid'])
+		user = lm.current_user()
 		bank_delete_form = BankDeleteForm(request.form)
-		bank_rename_form = BankRenameForm(request.form)
-		bank = PiggyBank.query.get_or_404(bank_delete_form.bankid.data)	
+		bank = owned_or_404(PiggyBank, bank_delete_form.bankid.data)
 		if request.method == 'POST':
-			if bank.user_id == user.id and check_password_hash(user.password, bank_delete_form.password.data) == True:
-				for allowance in bank.allowances:
-					dbm.delete_allowance(allowance)
-				for expense in bank.expenses:
-					dbm.delete_expense(expense)
-				for deposit in bank.deposits:
-					dbm.delete_deposit(deposit)
-				dbm.delete_bank(bank)
+			if check_password_hash(user.password, bank_delete_form.password.data) == True:
+				if dbm.bank_size(bank) > app.config.get('BANK_DELETE_ASYNC_ROWS', 10000):
+					dbm.detach_bank(bank)
+					from tasks import delete_bank_task
+					delete_bank_task.delay(bank.id)
+				else:
+					dbm.delete_bank(bank.id)
 				return "Bank Deleted! Please select a different bank."
-			elif bank.user_id == user.id and check_password_hash(user.password, bank_delete_form.password.data) != True:
+			else:
 				templist = list(bank_delete_form.password.errors)
 				templist.append("Incorrect Password.")
 				bank_delete_form.password.errors = tuple(templist)
-	return render_template('settings.html', bank=bank, bankdeleteform=bank_delete_form, bankrenameform=bank_rename_form)
+		return render_settings(bank, bank_delete_form=bank_delete_form)
+	return render_template('oops.html')
+
+
 
+# export
+def export_response(rows, format, filename):
+	# the body is generated while the rows stream in; stream_with_context keeps the session open until it ends
+	return app.response_class(stream_with_context(ledgerio.WRITERS[format](rows)), mimetype=ledgerio.EXPORT_FORMATS[format],
+		headers={'Content-Disposition': 'attachment; filename="%s.%s"' % (filename, format)})
 
+@app.route('/banks/<int:bankid>/export.<format>')
+def export_bank(bankid, format):
+	if lm.check_login(session) and format in ledgerio.EXPORT_FORMATS:
+		bank = owned_or_404(PiggyBank, bankid)
+		return export_response(dbm.ledger_rows([bank.id]), format, 'piggybank-%d' % bank.id)
+	abort(404)
+
+@app.route('/family/export.<format>')
+def export_family(format):
+	if lm.check_login(session) and format in ledgerio.EXPORT_FORMATS:
+		return export_response(dbm.ledger_rows(dbm.family_bank_ids(lm.current_user())), format, 'piggybank-family')
+	abort(404)
+
+def render_analytics(bank_ids, bank=None):
+	return render_template('analytics.html', bank=bank, weekly=dbm.rollups(bank_ids, 'week', app.config.get('ANALYTICS_WEEKS', 12)),
+		monthly=dbm.rollups(bank_ids, 'month', app.config.get('ANALYTICS_MONTHS', 12)))
+
+@csrf.exempt
+@app.route('/analytics/', methods=['GET', 'POST'])
+def analytics():
+	if lm.check_login(session):
+		bank = owned_or_404(PiggyBank, request.values['bankid'])
+		# the window of periods shown moves on each Monday even when the bank doesn't change
+		version = '%s:%s' % (bank.data_version or 0, period_start('week', datetime.utcnow()))
+		return fragment_response('analytics', bank.id, version, lambda: render_analytics([bank.id], bank))
+	return render_template('oops.html')
+
+@app.route('/family/analytics/')
+def family_analytics():
+	# every bank of the user and their children, summed; reads rollup rows only, so it is not cached
+	if lm.check_login(session):
+		return render_analytics(dbm.family_bank_ids(lm.current_user()))
+	return render_template('oops.html')
+
+
+### JSON API
+# Mutations for the bank fragments. Each answers with only the changed record and the bank's new
+# balance; static/js/functions.js patches the page with them.
+def money(value):
+	return '%.2f' % value
+
+def day(value):
+	if value == None:
+		return None
+	return value.strftime('%Y-%m-%d')
+
+def bank_json(bank):
+	return {'id': bank.id, 'balance': money(bank.current_balance)}
+
+def deposit_json(deposit):
+	return {'id': deposit.id, 'amount': money(deposit.amount_deposited), 'description': deposit.description,
+		'date': day(deposit.date_deposited)}
+
+def expense_json(expense):
+	return {'id': expense.id, 'name': expense.name, 'description': expense.description, 'price': money(expense.price),
+		'purchased': expense.purchased == True, 'date_added': day(expense.date_added), 'date_purchased': day(expense.date_purchased)}
+
+def allowance_json(allowance):
+	return {'id': allowance.id, 'amount': money(allowance.amount), 'description': allowance.description,
+		'frequency': allowance.frequency, 'active': allowance.active == True}
+
+def recurring_expense_json(expense):
+	return {'id': expense.id, 'name': expense.name, 'description': expense.description, 'price': money(expense.price),
+		'frequency': expense.frequency, 'payday': expense.payday, 'active': expense.active == True,
+		'next_run': day(expense.next_run_at) if expense.active else None}
+
+def api_response(payload, status=200):
+	return app.response_class(json.dumps(payload, separators=(',', ':')), status=status, mimetype='application/json')
+
+def api_user():
+	user = lm.current_user()
+	if user == None:
+		abort(api_response({'errors': {'login': ["Please sign in again."]}}, 401))
+	return user
+
+def api_owned(model, itemid):
+	# the item if it is (in) a bank the logged in user owns; anything else is a JSON error
+	item = dbm.owned(model, api_user(), itemid)
+	if item == None:
+		abort(api_response({'errors': {'id': ["Not found."]}}, 404))
+	return item
+
+def import_json(ledger_import):
+	return {'id': ledger_import.id, 'filename': ledger_import.filename, 'status': ledger_import.status,
+		'size': ledger_import.size, 'imported': ledger_import.rows_imported, 'skipped': ledger_import.rows_skipped,
+		'errors': json.loads(ledger_import.errors or '[]')}
+
+def api_form_errors(form):
+	return api_response({'errors': form.errors}, 400)
+
+@app.route('/api/v1/banks/<int:bankid>/deposits', methods=['POST'])
+def api_add_deposit(bankid):
+	bank = api_owned(PiggyBank, bankid)
+	form = AddDepositForm(request.form, csrf_enabled=False)
+	if not form.validate():
+		return api_form_errors(form)
+	deposit = dbm.create_deposit(form.amount.data, bank, form.description.data)
+	return api_response({'bank': bank_json(bank), 'deposit': deposit_json(deposit)})
+
+@app.route('/api/v1/deposits/<int:depositid>', methods=['DELETE'])
+def api_delete_deposit(depositid):
+	deposit = api_owned(Deposit, depositid)
+	bank = deposit.piggybank
+	dbm.delete_deposit(deposit)
+	return api_response({'bank': bank_json(bank), 'deleted': depositid})
+
+@app.route('/api/v1/banks/<int:bankid>/expenses', methods=['POST'])
+def api_add_expense(bankid):
+	bank = api_owned(PiggyBank, bankid)
+	form = AddExpenseForm(request.form, csrf_enabled=False)
+	if not form.validate():
+		return api_form_errors(form)
+	expense = dbm.create_expense(form.name.data, form.price.data, bank, form.description.data, form.purchased.data == True)
+	return api_response({'bank': bank_json(bank), 'expense': expense_json(expense)})
+
+@app.route('/api/v1/expenses/<int:expenseid>/purchase', methods=['POST'])
+def api_purchase_expense(expenseid):
+	expense = api_owned(Expense, expenseid)
+	dbm.purchase_expense(expense)
+	return api_response({'bank': bank_json(expense.piggybank), 'expense': expense_json(expense)})
+
+@app.route('/api/v1/expenses/<int:expenseid>/refund', methods=['POST'])
+def api_refund_expense(expenseid):
+	expense = api_owned(Expense, expenseid)
+	dbm.refund_expense(expense)
+	return api_response({'bank': bank_json(expense.piggybank), 'expense': expense_json(expense)})
+
+@app.route('/api/v1/expenses/<int:expenseid>', methods=['DELETE'])
+def api_delete_expense(expenseid):
+	expense = api_owned(Expense, expenseid)
+	bank = expense.piggybank
+	dbm.delete_expense(expense)
+	return api_response({'bank': bank_json(bank), 'deleted': expenseid})
+
+@app.route('/api/v1/banks/<int:bankid>/allowances', methods=['POST'])
+def api_add_allowance(bankid):
+	bank = api_owned(PiggyBank, bankid)
+	form = AddAllowanceForm(request.form, csrf_enabled=False)
+	if not form.validate():
+		return api_form_errors(form)
+	allowance = dbm.create_allowance(form.amount.data, form.frequency.data, bank, form.description.data)
+	return api_response({'bank': bank_json(bank), 'allowance': allowance_json(allowance)})
+
+@app.route('/api/v1/banks/<int:bankid>/imports', methods=['POST'])
+def api_import_ledger(bankid):
+	# multipart upload of a CSV or OFX file; a large one is imported by a worker, poll api_import_status
+	bank = api_owned(PiggyBank, bankid)
+	upload = request.files.get('file')
+	if upload == None:
+		return api_response({'errors': {'file': ["Choose a CSV or OFX file."]}}, 400)
+	format = request.form.get('format') or ledgerio.guess_format(upload.filename)
+	if format not in ledgerio.FORMATS:
+		return api_response({'errors': {'format': ["Use csv or ofx."]}}, 400)
+	ledger_import = dbm.create_import(bank, lm.current_user(), format, upload.filename, upload.stream)
+	if ledger_import.size > app.config.get('IMPORT_ASYNC_BYTES', 262144):
+		from tasks import import_ledger_task
+		import_ledger_task.delay(ledger_import.id)
+		return api_response({'import': import_json(ledger_import)}, 202)
+	ledger_import = dbm.run_import(ledger_import.id)
+	return api_response({'bank': bank_json(bank), 'import': import_json(ledger_import)})
+
+def forecast_args():
+	# (horizon in days, goal or None) from ?days= and ?goal=, or a JSON error
+	horizon = request.args.get('days', app.config.get('FORECAST_DAYS', 365), type=int)
+	if not 1 <= horizon <= app.config.get('FORECAST_MAX_DAYS', 730):
+		abort(api_response({'errors': {'days': ["Must be between 1 and %d." % app.config.get('FORECAST_MAX_DAYS', 730)]}}, 400))
+	goal = request.args.get('goal')
+	if goal:
+		try:
+			goal = Decimal(goal).quantize(Decimal('0.01'))
+		except InvalidOperation:
+			abort(api_response({'errors': {'goal': ["Not an amount."]}}, 400))
+	return horizon, goal or None
+
+@app.route('/api/v1/banks/<int:bankid>/forecast', methods=['GET'])
+def api_bank_forecast(bankid):
+	horizon, goal = forecast_args()
+	bank = api_owned(PiggyBank, bankid)
+	return api_response({'forecast': dbm.forecasts([bank], horizon, goal)[bank.id]})
+
+@app.route('/api/v1/forecast', methods=['GET'])
+def api_family_forecast():
+	# every bank of the logged in user and their children, projected together
+	horizon, goal = forecast_args()
+	user = lm.current_user()
+	if user == None:
+		abort(api_response({'errors': {'login': ["Please sign in again."]}}, 401))
+	banks = PiggyBank.query.join(User, PiggyBank.user_id == User.id) \
+		.filter(or_(User.id == user.id, User.parent_id == user.id)).order_by(PiggyBank.id).all()
+	results = dbm.forecasts(banks, horizon, goal)
+	return api_response({'forecasts': [results[bank.id] for bank in banks]})
+
+@app.route('/api/v1/imports/<int:importid>', methods=['GET'])
+def api_import_status(importid):
+	return api_response({'import': import_json(api_owned(LedgerImport, importid))})
+
+@app.route('/api/v1/allowances/<int:allowanceid>/toggle', methods=['POST'])
+def api_toggle_allowance(allowanceid):
+	allowance = api_owned(Allowance, allowanceid)
+	dbm.toggle_allowance(allowance)
+	return api_response({'bank': bank_json(allowance.piggybank), 'allowance': allowance_json(allowance)})
+
+@app.route('/api/v1/allowances/<int:allowanceid>', methods=['DELETE'])
+def api_delete_allowance(allowanceid):
+	allowance = api_owned(Allowance, allowanceid)
+	bank = allowance.piggybank
+	dbm.delete_allowance(allowance)
+	return api_response({'bank': bank_json(bank), 'deleted': allowanceid})
+
+@app.route('/api/v1/banks/<int:bankid>/recurring_expenses', methods=['GET'])
+def api_recurring_expenses(bankid):
+	bank = api_owned(PiggyBank, bankid)
+	expenses = RecurringExpense.query.filter(RecurringExpense.bank_id == bank.id).order_by(RecurringExpense.id)
+	return api_response({'recurring_expenses': [recurring_expense_json(expense) for expense in expenses]})
+
+@app.route('/api/v1/banks/<int:bankid>/recurring_expenses', methods=['POST'])
+def api_add_recurring_expense(bankid):
+	bank = api_owned(PiggyBank, bankid)
+	form = AddRecurringExpenseForm(request.form, csrf_enabled=False)
+	if not form.validate():
+		return api_form_errors(form)
+	expense = dbm.create_recurring_expense(form.name.data, form.price.data, form.frequency.data, bank, form.description.data,
+		form.payday.data)
+	return api_response({'bank': bank_json(bank), 'recurring_expense': recurring_expense_json(expense)})
+
+@app.route('/api/v1/recurring_expenses/<int:expenseid>/toggle', methods=['POST'])
+def api_toggle_recurring_expense(expenseid):
+	expense = api_owned(RecurringExpense, expenseid)
+	dbm.toggle_recurring_expense(expense)
+	return api_response({'bank': bank_json(expense.piggybank), 'recurring_expense': recurring_expense_json(expense)})
+
+@app.route('/api/v1/recurring_expenses/<int:expenseid>', methods=['DELETE'])
+def api_delete_recurring_expense(expenseid):
+	expense = api_owned(RecurringExpense, expenseid)
+	bank = expense.piggybank
+	dbm.delete_recurring_expense(expense)
+	return api_response({'bank': bank_json(bank), 'deleted': expenseid})
+
+@app.route('/api/v1/timezone', methods=['POST'])
+def api_set_timezone():
+	# an IANA name from pytz.common_timezones, e.g. America/Chicago
+	user = api_user()
+	form = TimezoneForm(request.form, csrf_enabled=False)
+	if not form.validate():
+		return api_form_errors(form)
+	dbm.set_timezone(user, form.timezone.data)
+	return api_response({'timezone': user.timezone})
 
 
 @app.route('/logout/')
@@ -744,33 +2340,58 @@ def logout():
 		
 	return redirect(url_for('login'))
 
+# sign out of every browser/device
+@app.route('/logout/all/')
+def logout_all():
+	if lm.check_login(session):
+		lm.revoke(lm.current_user())
+		lm.logout()
+	return redirect(url_for('login'))
+
 
 ### Admin and Debug
+def cached_totals():
+	# System totals change with every write, so rather than a data version they are keyed on the
+	# current ADMIN_TOTALS_TTL window: at most one count per window per cache.
+	ttl = app.config.get('ADMIN_TOTALS_TTL', 300)
+	key = fragment_key('admin_totals', 'all', int(time.time() // ttl))
+	totals = fragment_cache.get(key)
+	if totals == None:
+		totals = dbm.system_totals()
+		totals['counted_at'] = datetime.utcnow().strftime('%Y-%m-%d %H:%M UTC')
+		fragment_cache.set(key, totals, timeout=ttl)
+	return totals
+
 @app.route('/admin/', methods=['GET', 'POST'])
 def admin():
 
 	if lm.check_login(session):
-		user = dbm.get_user_by_id(session['userid'])
+		user = lm.current_user()
 	else: 
 		return redirect(url_for('login'))
 
 	if user.role == "admin":
-		try:
-			users = User.query.all()
-		except:
-			users = None
-		return render_template('admin.html', username=user.username, users=users, role=user.role)
+		search = request.args.get('q', '').strip()
+		users, nextid = dbm.users_page(search, request.args.get('after', type=int))
+		return render_template('admin.html', username=user.username, users=users, role=user.role, search=search,
+			nextid=nextid, stats=dbm.user_stats([u.id for u in users]), totals=cached_totals(),
+			profile=profile_window.snapshot(), profile_buckets=PROFILE_BUCKETS,
+			profile_rate=app.config.get('PROFILE_SAMPLE_RATE', 0), profile_window=app.config.get('PROFILE_WINDOW', 900))
 
 	return redirect(url_for('home'))
 
 @app.route('/admin/reset_db/')
 def reset_db():
 	if lm.check_login(session):
-		user = dbm.get_user_by_id(session['userid'])
+		user = lm.current_user()
 	if user.role == "admin":
 		db.session.commit()
 		db.drop_all()
 		db.create_all()
+		from migrations import stamp
+		stamp()
+		# ids and data versions start over, so fragments cached for the old rows would match new ones
+		fragment_cache.clear()
 		dbm.create_user("Admin", "testpass", "admin@piggy-bank.us", "admin")
 		user = User.query.filter_by(username="admin").first()
 		dbm.create_bank(user, "Test Bank")
@@ -783,30 +2404,17 @@ def reset_db():
 @app.route('/admin/generate_test_users/')
 def generate_test_users():
 	if lm.check_login(session):
-		user = dbm.get_user_by_id(session['userid'])
+		user = lm.current_user()
 	if user.role == "admin":
+		# ?users=3&banks=2&rows=50&seed=0; bigger loads belong in scripts/bench_routes.py
 		try:
-			dbm.create_user("testuser1", "testpass", "testemail1", "parent")
-			dbm.create_user("testuser2", "testpass", "testemail2", "parent")
-			dbm.create_user("testuser3", "testpass", "testemail3", "parent")
-		except:
-			pass
+			dbm.generate_test_data(request.args.get('users', 3, type=int), request.args.get('banks', 2, type=int),
+				request.args.get('rows', 50, type=int), seed=request.args.get('seed', 0, type=int))
+		except IntegrityError:
+			# this seed's users already exist
+			db.session.rollback()
 	return redirect(url_for('admin'))
 
-### Tasks
-@celery.task
-def pay_allowances():
-	date = datetime.utcnow().day
-	day = datetime.utcnow().weekday()
-	allowances = Allowance.query.all()
-	for allowance in allowances:
-		if allowance.active == True and allowance.piggybank != None:
-			if (allowance.frequency == "daily") or (allowance.frequency == "weekly" and allowance.payday == day) \
-			 or (allowance.frequency == "biweekly" and (date == 1 or date == 15)) \
-			 or (allowance.frequency == "monthly" and date == 1):
-				dbm.create_deposit(allowance.amount, allowance.piggybank, allowance.description)
-	return
-
 
 '''
 @csrf.error_handler
@@ -0,0 +1,120 @@
+"""Fingerprinted, precompressed static files.
+
+At startup every file under static/ is read once and named after a hash of its content
+(css/main.css -> css/main.3f2a9c1b7d4e.css). Text files are compressed once with gzip,
+and with brotli when the brotli module is installed. A hashed name never changes
+content, so app.asset serves these files with a one-year immutable Cache-Control.
+url() references inside stylesheets are rewritten to hashed URLs as well, so fonts
+and images are cached the same way. Files missing from the manifest still come from
+/static/. The manifest is built on first use, so processes that never serve a page skip
+the work; gunicorn_config.py builds it in the master before the workers fork.
+"""
+import hashlib
+import mimetypes
+import os
+import posixpath
+import re
+import threading
+import zlib
+
+COMPRESSIBLE = ('text/', 'application/javascript', 'application/json', 'application/x-javascript', 'image/svg+xml',
+	'application/x-font-ttf', 'application/vnd.ms-fontobject', 'font/ttf')
+CSS_URL = re.compile(r'''url\(\s*(['"]?)([^'")]+?)\1\s*\)''')
+
+
+def gzipped(data, level=9):
+	compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+	return compressor.compress(data) + compressor.flush()
+
+def brotli_compressed(data):
+	try:
+		import brotli
+	except ImportError:
+		return None
+	return brotli.compress(data)
+
+ENCODERS = (('br', brotli_compressed), ('gzip', gzipped))
+
+
+class Asset:
+	def __init__(self, name, data, mimetype):
+		self.name = name
+		self.digest = hashlib.sha1(data).hexdigest()
+		self.mimetype = mimetype
+		base, extension = posixpath.splitext(name)
+		self.hashed = '%s.%s%s' % (base, self.digest[:12], extension)
+		# body per Content-Encoding; a compressed body is kept only if it saves at least a tenth
+		self.bodies = {'identity': data}
+		if mimetype.startswith(COMPRESSIBLE):
+			for encoding, encode in ENCODERS:
+				body = encode(data)
+				if body != None and len(body) < len(data) * 0.9:
+					self.bodies[encoding] = body
+
+	def __repr__(self):
+		return '<Asset %r>' % self.hashed
+
+class AssetManifest:
+	def __init__(self, folder, static_url, asset_url):
+		self.folder = folder
+		self.static_url = static_url.rstrip('/')
+		self.asset_url = asset_url.rstrip('/')
+		self.by_name = None
+		self.by_hash = None
+		self.lock = threading.Lock()
+
+	def load(self):
+		if self.by_name != None:
+			return
+		with self.lock:
+			if self.by_name != None:
+				return
+			by_name = {}
+			by_hash = {}
+			names = []
+			for root, dirs, files in os.walk(self.folder):
+				for filename in files:
+					# editor backups and temp files
+					if filename.startswith('.') or '~' in filename or filename.endswith('.TMP'):
+						continue
+					names.append(os.path.relpath(os.path.join(root, filename), self.folder).replace(os.sep, '/'))
+			# stylesheets last, so the fonts and images they point at already have hashed names
+			for name in sorted(names, key=lambda name: (name.endswith('.css'), name)):
+				with open(os.path.join(self.folder, name), 'rb') as source:
+					data = source.read()
+				if name.endswith('.css'):
+					data = self.rewrite_css(name, data, by_name)
+				asset = Asset(name, data, mimetypes.guess_type(name)[0] or 'application/octet-stream')
+				by_name[name] = asset
+				by_hash[asset.hashed] = asset
+			self.by_hash = by_hash
+			self.by_name = by_name
+
+	def url(self, name, by_name=None):
+		if by_name == None:
+			self.load()
+			by_name = self.by_name
+		asset = by_name.get(name)
+		if asset == None:
+			return None
+		return '%s/%s' % (self.asset_url, asset.hashed)
+
+	def lookup(self, hashed):
+		self.load()
+		return self.by_hash.get(hashed)
+
+	def rewrite_css(self, name, data, by_name):
+		# url(../fonts/x.woff?#iefix) -> url(/assets/fonts/x.<hash>.woff?#iefix), resolved from where the
+		# stylesheet lives under /static/; external, data: and unknown URLs are left alone
+		base = posixpath.dirname('%s/%s' % (self.static_url, name))
+		def replace(match):
+			quote, reference = match.group(1), match.group(2)
+			path = re.split(r'[?#]', reference, 1)[0]
+			if ':' in path or path.startswith('//'):
+				return match.group(0)
+			target = posixpath.normpath(posixpath.join(base, path))
+			url = self.url(target[len(self.static_url) + 1:], by_name) if target.startswith(self.static_url + '/') else None
+			if url == None:
+				return match.group(0)
+			return 'url(%s%s%s%s)' % (quote, url, reference[len(path):], quote)
+		return CSS_URL.sub(replace, data.decode('utf-8')).encode('utf-8')
@@ -1,6 +1,8 @@
 import os
 from datetime import timedelta
-from celery.schedules import crontab
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+
 #CSRF Enable
 CSRF_ENABLED = True
 
@@ -10,26 +12,146 @@ SECRET_KEY = '393jfj39fjfj93jflallalal'
 #csrf time limit
 TIME_LIMIT = 86400
 
+#rows per page in the deposit and expense ledgers
+LEDGER_PAGE_SIZE = 50
+
+#banks with more deposits+expenses than this are deleted by a background task
+BANK_DELETE_ASYNC_ROWS = 10000
+
+#seconds a login session token stays valid
+SESSION_TOKEN_MAX_AGE = 1209600
+
+#rendered bank fragments: 'lru' (per process), 'redis' or 'memcached' (shared by all workers), or 'null'
+FRAGMENT_CACHE_TYPE = os.environ.get('FRAGMENT_CACHE_TYPE', 'lru')
+FRAGMENT_CACHE_URL = os.environ.get('FRAGMENT_CACHE_URL')
+#fragments kept by the lru backend
+FRAGMENT_CACHE_SIZE = 1000
+#seconds a shared backend keeps a fragment
+FRAGMENT_CACHE_TIMEOUT = 86400
+#change on deploys that alter templates, so a shared cache doesn't serve the old markup
+FRAGMENT_CACHE_PREFIX = os.environ.get('FRAGMENT_CACHE_PREFIX', '')
+
+#hashed, precompressed copies of static/ are served under this path with immutable caching
+ASSET_URL_PREFIX = '/assets'
+#HTML responses at least this big are gzipped for clients that accept it
+COMPRESS_MIN_BYTES = 1024
+COMPRESS_LEVEL = 6
+
+#most SQL statements each endpoint may run per request; see scripts/query_budget.py
+QUERY_BUDGETS = {
+	'banks': 3, 'navigationbar': 3, 'overview': 4, 'deposits': 3, 'expenses': 4, 'allowances': 3, 'settings': 2,
+	'analytics': 4, 'family_analytics': 4,
+	'add_deposit': 13, 'delete_deposit': 13, 'add_expense': 14, 'purchase_expense': 14, 'refund_expense': 14,
+	'delete_expense': 14, 'add_allowance': 8, 'toggle_allowance': 8, 'delete_allowance': 8, 'update_allowance': 6,
+	'rename_bank': 7, 'delete_bank': 14, 'admin': 7,
+	'api_add_deposit': 13, 'api_delete_deposit': 12, 'api_add_expense': 13, 'api_purchase_expense': 14,
+	'api_refund_expense': 14, 'api_delete_expense': 12, 'api_add_allowance': 8, 'api_toggle_allowance': 8,
+	'api_delete_allowance': 7, 'api_import_ledger': 28, 'api_import_status': 3, 'api_bank_forecast': 5,
+	'api_family_forecast': 5, 'set_timezone': 11, 'api_set_timezone': 10, 'api_recurring_expenses': 3,
+	'api_add_recurring_expense': 8, 'api_toggle_recurring_expense': 8, 'api_delete_recurring_expense': 7,
+}
+#raise QueryBudgetExceeded instead of logging a warning
+QUERY_BUDGET_STRICT = False
+
+#users per page of the /admin/ list
+ADMIN_PAGE_SIZE = 50
+#seconds the /admin/ system totals are cached
+ADMIN_TOTALS_TTL = 300
+
+#fraction of requests profiled (Server-Timing header, log line, /admin/ histograms); 0 turns it off
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+#seconds of profiles the /admin/ histograms cover, per process
+PROFILE_WINDOW = 900
+#slowest statements kept per profiled request
+PROFILE_SLOWEST = 3
+
+#ledger rows inserted per transaction by an import
+IMPORT_CHUNK = 1000
+#uploads bigger than this many bytes are imported by a worker instead of in the request
+IMPORT_ASYNC_BYTES = 262144
+#largest request body, uploads included
+MAX_CONTENT_LENGTH = 64 * 1024 * 1024
+#rows fetched per round trip while a ledger export streams
+EXPORT_BATCH = 1000
+
 
 #sqlalchemy database config for heroku
 if os.environ.get('DATABASE_URL') is None:
-	SQLALCHEMY_DATABASE_URI = "postgresql:///" + os.path.join(basedir, 'app.db')
+	SQLALCHEMY_DATABASE_URI = "sqlite:///" + os.path.join(basedir, 'app.db')
 else:
 	SQLALCHEMY_DATABASE_URI = os.environ['DATABASE_URL']
 
-#celery config
+#Postgres connections the web dyno may hold, split between its gunicorn workers (see gunicorn_config.py).
+#A gevent worker runs many requests at once; the ones beyond its pool wait up to SQLALCHEMY_POOL_TIMEOUT
+#seconds for a connection instead of opening more than the database allows. SQLite's pools take none
+#of these options, so local and script databases keep Flask-SQLAlchemy's defaults
+WEB_CONCURRENCY = int(os.environ.get('WEB_CONCURRENCY', 2))
+DATABASE_CONNECTIONS = int(os.environ.get('DATABASE_CONNECTIONS', 16))
+if not SQLALCHEMY_DATABASE_URI.startswith('sqlite'):
+	SQLALCHEMY_POOL_SIZE = max(1, DATABASE_CONNECTIONS // WEB_CONCURRENCY * 3 // 4)
+	SQLALCHEMY_MAX_OVERFLOW = max(0, DATABASE_CONNECTIONS // WEB_CONCURRENCY - SQLALCHEMY_POOL_SIZE)
+	SQLALCHEMY_POOL_TIMEOUT = 10
+	#seconds before a pooled connection is replaced, under Heroku's idle-connection cutoff
+	SQLALCHEMY_POOL_RECYCLE = 300
+
+#celery config; without CLOUDAMQP_URL (local runs, tools) tasks run in the process that queues them
 
-BROKER_URL=os.environ['CLOUDAMQP_URL'] 
+BROKER_URL = os.environ.get('CLOUDAMQP_URL')
 BROKER_VHOST = '/'
-CELERY_RESULT_BACKEND=os.environ['CLOUDAMQP_URL']
-CELERY_ALWAYS_EAGER = False
+CELERY_RESULT_BACKEND = BROKER_URL
+CELERY_ALWAYS_EAGER = BROKER_URL is None
+#crontab fields; tasks.make_celery turns them into schedules
 CELERYBEAT_SCHEDULE = {
-    'pay-allowances': {
-        'task': 'app.pay_allowances',
-        'schedule': crontab(minute=0, hour=0),   #or timedelta(days=1)
+    'run-schedules': {
+        'task': 'tasks.run_schedules',
+        'schedule': {'minute': 0},   #hourly; only items whose next_run_at has passed are touched
+        'args': ()
+    	},
+    'reconcile': {
+        'task': 'tasks.reconcile_task',
+        'schedule': {'minute': 15, 'hour': 4},   #nightly; only banks written since the last pass are checked
+        'args': ()
+    	},
+    'send-statements': {
+        'task': 'tasks.send_statements',
+        'schedule': {'minute': 30, 'hour': 6, 'day_of_week': 1},   #Monday morning, for the week to Sunday
         'args': ()
     	},
 	}
+CELERYBEAT_SCHEDULER = 'tasks.DatabaseScheduler'
+#seconds a beat leader's lease lasts without renewal; standby schedulers take over after this
+BEAT_LOCK_TTL = 30
 BROKER_POOL_LIMIT = 1
 
+#due allowances/recurring expenses run per bulk insert/balance update
+SCHEDULE_CHUNK = 1000
+#bank-id range shards run_schedules fans out to, one task each
+SCHEDULE_SHARDS = 8
+
 CELERY_TIMEZONE = 'UTC'
+
+#outgoing mail; `python -m smtpd -n -c DebuggingServer localhost:1025` with MAIL_PORT=1025 prints instead of sending
+MAIL_SERVER = os.environ.get('MAIL_SERVER', 'localhost')
+MAIL_PORT = int(os.environ.get('MAIL_PORT', 25))
+MAIL_USE_TLS = os.environ.get('MAIL_USE_TLS') == '1'
+MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
+MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
+MAIL_DEFAULT_SENDER = os.environ.get('MAIL_DEFAULT_SENDER', 'statements@piggy-bank.us')
+#messages sent over one SMTP connection before reconnecting; most servers cap a session
+MAIL_MAX_EMAILS = 500
+#weeks and months of totals on the analytics tab
+ANALYTICS_WEEKS = 12
+ANALYTICS_MONTHS = 12
+#banks whose rollups backfill_rollups rebuilds per transaction
+ROLLUP_BACKFILL_CHUNK = 500
+
+#days a balance forecast covers by default, and at most
+FORECAST_DAYS = 365
+FORECAST_MAX_DAYS = 730
+
+#banks checked per reconcile transaction
+RECONCILE_CHUNK = 500
+#parents whose weekly statements are built per set of queries
+STATEMENT_BATCH = 200
+#user-id range shards send_statements fans out to, one SMTP connection each
+STATEMENT_SHARDS = 4
@@ -0,0 +1,62 @@
+"""Balance forecasts.
+
+Every active allowance of a set of banks is laid out over a horizon of days as NumPy
+arrays, using the paydays app.is_payday pays on. One boolean array is built per
+(frequency, payday) rule and shared by every allowance on that rule. Each bank's
+projected balance is then its opening balance plus a cumulative sum of its payouts,
+computed for all the banks at once. Pending expenses are taken out up front, as if
+bought today. Amounts are integer cents, so the curves add up exactly. Nothing here
+touches the database; DBManager.forecasts does.
+"""
+import numpy as np
+
+
+def days_from(start, horizon):
+	# datetime64[D] days start, start + 1, ... for `horizon` days
+	return np.datetime64(start, 'D') + np.arange(horizon)
+
+def payday_mask(frequency, payday, days):
+	# app.is_payday over an array of days: daily; weekly on payday (0 = Monday); biweekly on the 1st
+	# and 15th; monthly on the 1st
+	if frequency == 'daily':
+		return np.ones(len(days), dtype=bool)
+	if frequency == 'weekly':
+		# like is_payday, no weekday matches a missing payday; np.equal keeps the comparison per element,
+		# where `array == None` is a single False on older NumPy
+		if payday == None:
+			return np.zeros(len(days), dtype=bool)
+		# 1970-01-01, day 0, was a Thursday
+		return np.equal((days.astype('int64') + 3) % 7, int(payday))
+	day_of_month = (days - days.astype('datetime64[M]')).astype('int64') + 1
+	if frequency == 'biweekly':
+		return (day_of_month == 1) | (day_of_month == 15)
+	if frequency == 'monthly':
+		return day_of_month == 1
+	return np.zeros(len(days), dtype=bool)
+
+def project(openings, allowances, start, horizon, goals=None):
+	# openings: {bank: cents}; allowances: [(bank, cents, frequency, payday, first payday as a date or None)];
+	# goals: {bank: cents}. Returns (banks, days, curves, reached): curves[i, d] is bank i's balance at the end
+	# of days[d], and reached[i] the first day index at or above its goal, or -1.
+	banks = sorted(openings)
+	row = dict((bank, index) for index, bank in enumerate(banks))
+	days = days_from(start, horizon)
+	payouts = np.zeros((len(banks), horizon), dtype=np.int64)
+	if allowances:
+		masks = {}
+		for bank, cents, frequency, payday, first in allowances:
+			if (frequency, payday) not in masks:
+				masks[(frequency, payday)] = payday_mask(frequency, payday, days)
+		schedule = np.array([masks[(frequency, payday)] for bank, cents, frequency, payday, first in allowances])
+		firsts = np.array([np.datetime64(first or start, 'D') for bank, cents, frequency, payday, first in allowances])
+		schedule &= days[np.newaxis, :] >= firsts[:, np.newaxis]
+		amounts = np.array([cents for bank, cents, frequency, payday, first in allowances], dtype=np.int64)
+		# several allowances of one bank add up into its row
+		np.add.at(payouts, np.array([row[allowance[0]] for allowance in allowances]), schedule * amounts[:, np.newaxis])
+	curves = np.array([openings[bank] for bank in banks], dtype=np.int64)[:, np.newaxis] + np.cumsum(payouts, axis=1)
+	reached = np.zeros(len(banks), dtype=np.int64) - 1
+	if goals:
+		targets = np.array([goals.get(bank, np.iinfo(np.int64).max) for bank in banks], dtype=np.int64)
+		hit = curves >= targets[:, np.newaxis]
+		reached = np.where(hit.any(axis=1), hit.argmax(axis=1), -1)
+	return banks, days, curves, reached
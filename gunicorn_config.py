@@ -0,0 +1,40 @@
+"""gunicorn settings for the web dyno.
+
+	gunicorn -c gunicorn_config.py app:app
+
+WEB_WORKER_CLASS picks the worker type. 'gevent' (the default) serves up to
+WEB_WORKER_CONNECTIONS requests at once per worker, switching greenlets whenever one waits
+on Postgres. psycogreen makes psycopg2 yield instead of blocking the whole worker. 'sync'
+serves one request per worker at a time. WEB_CONCURRENCY is the number of worker processes;
+config.py splits DATABASE_CONNECTIONS between them for the SQLAlchemy pool.
+python scripts/bench_serving.py compares the two modes.
+"""
+import os
+
+worker_class = os.environ.get('WEB_WORKER_CLASS', 'gevent')
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+worker_connections = int(os.environ.get('WEB_WORKER_CONNECTIONS', 100))
+bind = '0.0.0.0:%s' % os.environ.get('PORT', '8000')
+timeout = 30
+errorlog = '-'
+# the app (templates, asset manifest) is built once in the master and shared copy-on-write
+preload_app = True
+
+if worker_class == 'gevent':
+	# patch before the preloaded app creates its locks and sockets, not after the fork
+	from gevent import monkey
+	monkey.patch_all()
+	from psycogreen.gevent import patch_psycopg
+	patch_psycopg()
+
+
+def when_ready(server):
+	# hash and compress static/ once, before the workers fork and share it
+	from app import assets
+	assets.load()
+
+
+def post_fork(server, worker):
+	# connections opened in the master while preloading must not be shared between workers
+	from app import db
+	db.engine.dispose()
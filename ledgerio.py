@@ -0,0 +1,244 @@
+"""Ledger files in and out.
+
+The parsers turn a CSV or OFX file into plain deposit/expense dicts without ever holding
+the whole file: input is an iterable of byte chunks and rows come out one at a time.
+The writers do the reverse for exports, one line per row. Nothing here touches the
+database; DBManager.import_rows and DBManager.ledger_rows do.
+
+	python ledgerio.py import <bank id> <file> [csv|ofx]
+
+CSV files need a header row with date and amount columns; type (deposit or expense),
+name and description are optional. Without a type, positive amounts are deposits and
+negative amounts are purchased expenses. Exported CSV files import back as they are.
+"""
+import codecs
+import csv
+import json
+import re
+import sys
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+FORMATS = ('csv', 'ofx')
+EXPORT_FORMATS = {'csv': 'text/csv', 'jsonl': 'application/x-ndjson'}
+EXPORT_COLUMNS = ('date', 'type', 'amount', 'name', 'description', 'bank')
+CHUNK_BYTES = 65536
+MAX_AMOUNT = Decimal('99999999.99') # Numeric(10,2)
+DATE_FORMATS = ('%Y-%m-%d', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%m/%d/%Y', '%Y%m%d')
+
+
+class LedgerFormatError(ValueError):
+	def __init__(self, row, message):
+		ValueError.__init__(self, 'row %d: %s' % (row, message))
+		self.row = row
+
+class Rejects:
+	# rows a read skipped: all of them counted, the first few kept for the report
+	def __init__(self, keep=20):
+		self.count = 0
+		self.messages = []
+		self.keep = keep
+
+	def add(self, message):
+		self.count += 1
+		if len(self.messages) < self.keep:
+			self.messages.append(message)
+
+
+### Input
+def read_chunks(stream, size=CHUNK_BYTES):
+	while True:
+		data = stream.read(size)
+		if not data:
+			return
+		yield data
+
+def guess_format(filename):
+	if filename and filename.lower().endswith(('.ofx', '.qfx')):
+		return 'ofx'
+	return 'csv'
+
+def batches(rows, size):
+	batch = []
+	for row in rows:
+		batch.append(row)
+		if len(batch) >= size:
+			yield batch
+			batch = []
+	if batch:
+		yield batch
+
+def decoded(chunks):
+	# text pieces; a character split across two chunks is put back together, a BOM dropped
+	decoder = codecs.getincrementaldecoder('utf-8-sig')('replace')
+	for data in chunks:
+		text = decoder.decode(data)
+		if text:
+			yield text
+	text = decoder.decode(b'', True)
+	if text:
+		yield text
+
+def lines(chunks):
+	pending = ''
+	for text in decoded(chunks):
+		parts = (pending + text).split('\n')
+		pending = parts.pop()
+		for line in parts:
+			yield line + '\n'
+	if pending:
+		yield pending
+
+
+### Parsers
+def csv_records(chunks):
+	# the csv module reads text on Python 3 and utf-8 bytes on Python 2
+	if sys.version_info[0] >= 3:
+		return csv.reader(lines(chunks))
+	return ([cell.decode('utf-8') for cell in record] for record in csv.reader(line.encode('utf-8') for line in lines(chunks)))
+
+def parse_csv(chunks):
+	records = csv_records(chunks)
+	header = next(records, None)
+	if header == None:
+		return
+	columns = dict((name.strip().lower(), index) for index, name in enumerate(header))
+	if 'date' not in columns or 'amount' not in columns:
+		raise LedgerFormatError(1, "the header needs date and amount columns")
+	row = 1
+	for record in records:
+		row += 1
+		if not any(cell.strip() for cell in record):
+			continue
+		yield row, dict((name, record[index].strip()) for name, index in columns.items() if index < len(record))
+
+OFX_TAG = re.compile(r'<(/?)([A-Za-z0-9.]+)>([^<]*)')
+
+def ofx_tokens(chunks):
+	# (closing, tag, value) for every tag; text is scanned up to the last '<' seen so far,
+	# so a tag cut in half by a chunk boundary waits for the next chunk
+	pending = ''
+	for text in decoded(chunks):
+		pending += text
+		cut = pending.rfind('<')
+		if cut <= 0:
+			continue
+		for match in OFX_TAG.finditer(pending, 0, cut):
+			yield match.group(1) == '/', match.group(2).upper(), match.group(3).strip()
+		pending = pending[cut:]
+	for match in OFX_TAG.finditer(pending):
+		yield match.group(1) == '/', match.group(2).upper(), match.group(3).strip()
+
+def parse_ofx(chunks):
+	# OFX 1.x (SGML, leaf tags left open) and 2.x (XML): one row per <STMTTRN> aggregate
+	transaction = None
+	row = 0
+	for closing, tag, value in ofx_tokens(chunks):
+		if tag == 'STMTTRN':
+			if closing and transaction != None:
+				row += 1
+				yield row, {'date': transaction.get('DTPOSTED', '')[:8], 'amount': transaction.get('TRNAMT'),
+					'name': transaction.get('NAME') or transaction.get('PAYEE', ''), 'description': transaction.get('MEMO', '')}
+			transaction = None if closing else {}
+		elif transaction != None and not closing:
+			transaction[tag] = value
+
+PARSERS = {'csv': parse_csv, 'ofx': parse_ofx}
+
+
+### Validation
+def parse_amount(row, value):
+	try:
+		amount = Decimal((value or '').replace('$', '').replace(',', '')).quantize(Decimal('0.01'))
+	except InvalidOperation:
+		raise LedgerFormatError(row, "%r is not an amount" % value)
+	if amount == 0 or abs(amount) > MAX_AMOUNT:
+		raise LedgerFormatError(row, "amount %s is out of range" % amount)
+	return amount
+
+def parse_date(row, value):
+	for pattern in DATE_FORMATS:
+		try:
+			return datetime.strptime(value or '', pattern)
+		except ValueError:
+			pass
+	raise LedgerFormatError(row, "%r is not a date" % value)
+
+def ledger_row(row, raw):
+	# raw strings from either format -> {'kind', 'date', 'amount', 'name', 'description'}, amount positive
+	amount = parse_amount(row, raw.get('amount'))
+	kind = (raw.get('type') or '').lower()
+	if kind == '':
+		kind = 'deposit' if amount > 0 else 'expense'
+	elif kind not in ('deposit', 'expense'):
+		raise LedgerFormatError(row, "type must be deposit or expense, not %r" % kind)
+	description = raw.get('description') or ''
+	name = raw.get('name') or description
+	if kind == 'expense' and name == '':
+		raise LedgerFormatError(row, "an expense needs a name or description")
+	return {'kind': kind, 'date': parse_date(row, raw.get('date')), 'amount': abs(amount), 'name': name[:80],
+		'description': description}
+
+def read_ledger(chunks, format, rejects):
+	# valid rows of a ledger file; rows that fail validation are skipped and added to rejects
+	for row, raw in PARSERS[format](chunks):
+		try:
+			yield ledger_row(row, raw)
+		except LedgerFormatError as exc:
+			rejects.add(str(exc))
+
+
+### Output
+class LineBuffer:
+	# what csv.writer writes for one row, collected so it can be yielded
+	def __init__(self):
+		self.parts = []
+
+	def write(self, data):
+		self.parts.append(data)
+
+	def pop(self):
+		line = ''.join(self.parts)
+		self.parts = []
+		return line
+
+def export_record(row):
+	# (date, type, amount, name, description, bank) from DBManager.ledger_rows -> text cells
+	date, kind, amount, name, description, bank = row
+	return (date.strftime('%Y-%m-%d %H:%M:%S') if date != None else '', kind, '%.2f' % amount, name or '', description or '', bank or '')
+
+def csv_lines(rows):
+	buffer = LineBuffer()
+	writer = csv.writer(buffer)
+	py2 = sys.version_info[0] < 3
+	writer.writerow(EXPORT_COLUMNS)
+	yield buffer.pop()
+	for row in rows:
+		cells = export_record(row)
+		if py2:
+			cells = [cell.encode('utf-8') for cell in cells]
+		writer.writerow(cells)
+		yield buffer.pop()
+
+def json_lines(rows):
+	for row in rows:
+		yield json.dumps(dict(zip(EXPORT_COLUMNS, export_record(row))), sort_keys=True) + '\n'
+
+WRITERS = {'csv': csv_lines, 'jsonl': json_lines}
+
+
+if __name__ == '__main__':
+	if len(sys.argv) < 4 or sys.argv[1] != 'import':
+		sys.exit(__doc__)
+	from app import dbm, PiggyBank
+	bank = PiggyBank.query.get(int(sys.argv[2]))
+	if bank == None:
+		sys.exit('no bank %s' % sys.argv[2])
+	format = sys.argv[4] if len(sys.argv) > 4 else guess_format(sys.argv[3])
+	rejects = Rejects()
+	with open(sys.argv[3], 'rb') as upload:
+		count = dbm.import_rows(bank.id, bank.user, read_ledger(read_chunks(upload), format, rejects),
+			progress=lambda imported: sys.stdout.write('%d rows imported\n' % imported))
+	for message in rejects.messages:
+		print(message)
+	print('%d rows imported, %d skipped' % (count, rejects.count))
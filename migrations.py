@@ -0,0 +1,178 @@
+"""Versioned schema migrations.
+
+The app creates fresh databases with db.create_all() (see /admin/reset_db/) and
+stamps them with the latest version. Existing databases are brought up to date
+by running each migration newer than the version recorded in schema_version:
+
+	python migrations.py            # upgrade to the latest version
+	python migrations.py current    # print the recorded version
+	python migrations.py stamp      # record the latest version without running anything
+
+Every step checks the live schema before changing it, so running a step against
+a database that already has its tables, columns or indexes is harmless.
+"""
+import sys
+
+from sqlalchemy import Table, Column, Integer, MetaData, inspect, func
+
+from app import db, LEDGER_EPOCH, User, PiggyBank, Allowance, Deposit, Expense, RecurringExpense, BeatLock, BeatEntry, \
+	LedgerImport, LedgerImportChunk, LedgerRollup
+
+metadata = MetaData()
+schema_version = Table('schema_version', metadata, Column('version', Integer, nullable=False))
+
+
+def add_column(conn, model, name):
+	table = model.__table__
+	if name in [column['name'] for column in inspect(conn).get_columns(table.name)]:
+		return
+	column = table.c[name]
+	conn.execute('ALTER TABLE %s ADD COLUMN %s %s' % (conn.dialect.identifier_preparer.format_table(table),
+		conn.dialect.identifier_preparer.format_column(column), column.type.compile(dialect=conn.dialect)))
+
+def create_index(conn, model, name):
+	table = model.__table__
+	if name in [index['name'] for index in inspect(conn).get_indexes(table.name)]:
+		return
+	[index for index in table.indexes if index.name == name][0].create(conn)
+
+def create_table(conn, model):
+	model.__table__.create(conn, checkfirst=True)
+
+def set_not_null(conn, model, name):
+	# SQLite can't alter a column; there the app's writes keep it filled
+	if conn.dialect.name == 'sqlite':
+		return
+	table = model.__table__
+	conn.execute('ALTER TABLE %s ALTER COLUMN %s SET NOT NULL' % (conn.dialect.identifier_preparer.format_table(table),
+		conn.dialect.identifier_preparer.format_column(table.c[name])))
+
+
+def allowance_payout_keys(conn):
+	add_column(conn, Deposit, 'allowance_id')
+	add_column(conn, Deposit, 'pay_date')
+	create_index(conn, Deposit, 'uq_deposit_allowance_pay_date')
+
+def beat_lock(conn):
+	create_table(conn, BeatLock)
+	create_table(conn, BeatEntry)
+
+def recurrence(conn):
+	add_column(conn, User, 'timezone')
+	add_column(conn, Allowance, 'next_run_at')
+	add_column(conn, Expense, 'recurring_expense_id')
+	add_column(conn, Expense, 'pay_date')
+	create_index(conn, Expense, 'uq_expense_recurring_pay_date')
+	create_table(conn, RecurringExpense)
+
+def session_versions(conn):
+	add_column(conn, User, 'session_version')
+
+def ledger_indexes(conn):
+	create_index(conn, User, 'ix_user_parent_id')
+	create_index(conn, PiggyBank, 'ix_piggybank_user_id')
+	create_index(conn, Allowance, 'ix_allowance_bank_id')
+	create_index(conn, Allowance, 'ix_allowance_active_next_run')
+	create_index(conn, RecurringExpense, 'ix_recurring_expense_bank_id')
+	create_index(conn, RecurringExpense, 'ix_recurring_expense_active_next_run')
+	create_index(conn, Deposit, 'ix_deposit_bank_date')
+	create_index(conn, Expense, 'ix_expense_bank_purchased_date')
+	create_index(conn, Expense, 'ix_expense_bank_pending_added')
+
+def data_versions(conn):
+	add_column(conn, User, 'data_version')
+	add_column(conn, PiggyBank, 'data_version')
+
+def ledger_imports(conn):
+	create_table(conn, LedgerImport)
+	create_table(conn, LedgerImportChunk)
+
+def reconciled_versions(conn):
+	add_column(conn, PiggyBank, 'reconciled_version')
+
+def ledger_rollups(conn):
+	# filled by DBManager.backfill_rollups (backfill_rollups_task), not here
+	create_table(conn, LedgerRollup)
+
+def ledger_dates(conn):
+	# Keyset pages sort on the raw date columns to use their indexes, so none may be NULL. Undated
+	# rows become LEDGER_EPOCH (oldest); a purchase without a date takes the day it was added.
+	# Run backfill_rollups_task afterwards so the rollups count these rows too.
+	deposits = Deposit.__table__
+	expenses = Expense.__table__
+	conn.execute(deposits.update().where(deposits.c.date_deposited == None).values(date_deposited=LEDGER_EPOCH))
+	conn.execute(expenses.update().where(expenses.c.date_added == None)
+		.values(date_added=func.coalesce(expenses.c.date_purchased, LEDGER_EPOCH)))
+	conn.execute(expenses.update().where(expenses.c.purchased == True).where(expenses.c.date_purchased == None)
+		.values(date_purchased=expenses.c.date_added))
+	set_not_null(conn, Deposit, 'date_deposited')
+	set_not_null(conn, Expense, 'date_added')
+
+def weekly_paydays(conn):
+	# Editing an allowance used to clear its payday, leaving a weekly one with no next run. They get
+	# Monday, the default for new ones, and the next run_schedules gives them a next_run_at
+	# (DBManager.schedule_unscheduled).
+	for model in (Allowance, RecurringExpense):
+		table = model.__table__
+		conn.execute(table.update().where(table.c.payday == None).values(payday=0))
+
+# (version, step); append new steps, never reorder or edit released ones
+MIGRATIONS = [
+	(1, allowance_payout_keys),
+	(2, beat_lock),
+	(3, recurrence),
+	(4, session_versions),
+	(5, ledger_indexes),
+	(6, data_versions),
+	(7, ledger_imports),
+	(8, reconciled_versions),
+	(9, ledger_rollups),
+	(10, ledger_dates),
+	(11, weekly_paydays),
+]
+
+HEAD = MIGRATIONS[-1][0]
+
+
+def current(conn):
+	schema_version.create(conn, checkfirst=True)
+	version = conn.execute(schema_version.select()).scalar()
+	return version or 0
+
+def set_version(conn, version):
+	conn.execute(schema_version.delete())
+	conn.execute(schema_version.insert().values(version=version))
+
+def upgrade(engine=None, target=HEAD, log=None):
+	engine = engine or db.engine
+	with engine.begin() as conn:
+		version = current(conn)
+	for step_version, step in MIGRATIONS:
+		if version < step_version <= target:
+			# each step and its version bump commit together
+			with engine.begin() as conn:
+				step(conn)
+				set_version(conn, step_version)
+			if log:
+				log('migrated to %d (%s)' % (step_version, step.__name__))
+	return target
+
+def stamp(engine=None, version=HEAD):
+	engine = engine or db.engine
+	with engine.begin() as conn:
+		current(conn)
+		set_version(conn, version)
+	return version
+
+
+if __name__ == '__main__':
+	command = sys.argv[1] if len(sys.argv) > 1 else 'upgrade'
+	if command == 'upgrade':
+		upgrade(log=lambda line: sys.stdout.write(line + '\n'))
+	elif command == 'stamp':
+		stamp()
+	elif command == 'current':
+		with db.engine.begin() as conn:
+			print(current(conn))
+	else:
+		sys.exit(__doc__)
@@ -0,0 +1,82 @@
+"""Run several would-be beat schedulers against one database and check that the
+beat lock only ever has one holder.
+
+	python scripts/beat_lock_check.py --database sqlite:////tmp/beatlock.db --workers 4
+
+Each worker process tries to take the lease every --interval seconds. Halfway
+through, the current leader stops renewing (as if its dyno died) and the script
+reports how long the others took to fail over.
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+def contend(name, ttl, interval, until, events, crash_at):
+	from app import dbm
+	owner = 'worker-%d' % os.getpid()
+	while time.time() < until:
+		if dbm.acquire_lock(name, owner, ttl):
+			events.put((time.time(), owner))
+			if time.time() >= crash_at:
+				return # the leader dies without releasing the lease
+		time.sleep(interval)
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+	parser.add_argument('--database', default='sqlite:////tmp/beatlock.db')
+	parser.add_argument('--workers', type=int, default=4)
+	parser.add_argument('--ttl', type=float, default=2)
+	parser.add_argument('--interval', type=float, default=0.2)
+	parser.add_argument('--duration', type=float, default=10)
+	args = parser.parse_args()
+
+	os.environ['DATABASE_URL'] = args.database
+	os.environ.setdefault('CLOUDAMQP_URL', 'memory://')
+	from app import db, BeatLock
+	BeatLock.__table__.create(db.engine, checkfirst=True)
+	db.session.execute(BeatLock.__table__.delete())
+	db.session.commit()
+	db.session.remove()
+	db.engine.dispose()
+
+	start = time.time()
+	events = multiprocessing.Queue()
+	workers = [multiprocessing.Process(target=contend, args=('beat-lock-check', args.ttl, args.interval,
+		start + args.duration, events, start + args.duration / 2)) for i in range(args.workers)]
+	for worker in workers:
+		worker.start()
+	for worker in workers:
+		worker.join()
+
+	timeline = []
+	while not events.empty():
+		timeline.append(events.get())
+	timeline.sort()
+
+	overlaps = 0
+	failovers = []
+	for (prev_at, prev_owner), (at, owner) in zip(timeline, timeline[1:]):
+		if owner != prev_owner:
+			# a new leader is only allowed once the old lease has run out
+			if at - prev_at < args.ttl:
+				overlaps += 1
+			failovers.append(at - prev_at)
+
+	leaders = sorted(set(owner for at, owner in timeline))
+	print('%d lease renewals by %d leader(s): %s' % (len(timeline), len(leaders), ', '.join(leaders)))
+	for gap in failovers:
+		print('failover after %.2fs (ttl %.2fs)' % (gap, args.ttl))
+	if overlaps:
+		print('FAILED: %d overlapping leases' % overlaps)
+		sys.exit(1)
+	print('ok: never more than one leader')
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,150 @@
+"""Show query plans and timings for the ledger access paths before and after the
+composite indexes added by the ledger_indexes migration.
+
+	python scripts/bench_indexes.py --database sqlite:////tmp/bench.db --banks 200 --rows 2000
+
+The database is dropped and rebuilt: create_all() without the ledger indexes,
+loaded with --rows deposits and --rows expenses per bank, measured, then
+upgraded with the migration and measured again. The ledger pages are fetched through
+dbm.deposits_page, dbm.pending_expenses_page and dbm.purchased_expenses_page, the calls
+the views make, and each is also measured one page in, following the first page's cursor.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+def load(db, banks, rows):
+	from werkzeug.security import generate_password_hash
+	from app import User, PiggyBank, Allowance, Deposit, Expense
+	random.seed(7)
+	now = datetime.utcnow()
+	password = generate_password_hash('testpass')
+	db.session.execute(User.__table__.insert(), [{'username': 'bench%d' % i, 'password': password,
+		'email': 'bench%d@example.com' % i, 'role': 'parent', 'active': True} for i in range(banks // 5 + 1)])
+	users = [row[0] for row in db.session.query(User.id)]
+	db.session.execute(PiggyBank.__table__.insert(), [{'name': 'Bank %d' % i, 'current_balance': 0,
+		'user_id': users[i % len(users)]} for i in range(banks)])
+	bank_ids = [row[0] for row in db.session.query(PiggyBank.id)]
+	db.session.execute(Allowance.__table__.insert(), [{'amount': 5, 'frequency': 'weekly', 'payday': i % 7,
+		'active': i % 3 != 0, 'bank_id': bank_id, 'next_run_at': now + timedelta(hours=random.randint(-24, 24 * 7))}
+		for i, bank_id in enumerate(bank_ids)])
+	for bank_id in bank_ids:
+		db.session.execute(Deposit.__table__.insert(), [{'bank_id': bank_id, 'amount_deposited': random.randint(1, 20),
+			'date_deposited': now - timedelta(minutes=random.randint(0, 525600)), 'description': ''} for i in range(rows)])
+		expenses = []
+		for i in range(rows):
+			added = now - timedelta(minutes=random.randint(0, 525600))
+			purchased = random.random() < 0.8
+			expenses.append({'bank_id': bank_id, 'name': 'thing %d' % i, 'price': random.randint(1, 20), 'date_added': added,
+				'purchased': purchased, 'date_purchased': added + timedelta(days=1) if purchased else None})
+		db.session.execute(Expense.__table__.insert(), expenses)
+	db.session.commit()
+	return bank_ids, users
+
+
+def access_paths(bank_id, user_id):
+	from sqlalchemy import desc
+	from app import dbm, PiggyBank, Allowance, Deposit, Expense
+	now = datetime.utcnow()
+	bank = PiggyBank.query.get(bank_id)
+	paths = [
+		('overview: recent purchases', Expense.query.filter(Expense.bank_id == bank_id).filter(Expense.purchased == True)
+			.order_by(desc(Expense.date_purchased)).limit(5).all),
+		('overview: recent deposits', Deposit.query.filter(Deposit.bank_id == bank_id).order_by(desc(Deposit.date_deposited))
+			.limit(5).all),
+	]
+	for name, page in (('deposits', dbm.deposits_page), ('expenses: pending', dbm.pending_expenses_page),
+			('expenses: purchased', dbm.purchased_expenses_page)):
+		cursor = page(bank)[1]
+		paths.append(('%s: first page' % name, lambda page=page: page(bank)))
+		if cursor != None:
+			paths.append(('%s: second page' % name, lambda page=page, cursor=cursor: page(bank, cursor)))
+	paths += [
+		('banks: by user', PiggyBank.query.filter(PiggyBank.user_id == user_id).order_by(PiggyBank.id).all),
+		('schedule: due allowances', Allowance.query.filter(Allowance.active == True).filter(Allowance.next_run_at <= now).all),
+	]
+	return paths
+
+
+def last_statement(db, run):
+	# the SQL and DBAPI parameters of the last statement run() sends
+	from sqlalchemy import event
+	statements = []
+	def record(conn, cursor, statement, parameters, context, executemany):
+		statements.append((statement, parameters))
+	event.listen(db.engine, 'before_cursor_execute', record)
+	try:
+		run()
+	finally:
+		event.remove(db.engine, 'before_cursor_execute', record)
+	return statements[-1]
+
+
+def explain(db, statement, params):
+	prefix = 'EXPLAIN QUERY PLAN ' if db.engine.dialect.name == 'sqlite' else 'EXPLAIN '
+	connection = db.engine.raw_connection()
+	try:
+		cursor = connection.cursor()
+		cursor.execute(prefix + statement, params)
+		return [' '.join(str(column) for column in row) for row in cursor.fetchall()]
+	finally:
+		connection.close()
+
+
+def measure(db, paths, repeat):
+	results = {}
+	for name, run in paths:
+		started = time.time()
+		for i in range(repeat):
+			run()
+		elapsed = (time.time() - started) / repeat * 1000
+		results[name] = (elapsed, explain(db, *last_statement(db, run)))
+	# end the session's read transaction so the migration can alter the tables
+	db.session.rollback()
+	return results
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+	parser.add_argument('--database', default='sqlite:////tmp/bench_indexes.db')
+	parser.add_argument('--banks', type=int, default=100)
+	parser.add_argument('--rows', type=int, default=1000)
+	parser.add_argument('--repeat', type=int, default=20)
+	args = parser.parse_args()
+
+	os.environ['DATABASE_URL'] = args.database
+	os.environ.setdefault('CLOUDAMQP_URL', 'memory://')
+	from app import db
+	import migrations
+
+	db.drop_all()
+	db.create_all()
+	with db.engine.begin() as conn:
+		for table in db.metadata.sorted_tables:
+			for index in table.indexes:
+				if index.name.startswith('ix_'):
+					index.drop(conn)
+	migrations.stamp(version=4)
+	started = time.time()
+	bank_ids, users = load(db, args.banks, args.rows)
+	print('loaded %d banks x %d deposits/expenses in %.1fs' % (args.banks, args.rows, time.time() - started))
+
+	paths = access_paths(bank_ids[len(bank_ids) // 2], users[len(users) // 2])
+	before = measure(db, paths, args.repeat)
+	migrations.upgrade()
+	after = measure(db, paths, args.repeat)
+
+	for name, run in paths:
+		print('\n%s: %.2fms -> %.2fms' % (name, before[name][0], after[name][0]))
+		print('  before: ' + '\n          '.join(before[name][1]))
+		print('  after:  ' + '\n          '.join(after[name][1]))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,184 @@
+"""Drive every route and the allowance task through the test client on a generated
+database and record latency percentiles and SQL statement counts.
+
+	python scripts/bench_routes.py --database sqlite:////tmp/bench_routes.db --users 50 --banks 3 --rows 500 \
+		--output after.json --compare before.json
+
+The database is dropped and loaded with dbm.generate_test_data (same --seed, same data).
+Every route is requested --repeat times as the first generated user. Fragment routes and
+forecasts are measured twice, cold (fragment cache cleared before each request) and warm.
+The allowance task runs last, one run_schedule_shard per shard, over the allowances the
+generator left due.
+Results are written as JSON; --compare prints the change against an earlier run.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# routes answered from the fragment cache, measured cold and warm
+CACHED = ('banks', 'navigationbar', 'overview', 'deposits', 'expenses', 'allowances', 'analytics', 'api_bank_forecast',
+	'api_family_forecast')
+
+
+def percentile(values, fraction):
+	# nearest rank on sorted values
+	index = int(round(fraction * (len(values) - 1)))
+	return values[index]
+
+
+def summary(latencies, queries):
+	latencies = sorted(latencies)
+	return {'count': len(latencies), 'mean_ms': sum(latencies) / len(latencies), 'p50_ms': percentile(latencies, 0.5),
+		'p90_ms': percentile(latencies, 0.9), 'p99_ms': percentile(latencies, 0.99), 'max_ms': latencies[-1],
+		'queries': max(queries)}
+
+
+def routes(bank_id, expense_id, allowance_id):
+	# (name, method, url, data); data may be a function of the iteration
+	bank = {'bankid': bank_id}
+	deposit = dict(bank, amount='3.00', description='bench')
+	expense = dict(bank, name='bench', price='1.50', description='bench')
+	allowance = dict(bank, amount='2.00', frequency='weekly', description='bench')
+	return [
+		('banks', 'GET', '/banks/', {}),
+		('navigationbar', 'GET', '/navigation/', bank),
+		('overview', 'GET', '/overview/', bank),
+		('deposits', 'GET', '/deposits/', bank),
+		('expenses', 'GET', '/expenses/', bank),
+		('allowances', 'GET', '/allowances/', bank),
+		('analytics', 'GET', '/analytics/', bank),
+		('family_analytics', 'GET', '/family/analytics/', {}),
+		('settings', 'POST', '/settings/', bank),
+		('export_bank', 'GET', '/banks/%d/export.csv' % bank_id, {}),
+		('api_bank_forecast', 'GET', '/api/v1/banks/%d/forecast?goal=500' % bank_id, {}),
+		('api_family_forecast', 'GET', '/api/v1/forecast?goal=500', {}),
+		('add_deposit', 'POST', '/adddeposit/', deposit),
+		('add_expense', 'POST', '/addexpense/', dict(expense, purchased='y')),
+		('purchase_expense', 'POST', '/purchaseexpense/', {'expenseid': expense_id}),
+		('refund_expense', 'POST', '/refundexpense/', {'expenseid': expense_id}),
+		('add_allowance', 'POST', '/addallowance/', allowance),
+		('toggle_allowance', 'POST', '/toggleallowance/', {'allowanceid': allowance_id}),
+		('update_allowance', 'POST', '/updateallowance/', dict(allowance, allowanceid=allowance_id)),
+		('rename_bank', 'POST', '/renamebank/', lambda i: {'bankid': bank_id, 'bankname': 'Bench %d' % i}),
+		('api_add_deposit', 'POST', '/api/v1/banks/%d/deposits' % bank_id, deposit),
+		('api_add_expense', 'POST', '/api/v1/banks/%d/expenses' % bank_id, expense),
+	]
+
+
+def compare(results, before):
+	print('\n%-24s %10s %10s %8s %8s' % ('', 'p50 before', 'p50 after', 'change', 'queries'))
+	for section in ('routes', 'tasks'):
+		for name in sorted(results[section]):
+			old = before.get(section, {}).get(name)
+			new = results[section][name]
+			if old == None:
+				print('%-24s %10s %10.2f %8s %8d' % (name, '-', new['p50_ms'], 'new', new['queries']))
+				continue
+			change = (new['p50_ms'] - old['p50_ms']) / old['p50_ms'] * 100 if old['p50_ms'] else 0
+			print('%-24s %10.2f %10.2f %+7.1f%% %3d -> %d' % (name, old['p50_ms'], new['p50_ms'], change,
+				old['queries'], new['queries']))
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+	parser.add_argument('--database', default='sqlite:////tmp/bench_routes.db')
+	parser.add_argument('--users', type=int, default=20)
+	parser.add_argument('--banks', type=int, default=3)
+	parser.add_argument('--rows', type=int, default=200)
+	parser.add_argument('--allowances', type=int, default=2)
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--repeat', type=int, default=50)
+	parser.add_argument('--output', default='bench_routes.json')
+	parser.add_argument('--compare')
+	args = parser.parse_args()
+
+	os.environ['DATABASE_URL'] = args.database
+	os.environ.setdefault('CLOUDAMQP_URL', 'memory://')
+	from sqlalchemy import event
+	from app import app, db, dbm, fragment_cache, PiggyBank, Expense, Allowance
+	from tasks import run_schedule_shard
+	import migrations
+	app.config.update(TESTING=True, WTF_CSRF_ENABLED=False)
+
+	db.drop_all()
+	db.create_all()
+	migrations.stamp()
+	started = time.time()
+	user_ids = dbm.generate_test_data(args.users, args.banks, args.rows, args.allowances, args.seed)
+	print('loaded %d users x %d banks x %d rows in %.1fs' % (args.users, args.banks, args.rows, time.time() - started))
+	bank_id = db.session.query(PiggyBank.id).filter(PiggyBank.user_id == user_ids[0]).order_by(PiggyBank.id).first()[0]
+	expense_id = db.session.query(Expense.id).filter(Expense.bank_id == bank_id).filter(Expense.purchased == False) \
+		.order_by(Expense.id).first()[0]
+	allowance_id = db.session.query(Allowance.id).filter(Allowance.bank_id == bank_id).order_by(Allowance.id).first()[0]
+	db.session.remove()
+
+	statements = [0]
+	def count(conn, cursor, statement, parameters, context, executemany):
+		statements[0] += 1
+	event.listen(db.engine, 'before_cursor_execute', count)
+
+	client = app.test_client()
+	client.post('/login/', data={'username': 'test%d_0' % args.seed, 'password': 'testpass'})
+	results = {'routes': {}, 'tasks': {}}
+	for name, method, url, data in routes(bank_id, expense_id, allowance_id):
+		passes = [(name, True)]
+		if name in CACHED:
+			passes = [(name + ' (cold)', True), (name + ' (warm)', False)]
+		for label, cold in passes:
+			latencies = []
+			queries = []
+			for i in range(args.repeat):
+				if cold:
+					fragment_cache.clear()
+				statements[0] = 0
+				started = time.time()
+				params = data(i) if callable(data) else data
+				# the fragment views read bankid from the query string on GET
+				if method == 'GET':
+					response = client.open(url, method=method, query_string=params)
+				else:
+					response = client.open(url, method=method, data=params)
+				response.get_data() # streamed responses run their queries here
+				latencies.append((time.time() - started) * 1000)
+				queries.append(statements[0])
+				if response.status_code >= 400:
+					sys.exit('%s answered %d' % (label, response.status_code))
+			results['routes'][label] = summary(latencies, queries)
+			print('%-24s p50 %7.2fms  p99 %7.2fms  %3d queries' % (label, results['routes'][label]['p50_ms'],
+				results['routes'][label]['p99_ms'], results['routes'][label]['queries']))
+
+	# the allowance task: one shard at a time, eagerly, as the worker would run them
+	now = datetime.utcnow().replace(microsecond=0)
+	latencies = []
+	queries = []
+	paid = 0
+	for first, last in dbm.due_shards('allowance', now, app.config.get('SCHEDULE_SHARDS', 8)):
+		statements[0] = 0
+		started = time.time()
+		paid += run_schedule_shard.apply(args=('allowance', first, last, now.strftime("%Y-%m-%dT%H:%M:%S"))).get()['count']
+		latencies.append((time.time() - started) * 1000)
+		queries.append(statements[0])
+	if latencies:
+		results['tasks']['run_schedule_shard (allowance)'] = dict(summary(latencies, queries), paid=paid)
+		print('%-24s %d shards, %d paid, p50 %.2fms per shard' % ('allowances', len(latencies), paid,
+			results['tasks']['run_schedule_shard (allowance)']['p50_ms']))
+
+	results['meta'] = {'started': now.strftime('%Y-%m-%dT%H:%M:%S'), 'database': db.engine.dialect.name,
+		'python': platform.python_version(), 'users': args.users, 'banks': args.banks, 'rows': args.rows,
+		'allowances': args.allowances, 'seed': args.seed, 'repeat': args.repeat}
+	with open(args.output, 'w') as output:
+		json.dump(results, output, indent=1, sort_keys=True)
+	print('wrote ' + args.output)
+	if args.compare:
+		with open(args.compare) as previous:
+			compare(results, json.load(previous))
+
+
+if __name__ == '__main__':
+	main()
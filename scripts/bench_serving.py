@@ -0,0 +1,145 @@
+"""Serve a generated database with gunicorn in sync and in gevent mode and load each one
+with concurrent logged-in clients.
+
+	python scripts/bench_serving.py --database postgresql:///piggybank_serving --clients 50 --seconds 20
+
+The database is dropped and loaded with dbm.generate_test_data. For each --modes entry
+gunicorn is started from gunicorn_config.py with WEB_WORKER_CLASS set to that mode and
+--workers processes. --clients threads then log in as the generated users, round-robin,
+and request that user's bank pages and forecasts for --seconds. Throughput, latency
+percentiles and errors are printed per mode. Run it against Postgres: SQLite has no
+network wait for gevent to overlap.
+"""
+import argparse
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+try:
+	from urllib.request import build_opener, HTTPCookieProcessor, Request
+	from urllib.parse import urlencode
+	from urllib.error import HTTPError
+	from http.cookiejar import CookieJar
+except ImportError:
+	from urllib2 import build_opener, HTTPCookieProcessor, Request, HTTPError
+	from urllib import urlencode
+	from cookielib import CookieJar
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+# read-only pages a signed-in parent loads; %d is one of their bank ids
+PAGES = ('/banks/', '/navigation/?bankid=%d', '/overview/?bankid=%d', '/deposits/?bankid=%d', '/expenses/?bankid=%d',
+	'/allowances/?bankid=%d', '/analytics/?bankid=%d', '/family/analytics/', '/api/v1/banks/%d/forecast?goal=500')
+CSRF_META = re.compile(r'name="csrf-token" content="([^"]+)"')
+
+
+def percentile(values, fraction):
+	# nearest rank on sorted values
+	index = int(round(fraction * (len(values) - 1)))
+	return values[index]
+
+
+def wait_for(port, seconds):
+	deadline = time.time() + seconds
+	while time.time() < deadline:
+		try:
+			socket.create_connection(('127.0.0.1', port), 1).close()
+			return True
+		except socket.error:
+			time.sleep(0.2)
+	return False
+
+
+def client(base, username, bank_ids, stop, latencies, errors):
+	opener = build_opener(HTTPCookieProcessor(CookieJar()))
+	token = CSRF_META.search(opener.open(base + '/login/').read().decode('utf-8')).group(1)
+	opener.open(Request(base + '/login/', urlencode({'username': username, 'password': 'testpass'}).encode('utf-8'),
+		{'X-CSRFToken': token}))
+	while not stop.is_set():
+		page = random.choice(PAGES)
+		url = base + (page % random.choice(bank_ids) if '%d' in page else page)
+		started = time.time()
+		try:
+			opener.open(url).read()
+			latencies.append((time.time() - started) * 1000)
+		except (HTTPError, socket.error):
+			errors.append(url)
+
+
+def run(mode, args, users, env):
+	env = dict(env, WEB_WORKER_CLASS=mode, WEB_CONCURRENCY=str(args.workers), PORT=str(args.port))
+	server = subprocess.Popen(['gunicorn', '-c', 'gunicorn_config.py', 'app:app'], cwd=ROOT, env=env)
+	try:
+		if not wait_for(args.port, 30):
+			sys.exit('gunicorn (%s) did not start listening on port %d' % (mode, args.port))
+		base = 'http://127.0.0.1:%d' % args.port
+		stop = threading.Event()
+		latencies = []
+		errors = []
+		threads = [threading.Thread(target=client, args=(base, users[i % len(users)][0], users[i % len(users)][1], stop,
+			latencies, errors)) for i in range(args.clients)]
+		for thread in threads:
+			thread.daemon = True
+			thread.start()
+		time.sleep(args.seconds)
+		stop.set()
+		for thread in threads:
+			thread.join()
+	finally:
+		server.terminate()
+		server.wait()
+	latencies.sort()
+	if not latencies:
+		sys.exit('%s: no request succeeded' % mode)
+	return {'requests': len(latencies), 'rps': len(latencies) / float(args.seconds), 'p50_ms': percentile(latencies, 0.5),
+		'p90_ms': percentile(latencies, 0.9), 'p99_ms': percentile(latencies, 0.99), 'errors': len(errors)}
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+	parser.add_argument('--database', default='postgresql:///piggybank_serving')
+	parser.add_argument('--users', type=int, default=20)
+	parser.add_argument('--banks', type=int, default=3)
+	parser.add_argument('--rows', type=int, default=200)
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--modes', default='sync,gevent')
+	parser.add_argument('--workers', type=int, default=2)
+	parser.add_argument('--clients', type=int, default=50)
+	parser.add_argument('--seconds', type=int, default=20)
+	parser.add_argument('--port', type=int, default=8123)
+	args = parser.parse_args()
+
+	os.environ['DATABASE_URL'] = args.database
+	os.environ.setdefault('CLOUDAMQP_URL', 'memory://')
+	from app import db, dbm, User, PiggyBank
+	import migrations
+
+	db.drop_all()
+	db.create_all()
+	migrations.stamp()
+	user_ids = dbm.generate_test_data(args.users, args.banks, args.rows, seed=args.seed)
+	users = []
+	for user in User.query.filter(User.id.in_(user_ids)).order_by(User.id):
+		users.append((user.username, [row[0] for row in db.session.query(PiggyBank.id).filter(PiggyBank.user_id == user.id)]))
+	db.session.remove()
+	print('loaded %d users x %d banks x %d rows; %d clients for %ds per mode' % (args.users, args.banks, args.rows,
+		args.clients, args.seconds))
+
+	results = {}
+	for mode in args.modes.split(','):
+		results[mode] = run(mode, args, users, os.environ)
+	print('\n%-8s %9s %9s %9s %9s %7s' % ('', 'req/s', 'p50 ms', 'p90 ms', 'p99 ms', 'errors'))
+	for mode in args.modes.split(','):
+		result = results[mode]
+		print('%-8s %9.1f %9.2f %9.2f %9.2f %7d' % (mode, result['rps'], result['p50_ms'], result['p90_ms'],
+			result['p99_ms'], result['errors']))
+
+
+if __name__ == '__main__':
+	main()
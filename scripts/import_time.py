@@ -0,0 +1,65 @@
+"""Time importing the web app in fresh interpreters and check that it leaves the
+worker-only modules alone.
+
+	python scripts/import_time.py --repeat 7 --max-ms 1500
+
+Each run starts a new Python process without CLOUDAMQP_URL, imports --module (app, the
+module gunicorn serves) and reports the import time and the number of modules loaded.
+The import must not load any of WORKER_ONLY; Celery, Flask-Mail and NumPy are imported by
+tasks.py or at first use. Exits non-zero when one is loaded or the median import takes
+longer than --max-ms, so it can run in CI to catch a regression.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+WORKER_ONLY = ('celery', 'kombu', 'billiard', 'flask_mail', 'numpy', 'brotli', 'tasks', 'forecast')
+# runs in the child; the import time excludes interpreter startup
+PROBE = '''
+import json, sys, time
+started = time.time()
+__import__(sys.argv[1])
+elapsed = time.time() - started
+print(json.dumps({'ms': elapsed * 1000, 'modules': sorted(sys.modules)}))
+'''
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+	parser.add_argument('--module', default='app')
+	parser.add_argument('--database', default='sqlite:////tmp/import_time.db')
+	parser.add_argument('--repeat', type=int, default=5)
+	parser.add_argument('--max-ms', type=float)
+	args = parser.parse_args()
+
+	env = dict(os.environ, DATABASE_URL=args.database)
+	env.pop('CLOUDAMQP_URL', None)
+	runs = []
+	for i in range(args.repeat):
+		output = subprocess.check_output([sys.executable, '-c', PROBE, args.module], cwd=ROOT, env=env)
+		runs.append(json.loads(output.decode('utf-8').strip().split('\n')[-1]))
+	timings = sorted(run['ms'] for run in runs)
+	median = timings[len(timings) // 2]
+	modules = runs[-1]['modules']
+	print('import %s: median %.1fms, min %.1fms, max %.1fms over %d runs; %d modules loaded' % (args.module, median,
+		timings[0], timings[-1], len(timings), len(modules)))
+
+	failed = False
+	loaded = [name for name in modules if name.split('.')[0] in WORKER_ONLY]
+	if loaded:
+		print('FAILED: importing %s loads %s' % (args.module, ', '.join(loaded)))
+		failed = True
+	if args.max_ms != None and median > args.max_ms:
+		print('FAILED: median import time %.1fms is over %.1fms' % (median, args.max_ms))
+		failed = True
+	if failed:
+		sys.exit(1)
+	print('ok')
+
+
+if __name__ == '__main__':
+	main()
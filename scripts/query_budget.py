@@ -0,0 +1,160 @@
+"""Request every budgeted endpoint once with the test client and fail if any of them runs
+more SQL statements than QUERY_BUDGETS in config.py allows.
+
+	python scripts/query_budget.py --database sqlite:////tmp/query_budget.db
+
+The fragment cache is cleared before each request, so fragment endpoints are measured
+rendering from scratch. Raise a budget only together with the change that needs it.
+"""
+import argparse
+import io
+import os
+import sys
+from decimal import Decimal
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+def load(dbm, User, PiggyBank, rows):
+	dbm.create_user('budget', 'testpass', 'budget@example.com', 'parent')
+	dbm.create_user('budgetadmin', 'testpass', 'budgetadmin@example.com', 'admin')
+	user = User.query.filter_by(username='budget').first()
+	for i in range(3):
+		dbm.create_user('kid%d' % i, 'testpass', 'kid%d@example.com' % i, 'child', user)
+	dbm.create_bank(user, 'Budget')
+	bank = PiggyBank.query.filter_by(user_id=user.id).first()
+	for i in range(rows):
+		dbm.create_deposit(Decimal(5), bank, 'deposit %d' % i)
+		dbm.create_expense('pending %d' % i, Decimal(1), bank, purchased=False)
+		dbm.create_expense('bought %d' % i, Decimal(1), bank, purchased=True)
+	for i in range(3):
+		dbm.create_allowance(Decimal(2), 'weekly', bank, 'allowance %d' % i, payday=i)
+		dbm.create_recurring_expense('recurring %d' % i, Decimal(1), 'monthly', bank)
+	return bank.id
+
+
+def latest_import():
+	from sqlalchemy import func
+	from app import db, LedgerImport
+	import_id = db.session.query(func.max(LedgerImport.id)).scalar()
+	db.session.remove()
+	return import_id
+
+
+def requests(bank_id, deposit_ids, expense_ids, allowance_ids, recurring_ids):
+	bank = {'bankid': bank_id}
+	deposit = dict(bank, amount='3.00', description='budget')
+	expense = dict(bank, name='budget', price='1.50', description='budget')
+	allowance = dict(bank, amount='2.00', frequency='weekly', description='budget')
+	recurring = dict(bank, name='budget', price='4.00', frequency='weekly', payday='2', description='budget')
+	return [
+		('banks', 'GET', '/banks/', {}),
+		('navigationbar', 'GET', '/navigation/', bank),
+		('overview', 'GET', '/overview/', bank),
+		('deposits', 'GET', '/deposits/', bank),
+		('expenses', 'GET', '/expenses/', bank),
+		('allowances', 'GET', '/allowances/', bank),
+		('analytics', 'GET', '/analytics/', bank),
+		('family_analytics', 'GET', '/family/analytics/', {}),
+		('settings', 'POST', '/settings/', bank),
+		('add_deposit', 'POST', '/adddeposit/', deposit),
+		('add_expense', 'POST', '/addexpense/', dict(expense, purchased='y')),
+		('purchase_expense', 'POST', '/purchaseexpense/', {'expenseid': expense_ids[0]}),
+		('refund_expense', 'POST', '/refundexpense/', {'expenseid': expense_ids[0]}),
+		('add_allowance', 'POST', '/addallowance/', allowance),
+		('toggle_allowance', 'POST', '/toggleallowance/', {'allowanceid': allowance_ids[0]}),
+		('update_allowance', 'POST', '/updateallowance/', dict(allowance, allowanceid=allowance_ids[0])),
+		('rename_bank', 'POST', '/renamebank/', {'bankid': bank_id, 'bankname': 'Renamed'}),
+		('api_add_deposit', 'POST', '/api/v1/banks/%d/deposits' % bank_id, deposit),
+		('api_add_expense', 'POST', '/api/v1/banks/%d/expenses' % bank_id, expense),
+		('api_purchase_expense', 'POST', '/api/v1/expenses/%d/purchase' % expense_ids[1], {}),
+		('api_refund_expense', 'POST', '/api/v1/expenses/%d/refund' % expense_ids[1], {}),
+		('api_add_allowance', 'POST', '/api/v1/banks/%d/allowances' % bank_id, allowance),
+		('api_toggle_allowance', 'POST', '/api/v1/allowances/%d/toggle' % allowance_ids[1], {}),
+		('delete_deposit', 'POST', '/deletedeposit/', {'depositid': deposit_ids[0]}),
+		('api_delete_deposit', 'DELETE', '/api/v1/deposits/%d' % deposit_ids[1], {}),
+		('delete_expense', 'POST', '/deleteexpense/', {'expenseid': expense_ids[2]}),
+		('delete_allowance', 'POST', '/deleteallowance/', {'allowanceid': allowance_ids[2]}),
+		('api_delete_expense', 'DELETE', '/api/v1/expenses/%d' % expense_ids[3], {}),
+		('api_delete_allowance', 'DELETE', '/api/v1/allowances/%d' % allowance_ids[1], {}),
+		('api_import_ledger', 'POST', '/api/v1/banks/%d/imports' % bank_id,
+			{'file': (io.BytesIO(b'date,amount,name\n2014-01-02,5.00,\n2014-01-03,-1.25,Candy\n'), 'ledger.csv')}),
+		('api_import_status', 'GET', lambda: '/api/v1/imports/%d' % latest_import(), {}),
+		('set_timezone', 'POST', '/settimezone/', {'bankid': bank_id, 'timezone': 'America/Chicago'}),
+		('api_set_timezone', 'POST', '/api/v1/timezone', {'timezone': 'Europe/Berlin'}),
+		('api_recurring_expenses', 'GET', '/api/v1/banks/%d/recurring_expenses' % bank_id, {}),
+		('api_add_recurring_expense', 'POST', '/api/v1/banks/%d/recurring_expenses' % bank_id, recurring),
+		('api_toggle_recurring_expense', 'POST', '/api/v1/recurring_expenses/%d/toggle' % recurring_ids[0], {}),
+		('api_delete_recurring_expense', 'DELETE', '/api/v1/recurring_expenses/%d' % recurring_ids[1], {}),
+		('api_bank_forecast', 'GET', '/api/v1/banks/%d/forecast?goal=500' % bank_id, {}),
+		('api_family_forecast', 'GET', '/api/v1/forecast?goal=500', {}),
+		('delete_bank', 'POST', '/deletebank/', {'bankid': bank_id, 'password': 'testpass'}),
+	]
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+	parser.add_argument('--database', default='sqlite:////tmp/query_budget.db')
+	parser.add_argument('--rows', type=int, default=60)
+	args = parser.parse_args()
+
+	os.environ['DATABASE_URL'] = args.database
+	os.environ.setdefault('CLOUDAMQP_URL', 'memory://')
+	from app import app, db, dbm, fragment_cache, User, PiggyBank, Deposit, Expense, Allowance, RecurringExpense, \
+		QueryBudgetExceeded
+	app.config.update(TESTING=True, WTF_CSRF_ENABLED=False, QUERY_BUDGET_STRICT=True)
+
+	db.drop_all()
+	db.create_all()
+	bank_id = load(dbm, User, PiggyBank, args.rows)
+	deposit_ids = [row[0] for row in db.session.query(Deposit.id).filter(Deposit.bank_id == bank_id).order_by(Deposit.id).limit(2)]
+	expense_ids = [row[0] for row in db.session.query(Expense.id).filter(Expense.bank_id == bank_id) \
+		.filter(Expense.purchased == False).order_by(Expense.id).limit(4)]
+	allowance_ids = [row[0] for row in db.session.query(Allowance.id).filter(Allowance.bank_id == bank_id).order_by(Allowance.id)]
+	recurring_ids = [row[0] for row in db.session.query(RecurringExpense.id).filter(RecurringExpense.bank_id == bank_id) \
+		.order_by(RecurringExpense.id)]
+	db.session.remove()
+
+	client = app.test_client()
+	budgets = app.config['QUERY_BUDGETS']
+	failures = []
+
+	def measure(endpoint, method, url, data):
+		fragment_cache.clear()
+		if callable(url):
+			url = url()
+		try:
+			# the fragment views read bankid from the query string on GET
+			if method == 'GET':
+				response = client.open(url, method=method, query_string=data)
+			else:
+				response = client.open(url, method=method, data=data)
+		except QueryBudgetExceeded as exc:
+			failures.append(str(exc))
+			print('%-22s over budget: %s' % (endpoint, exc))
+			return
+		if response.status_code >= 400:
+			failures.append('%s answered %d' % (endpoint, response.status_code))
+		print('%-22s %3s queries (budget %d) %d' % (endpoint, response.headers.get('X-Query-Count'),
+			budgets[endpoint], response.status_code))
+
+	client.post('/login/', data={'username': 'budget', 'password': 'testpass'})
+	exercised = set(['admin'])
+	for endpoint, method, url, data in requests(bank_id, deposit_ids, expense_ids, allowance_ids, recurring_ids):
+		measure(endpoint, method, url, data)
+		exercised.add(endpoint)
+	client.get('/logout/')
+	client.post('/login/', data={'username': 'budgetadmin', 'password': 'testpass'})
+	measure('admin', 'GET', '/admin/', {})
+
+	missing = sorted(set(budgets) - exercised)
+	if missing:
+		print('not exercised: ' + ', '.join(missing))
+	if failures:
+		print('FAILED: ' + '; '.join(failures))
+		sys.exit(1)
+	print('ok: every endpoint within its query budget')
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,69 @@
+"""Corrupt balances in a generated data set and check that one reconcile pass repairs
+them and that the next pass, with nothing written in between, checks no bank at all.
+
+	python scripts/reconcile_check.py --database postgresql:///piggybank_reconcile --users 200 --rows 500
+
+Drift is made the way it used to happen: ledger rows deleted behind the balance's back,
+plus some running deposit balances overwritten. Afterwards every bank must equal its
+deposits minus its purchased expenses.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from decimal import Decimal
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+	parser.add_argument('--database', default='sqlite:////tmp/reconcile_check.db')
+	parser.add_argument('--users', type=int, default=50)
+	parser.add_argument('--banks', type=int, default=2)
+	parser.add_argument('--rows', type=int, default=200)
+	parser.add_argument('--corrupt', type=int, default=20)
+	args = parser.parse_args()
+
+	os.environ['DATABASE_URL'] = args.database
+	os.environ.setdefault('CLOUDAMQP_URL', 'memory://')
+	from app import db, dbm, PiggyBank, Deposit
+	import migrations
+
+	db.drop_all()
+	db.create_all()
+	migrations.stamp()
+	dbm.generate_test_data(args.users, args.banks, args.rows)
+	checked, banks_fixed, deposits_fixed = dbm.reconcile()
+	print('first pass over fresh data: %d banks checked, %d balances and %d deposits repaired' % (checked, banks_fixed, deposits_fixed))
+
+	random.seed(3)
+	bank_ids = [row[0] for row in db.session.query(PiggyBank.id)]
+	corrupted = random.sample(bank_ids, min(args.corrupt, len(bank_ids)))
+	for bank_id in corrupted:
+		deposit_id = db.session.query(Deposit.id).filter(Deposit.bank_id == bank_id).order_by(Deposit.id).first()[0]
+		Deposit.query.filter(Deposit.id == deposit_id).delete(synchronize_session=False)
+		dbm.touch(bank_id)
+	table = Deposit.__table__
+	db.session.execute(table.update().where(table.c.bank_id.in_(corrupted[:len(corrupted) // 2])).values(balance=Decimal('-1')))
+	db.session.commit()
+
+	started = time.time()
+	checked, banks_fixed, deposits_fixed = dbm.reconcile()
+	print('after corrupting %d banks: %d checked, %d balances and %d deposits repaired in %.2fs' % (len(corrupted), checked,
+		banks_fixed, deposits_fixed, time.time() - started))
+	ok = checked == len(corrupted) and banks_fixed == len(corrupted)
+	ok = ok and not dbm.balance_drift(bank_ids) and not dbm.deposit_drift(bank_ids)
+	checked, banks_fixed, deposits_fixed = dbm.reconcile()
+	print('next pass: %d checked, %d repaired' % (checked, banks_fixed + deposits_fixed))
+	ok = ok and checked == 0 and banks_fixed + deposits_fixed == 0
+
+	if not ok:
+		print('FAILED: drift left behind or repaired banks rechecked')
+		sys.exit(1)
+	print('ok: balances reconciled')
+
+
+if __name__ == '__main__':
+	main()
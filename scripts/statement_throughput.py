@@ -0,0 +1,58 @@
+"""Send a week of statements for a generated data set to a local SMTP server and report
+the throughput.
+
+	python -m smtpd -n -c DebuggingServer localhost:1025 > /dev/null &
+	python scripts/statement_throughput.py --database sqlite:////tmp/statements.db --users 2000 --port 1025
+
+The database is dropped and loaded with dbm.generate_test_data. Every shard of
+send_statements runs in this process, each over its own SMTP connection, as a worker would.
+"""
+import argparse
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+	parser.add_argument('--database', default='sqlite:////tmp/statement_throughput.db')
+	parser.add_argument('--users', type=int, default=500)
+	parser.add_argument('--banks', type=int, default=2)
+	parser.add_argument('--rows', type=int, default=100)
+	parser.add_argument('--server', default='localhost')
+	parser.add_argument('--port', type=int, default=1025)
+	args = parser.parse_args()
+
+	os.environ['DATABASE_URL'] = args.database
+	os.environ.setdefault('CLOUDAMQP_URL', 'memory://')
+	os.environ['MAIL_SERVER'] = args.server
+	os.environ['MAIL_PORT'] = str(args.port)
+	from app import app, db, dbm
+	from tasks import send_statement_shard
+	import migrations
+
+	db.drop_all()
+	db.create_all()
+	migrations.stamp()
+	started = time.time()
+	dbm.generate_test_data(args.users, args.banks, args.rows)
+	print('loaded %d users x %d banks x %d rows in %.1fs' % (args.users, args.banks, args.rows, time.time() - started))
+
+	end = (datetime.utcnow() + timedelta(days=1)).strftime('%Y-%m-%d')
+	shards = dbm.statement_shards(app.config.get('STATEMENT_SHARDS', 4))
+	db.session.remove()
+	sent = 0
+	started = time.time()
+	for first, last in shards:
+		result = send_statement_shard(first, last, end)
+		print('users %d-%d: %d statements in %.2fs' % (first, last, result['sent'], result['elapsed']))
+		sent += result['sent']
+	elapsed = time.time() - started
+	print('%d statements in %.2fs: %.1f/s' % (sent, elapsed, sent / elapsed if elapsed else 0))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,99 @@
+"""Hammer one bank with concurrent deposits, purchases and refunds and check that
+no balance update is lost.
+
+	python scripts/stress_balances.py --database postgresql:///piggybank_stress --threads 16 --ops 200
+
+Phase 1 runs only deposits. Every deposit must end up with its own running
+balance, and current_balance must equal the sum of deposits. Phase 2 purchases
+and refunds a shared set of expenses from every thread. current_balance must
+equal deposits minus purchased expenses. A read-modify-write implementation
+fails both checks within a few hundred operations on Postgres.
+"""
+import argparse
+import os
+import random
+import sys
+import threading
+from decimal import Decimal
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+def run_threads(count, target):
+	errors = []
+	def guarded(index):
+		from app import db
+		try:
+			target(index)
+		except Exception as exc:
+			errors.append(exc)
+		finally:
+			db.session.remove()
+	threads = [threading.Thread(target=guarded, args=(i,)) for i in range(count)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	return errors
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+	parser.add_argument('--database', default='sqlite:////tmp/stress_balances.db')
+	parser.add_argument('--threads', type=int, default=8)
+	parser.add_argument('--ops', type=int, default=100)
+	parser.add_argument('--expenses', type=int, default=10)
+	args = parser.parse_args()
+
+	os.environ['DATABASE_URL'] = args.database
+	os.environ.setdefault('CLOUDAMQP_URL', 'memory://')
+	from sqlalchemy import func
+	from app import db, dbm, User, PiggyBank, Deposit, Expense
+
+	db.drop_all()
+	db.create_all()
+	dbm.create_user('stress', 'testpass', 'stress@example.com', 'parent')
+	user = User.query.filter_by(username='stress').first()
+	dbm.create_bank(user, 'Stress')
+	bank_id = PiggyBank.query.filter_by(user_id=user.id).first().id
+	for i in range(args.expenses):
+		dbm.create_expense('thing %d' % i, Decimal('1.25'), PiggyBank.query.get(bank_id), purchased=False)
+	db.session.remove()
+
+	def deposit(index):
+		for i in range(args.ops):
+			dbm.create_deposit(Decimal(random.randint(1, 100)), PiggyBank.query.get(bank_id), 'thread %d' % index)
+
+	errors = run_threads(args.threads, deposit)
+	deposits = db.session.query(func.sum(Deposit.amount_deposited)).filter(Deposit.bank_id == bank_id).scalar()
+	balances = [row[0] for row in db.session.query(Deposit.balance).filter(Deposit.bank_id == bank_id)]
+	balance = PiggyBank.query.get(bank_id).current_balance
+	print('deposits: %d ops, sum %s, current_balance %s, %d distinct running balances, %d errors' % (
+		len(balances), deposits, balance, len(set(balances)), len(errors)))
+	ok = balance == deposits and len(set(balances)) == len(balances)
+	db.session.remove()
+
+	expense_ids = [row[0] for row in db.session.query(Expense.id).filter(Expense.bank_id == bank_id)]
+	def purchase_and_refund(index):
+		for i in range(args.ops):
+			expense = Expense.query.get(random.choice(expense_ids))
+			if random.random() < 0.5:
+				dbm.purchase_expense(expense)
+			else:
+				dbm.refund_expense(expense)
+
+	errors = run_threads(args.threads, purchase_and_refund)
+	spent = db.session.query(func.coalesce(func.sum(Expense.price), 0)).filter(Expense.bank_id == bank_id) \
+		.filter(Expense.purchased == True).scalar()
+	balance = PiggyBank.query.get(bank_id).current_balance
+	print('purchases/refunds: expected %s, current_balance %s, %d errors' % (deposits - spent, balance, len(errors)))
+	ok = ok and balance == deposits - spent
+
+	if not ok:
+		print('FAILED: lost balance updates')
+		sys.exit(1)
+	print('ok: no lost updates')
+
+
+if __name__ == '__main__':
+	main()
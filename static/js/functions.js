@@ -57,7 +57,143 @@ $(document).ready(function() {
 	})
 
 	$(function() {
-		$("#datepicker").datepicker();
+		if ($.fn.datepicker) {
+			$("#datepicker").datepicker();
+		}
 	});
 
-});
\ No newline at end of file
+});
+
+
+/* Bank fragments send their changes to the JSON API (/api/v1/) and patch the page with the
+   records and bank balance that come back, instead of reloading whole fragments. */
+var piggybank = (function() {
+	var months = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"];
+
+	function escape(text) {
+		return $("<div>").text(text == null ? "" : text).html();
+	}
+
+	// "2014-11-03" -> "Nov. 03, 2014", as the templates render dates
+	function day(iso) {
+		if (!iso) {
+			return "";
+		}
+		var parts = iso.split("-");
+		return months[parseInt(parts[1], 10) - 1] + ". " + parts[2] + ", " + parts[0];
+	}
+
+	function api(path) {
+		return (window.$SCRIPT_ROOT || "") + "/api/v1/" + path;
+	}
+
+	function button(action, kind, id, icon) {
+		return '<button type="button" class="btn btn-default" data-action="' + action + '" data-kind="' + kind +
+			'" data-id="' + id + '"><span class="glyphicon ' + icon + '"></span></button>';
+	}
+
+	var rows = {
+		deposit: function(d) {
+			return '<tr id="deposit' + d.id + '"><td>$' + d.amount + '</td><td>' + escape(d.description) + '</td><td>' +
+				day(d.date) + '</td><td>' + button("delete", "deposit", d.id, "glyphicon-remove deletebutton") + '</td></tr>';
+		},
+		expense: function(e) {
+			var toggle = e.purchased ? button("refund", "expense", e.id, "glyphicon-backward purchasebutton")
+				: button("purchase", "expense", e.id, "glyphicon-ok purchasebutton");
+			return '<tr id="expense' + e.id + '"><td>' + escape(e.name) + '</td><td>' + escape(e.description) + '</td><td>$' +
+				e.price + '</td><td>' + day(e.date_added) + '</td><td>' + day(e.date_purchased) + '</td><td>' + toggle + ' ' +
+				button("delete", "expense", e.id, "glyphicon-remove deletebutton") + '</td></tr>';
+		},
+		allowance: function(a) {
+			return '<tr id="allowance' + a.id + '"><td>$' + a.amount + '</td><td>' + escape(a.description) + '</td><td>' +
+				escape(a.frequency) + '</td><td>' + button("toggle", "allowance", a.id, "glyphicon-off " +
+				(a.active ? "purchasebutton" : "deletebutton")) + '</td><td>' +
+				button("delete", "allowance", a.id, "glyphicon-remove deletebutton") + '</td></tr>';
+		}
+	};
+
+	function setBalance(bank) {
+		$("#bankbalance" + bank.id).text(" $" + bank.balance + " ");
+	}
+
+	// new rows go to the top of their list, which is newest first
+	function place(kind, bankid, record) {
+		var html = rows[kind](record);
+		if (kind == "expense" && record.purchased) {
+			$("#purchasedmarker" + bankid).after(html);
+		} else {
+			$("#" + kind + "table" + bankid + " tr:first").after(html);
+		}
+		$("#" + kind + "table" + bankid + ", #" + kind + "heading" + bankid).show();
+	}
+
+	$(document).ajaxSend(function(evt, xhr, settings) {
+		if (!/^(GET|HEAD|OPTIONS|TRACE)$/i.test(settings.type)) {
+			xhr.setRequestHeader("X-CSRFToken", $("meta[name=csrf-token]").attr("content"));
+		}
+	});
+
+	$(document).on("click", "[data-action]", function(evt) {
+		evt.preventDefault();
+		var el = $(this), action = el.data("action"), kind = el.data("kind"), id = el.data("id");
+		if (action == "more") {
+			$.ajax({
+				type: "POST",
+				dataType: "html",
+				url: el.data("url"),
+				data: {bankid: el.data("bank"), cursor: String(el.data("cursor")), list: el.data("list")},
+				success: function(html) {
+					el.closest("tr").replaceWith(html);
+				}
+			});
+			return;
+		}
+		$.ajax({
+			type: action == "delete" ? "DELETE" : "POST",
+			dataType: "json",
+			url: api(kind + "s/" + id + (action == "delete" ? "" : "/" + action)),
+			success: function(data) {
+				setBalance(data.bank);
+				var row = $("#" + kind + id);
+				if (action == "delete") {
+					row.remove();
+				} else if (kind == "expense") {
+					row.remove();
+					place(kind, data.bank.id, data.expense);
+				} else {
+					row.replaceWith(rows[kind](data[kind]));
+				}
+			}
+		});
+	});
+
+	$(document).on("submit", "form.apiform", function(evt) {
+		evt.preventDefault();
+		var form = $(this), kind = form.data("kind"), bankid = form.data("bank");
+		$.ajax({
+			type: "POST",
+			dataType: "json",
+			url: api("banks/" + bankid + "/" + kind + "s"),
+			data: form.serialize(),
+			success: function(data) {
+				form.find(".apierrors").remove();
+				form[0].reset();
+				setBalance(data.bank);
+				place(kind, bankid, data[kind]);
+			},
+			error: function(xhr) {
+				var errors = (xhr.responseJSON && xhr.responseJSON.errors) || {form: ["Something went wrong. Please try again."]};
+				var list = $('<ul class="apierrors"></ul>');
+				$.each(errors, function(field, messages) {
+					$.each(messages, function(i, message) {
+						list.append($("<li></li>").text(message));
+					});
+				});
+				form.find(".apierrors").remove();
+				form.append(list);
+			}
+		});
+	});
+
+	return {day: day, rows: rows};
+})();
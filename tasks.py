@@ -0,0 +1,214 @@
+"""Celery tasks and the beat scheduler.
+
+Only the worker imports this module at startup:
+
+	celery -A tasks.celery worker --beat
+
+Views that queue a task import it where they queue it, so the web process starts without
+Celery, Flask-Mail or a reachable broker. Without CLOUDAMQP_URL, config.py runs tasks in
+the calling process instead. Every task runs inside an application context.
+"""
+from flask import has_app_context
+from flask.ext.mail import Mail, Message
+from sqlalchemy.exc import IntegrityError
+from datetime import datetime, timedelta
+from celery import Celery, chord, beat
+from celery.schedules import crontab
+from celery.utils.timeutils import maybe_make_aware
+from uuid import uuid4
+from app import app, db, dbm, BeatEntry, RECURRING_TYPES
+import os
+import pytz
+import socket
+import time
+
+
+### Celery Flask Integration
+def make_celery(app):
+	celery = Celery(app.import_name)
+	celery.conf.add_defaults(app.config)
+	# config.py lists beat entries as crontab fields, so importing it doesn't import Celery
+	celery.conf.CELERYBEAT_SCHEDULE = dict((name, dict(entry, schedule=crontab(**entry['schedule'])))
+		for name, entry in app.config.get('CELERYBEAT_SCHEDULE', {}).items())
+	TaskBase = celery.Task
+	class ContextTask(TaskBase):
+		abstract = True
+		def __call__(self, *args, **kwargs):
+			# eager tasks queued from a view already run inside its context
+			if has_app_context():
+				return TaskBase.__call__(self, *args, **kwargs)
+			with app.app_context():
+				return TaskBase.__call__(self, *args, **kwargs)
+	celery.Task = ContextTask
+	return celery
+
+celery = make_celery(app)
+
+mail = Mail(app)
+
+
+### Tasks
+@celery.task
+def run_schedules():
+	# hourly tick: fan every due allowance and recurring expense out over bank-id shards;
+	# report_schedules runs once every shard is done
+	now = datetime.utcnow().replace(microsecond=0)
+	dbm.schedule_unscheduled()
+	header = []
+	for kind in sorted(RECURRING_TYPES):
+		for first, last in dbm.due_shards(kind, now, app.config.get('SCHEDULE_SHARDS', 8)):
+			header.append(run_schedule_shard.s(kind, first, last, now.strftime("%Y-%m-%dT%H:%M:%S")))
+	if not header:
+		return report_schedules([], time.time())
+	chord(header)(report_schedules.s(time.time()))
+	return len(header)
+
+@celery.task(bind=True, max_retries=5, default_retry_delay=10)
+def run_schedule_shard(self, kind, first_bank, last_bank, now):
+	now = datetime.strptime(now, "%Y-%m-%dT%H:%M:%S")
+	try:
+		count, elapsed = dbm.run_due(kind, now, bank_range=(first_bank, last_bank))
+	except IntegrityError as exc:
+		# a duplicate of this shard committed first; the retry only runs what is still due
+		raise self.retry(exc=exc)
+	return {'kind': kind, 'count': count, 'elapsed': elapsed}
+
+@celery.task
+def delete_bank_task(bank_id):
+	started = time.time()
+	dbm.delete_bank(bank_id)
+	app.logger.info("delete_bank_task: deleted bank %d in %.3fs", bank_id, time.time() - started)
+	return
+
+@celery.task
+def import_ledger_task(import_id):
+	started = time.time()
+	ledger_import = dbm.run_import(import_id)
+	app.logger.info("import_ledger_task: import %d %s, %d rows in %.3fs", import_id, ledger_import.status,
+		ledger_import.rows_imported, time.time() - started)
+	return
+
+@celery.task
+def send_statements(end=None):
+	# weekly tick: fan the parents out over user-id shards, one SMTP connection each
+	if end == None:
+		end = datetime.utcnow().strftime("%Y-%m-%d")
+	header = [send_statement_shard.s(first, last, end) for first, last in dbm.statement_shards(app.config.get('STATEMENT_SHARDS', 4))]
+	if not header:
+		return report_statements([], time.time())
+	chord(header)(report_statements.s(time.time()))
+	return len(header)
+
+@celery.task
+def send_statement_shard(first_user, last_user, end):
+	# Statements for the week before `end` (a UTC date), STATEMENT_BATCH parents per set of queries.
+	# Both templates are compiled once and every message goes out over one SMTP connection;
+	# Flask-Mail reconnects after MAIL_MAX_EMAILS messages.
+	end = datetime.strptime(end, "%Y-%m-%d")
+	start = end - timedelta(days=7)
+	started = time.time()
+	sent = 0
+	text = app.jinja_env.get_template('statement.txt')
+	html = app.jinja_env.get_template('statement.html')
+	subject = 'Piggy bank statement for %s to %s' % (start.strftime('%b. %d'), (end - timedelta(days=1)).strftime('%b. %d, %Y'))
+	with mail.connect() as connection:
+		after = first_user - 1
+		while True:
+			batch = dbm.statement_batch(after, last_user, start, end)
+			db.session.remove()
+			if not batch:
+				break
+			for parent, banks in batch:
+				if not banks:
+					continue
+				context = {'parent': parent, 'banks': banks, 'start': start, 'end': end - timedelta(days=1)}
+				connection.send(Message(subject, recipients=[parent.email], body=text.render(context), html=html.render(context)))
+				sent += 1
+			after = batch[-1][0].id
+	elapsed = time.time() - started
+	app.logger.info("send_statement_shard: users %d-%d, %d statements in %.3fs (%.1f/s)", first_user, last_user, sent, elapsed,
+		sent / elapsed if elapsed else 0)
+	return {'sent': sent, 'elapsed': elapsed}
+
+@celery.task
+def report_statements(results, started):
+	sent = sum(result['sent'] for result in results)
+	elapsed = time.time() - started
+	app.logger.info("send_statements: sent %d statements in %d shards in %.3fs (%.1f/s)", sent, len(results), elapsed,
+		sent / elapsed if elapsed else 0)
+	return {'sent': sent, 'shards': len(results), 'elapsed': elapsed}
+
+@celery.task
+def backfill_rollups_task():
+	started = time.time()
+	count = dbm.backfill_rollups()
+	app.logger.info("backfill_rollups_task: rebuilt rollups of %d banks in %.3fs", count, time.time() - started)
+	return count
+
+@celery.task
+def reconcile_task(full=False):
+	started = time.time()
+	checked, banks_fixed, deposits_fixed = dbm.reconcile(full=full)
+	app.logger.info("reconcile_task: checked %d banks, repaired %d balances and %d deposit balances in %.3fs",
+		checked, banks_fixed, deposits_fixed, time.time() - started)
+	return {'checked': checked, 'balances': banks_fixed, 'deposits': deposits_fixed}
+
+@celery.task
+def report_schedules(results, started):
+	totals = dict((kind, 0) for kind in RECURRING_TYPES)
+	for result in results:
+		totals[result['kind']] += result['count']
+	elapsed = time.time() - started
+	app.logger.info("run_schedules: paid %d allowances, charged %d recurring expenses in %d shards in %.3fs",
+		totals['allowance'], totals['expense'], len(results), elapsed)
+	return {'allowances': totals['allowance'], 'expenses': totals['expense'], 'shards': len(results), 'elapsed': elapsed}
+
+
+### Beat Scheduler
+class DatabaseScheduler(beat.Scheduler):
+	# Only the process holding the 'celerybeat' lease sends tasks; everyone else polls for it,
+	# so every worker dyno can run --beat. Last-run times live in beat_entry instead of a shelve file.
+	lock_name = 'celerybeat'
+
+	def __init__(self, *args, **kwargs):
+		self.owner = '%s:%d:%s' % (socket.gethostname(), os.getpid(), uuid4().hex[:8])
+		self.lock_ttl = app.config.get('BEAT_LOCK_TTL', 30)
+		self.is_leader = False
+		beat.Scheduler.__init__(self, *args, **kwargs)
+
+	def setup_schedule(self):
+		self.merge_inplace(self.app.conf.CELERYBEAT_SCHEDULE)
+		self.load_entries()
+
+	def load_entries(self):
+		for row in BeatEntry.query.filter(BeatEntry.name.in_(list(self.schedule.keys()))):
+			if row.last_run_at != None:
+				self.schedule[row.name].last_run_at = maybe_make_aware(row.last_run_at)
+			self.schedule[row.name].total_run_count = row.total_run_count
+		db.session.commit()
+
+	def reserve(self, entry):
+		# persisted before the task is sent, so a new leader never re-runs it
+		new_entry = beat.Scheduler.reserve(self, entry)
+		last_run_at = maybe_make_aware(new_entry.last_run_at).astimezone(pytz.utc).replace(tzinfo=None)
+		dbm.save_beat_entry(new_entry.name, last_run_at, new_entry.total_run_count)
+		return new_entry
+
+	def tick(self):
+		was_leader = self.is_leader
+		self.is_leader = dbm.acquire_lock(self.lock_name, self.owner, self.lock_ttl)
+		if not self.is_leader:
+			return self.lock_ttl / 3.0
+		if not was_leader:
+			# the previous leader may have run entries since we loaded them
+			self.load_entries()
+		return min(beat.Scheduler.tick(self), self.lock_ttl / 3.0)
+
+	def close(self):
+		if self.is_leader:
+			dbm.release_lock(self.lock_name, self.owner)
+		beat.Scheduler.close(self)
+
+	@property
+	def info(self):
+		return '    . db -> lock %r (ttl %ss, owner %s)' % (self.lock_name, self.lock_ttl, self.owner)